@@ -0,0 +1,201 @@
+#! /usr/bin/python
+
+""" Copyright 2014 Forrest Brennen
+
+    This file is part of price_picture.
+
+    price_picture is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    price_picture is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with price_picture.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from datetime import datetime
+
+"""
+AggregateCache.py
+
+Stores calculated results in the DB, so that we don't have to go through every
+sale again each time we want to draw something.
+
+Each cache entry holds one metric (e.g. 'median') for every postcode prefix at
+one level (e.g. 'district', as in 'OX1') in one region (e.g. 'OX') for one
+year. Alongside the cache there's a collection of watermarks, one per (region,
+year), which the importers bump whenever they add sales. Entries remember the
+watermark they were built from, and are only used if it's still current, so
+importing new data for 2013 doesn't throw away anything we know about 1996.
+"""
+
+# The only prefix level we aggregate at for now.
+district_level = 'district'
+
+def mark_changed(watermark_collection, cells):
+    """Records that the sales for some (region, year) cells have changed.
+
+    Any cached aggregates for those cells will be rebuilt next time they're
+    asked for. Importers should call this once they've added their data.
+    """
+    for region, year in cells:
+        watermark_collection.update({ '_id': '%s:%d' % (region, year) },
+                                    { '$set': { 'region': region,
+                                                'year': year,
+                                                'updated': datetime.utcnow() },
+                                      '$inc': { 'version': 1 } },
+                                    upsert = True)
+
+class AggregateCache():
+    """A persistent, size-limited cache of per-prefix, per-year aggregates.
+
+    Public methods:
+    - __init__(collection, watermark_collection, max_entries) -- sets up the
+      cache.
+    - get_years(region, level, metric, years) -- fetches whatever is cached
+      and still valid.
+    - put(region, level, metric, year, values, counts) -- stores an entry.
+    - patch_year(region, level, year, metric_values, counts, prefixes) --
+      marks some prefixes of a year as changed, and updates just those.
+    - cached_metrics(region, level, year) -- the metrics with valid entries
+      for a year.
+    - invalidate(region, years) -- throws away entries built from stale data.
+    - versions(region, years) -- the current watermark of each year.
+
+    Public variables:
+    - max_entries -- the most entries we'll keep before evicting the least
+      recently used.
+    """
+
+    def __init__(self, collection, watermark_collection, max_entries = 10000):
+        """Constructor.
+
+        Accepts the collection to keep the cache in, the collection of
+        watermarks the importers maintain (see mark_changed), and the maximum
+        number of entries to keep.
+        """
+        self._collection = collection
+        self._watermarks = watermark_collection
+        self.max_entries = max_entries
+        self._collection.ensure_index([('region', 1), ('level', 1),
+                                       ('metric', 1), ('year', 1)])
+        self._collection.ensure_index('last_used')
+
+    def get_years(self, region, level, metric, years):
+        """Fetches cached values for a list of years.
+
+        Returns a dictionary mapping each year that was found, and is still
+        valid, to a pair of dictionaries: prefix -> value and prefix -> number
+        of sales. Years which need recalculating are left out.
+        """
+        versions = self.versions(region, years)
+        found = {}
+        for entry in self._collection.find({ 'region': region,
+                                             'level': level,
+                                             'metric': metric,
+                                             'year': { '$in': list(years) } }):
+            if entry['watermark'] != versions.get(entry['year'], 0):
+                continue
+            values = dict((prefix, value)
+                          for prefix, value, count in entry['cells'])
+            counts = dict((prefix, count)
+                          for prefix, value, count in entry['cells'])
+            found[entry['year']] = (values, counts)
+        if found:
+            self._collection.update({ '_id': { '$in':
+                                               [_entry_id(region, level,
+                                                          metric, year)
+                                                for year in found] } },
+                                    { '$set': { 'last_used':
+                                                datetime.utcnow() } },
+                                    multi = True)
+        return found
+
+    def put(self, region, level, metric, year, values, counts):
+        """Stores the values (prefix -> value) and counts (prefix -> number of
+        sales) of a metric for a year, stamped with the current watermark.
+        """
+        version = self.versions(region, [year]).get(year, 0)
+        self._collection.save({ '_id': _entry_id(region, level, metric, year),
+                                'region': region,
+                                'level': level,
+                                'metric': metric,
+                                'year': year,
+                                'watermark': version,
+                                'last_used': datetime.utcnow(),
+                                'cells': [[prefix, values[prefix],
+                                           counts.get(prefix, 0)]
+                                          for prefix in sorted(values)] })
+        self._evict()
+
+    def patch_year(self, region, level, year, metric_values, counts,
+                   prefixes):
+        """Records that the sales under some prefixes in a year have changed,
+        and brings the cached entries up to date for only those prefixes.
+
+        metric_values (metric -> (prefix -> value)) and counts hold the new
+        results for the changed prefixes; prefixes in the list but not in
+        counts no longer have any sales. The watermark is only moved on once,
+        so every metric given is patched. Entries for any other metric, or
+        which weren't valid to begin with, are left to be rebuilt in full.
+        """
+        version = self.versions(region, [year]).get(year, 0)
+        entries = list(self._collection.find({ 'region': region,
+                                               'level': level,
+                                               'year': year }))
+        mark_changed(self._watermarks, [(region, year)])
+        prefixes = set(prefixes)
+        for entry in entries:
+            if entry['watermark'] != version or \
+               entry['metric'] not in metric_values:
+                continue
+            new_values = dict((prefix, value)
+                              for prefix, value, count in entry['cells']
+                              if prefix not in prefixes)
+            new_counts = dict((prefix, count)
+                              for prefix, value, count in entry['cells']
+                              if prefix not in prefixes)
+            new_values.update(metric_values[entry['metric']])
+            new_counts.update(counts)
+            self.put(region, level, entry['metric'], year, new_values,
+                     new_counts)
+
+    def cached_metrics(self, region, level, year):
+        """Returns the metrics which have a valid entry for a year."""
+        version = self.versions(region, [year]).get(year, 0)
+        return [entry['metric'] for entry in self._collection.find(
+                    { 'region': region, 'level': level, 'year': year },
+                    { 'metric': 1, 'watermark': 1 })
+                if entry['watermark'] == version]
+
+    def invalidate(self, region, years):
+        """Removes every cached entry for some years in a region."""
+        self._collection.remove({ 'region': region,
+                                  'year': { '$in': list(years) } })
+
+    def versions(self, region, years):
+        """Returns the current watermark of each year in a region, as a
+        dictionary. Years which have never had sales imported are missing.
+        """
+        return dict((entry['year'], entry['version'])
+                    for entry in self._watermarks.find(
+                        { 'region': region, 'year': { '$in': list(years) } }))
+
+    def _evict(self):
+        """Removes the least recently used entries if we're over size."""
+        excess = self._collection.count() - self.max_entries
+        if excess <= 0:
+            return
+        oldest = [entry['_id'] for entry in
+                  self._collection.find({}, { '_id': 1 })
+                                  .sort('last_used', 1).limit(excess)]
+        self._collection.remove({ '_id': { '$in': oldest } })
+
+def _entry_id(region, level, metric, year):
+    """Returns the key of a cache entry."""
+    return '%s:%s:%s:%d' % (region, level, metric, year)
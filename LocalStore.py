@@ -0,0 +1,969 @@
+#! /usr/bin/python
+
+""" Copyright 2014 Forrest Brennen
+
+    This file is part of price_picture.
+
+    price_picture is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    price_picture is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with price_picture.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import cPickle
+import math
+import re
+import sqlite3
+import threading
+import uuid
+
+from pymongo import errors
+
+"""
+LocalStore.py
+
+An embedded stand-in for a MongoDB server, keeping everything in a single
+SQLite file, so price_picture can be run (and tested) without a mongod.
+
+Only the bits of pymongo's database and collection API that price_picture
+actually uses are here: find/insert/save/update/remove with the simple query
+operators, unordered bulk operations, and aggregation pipelines made of
+$match, $project, $group, $sort, $skip and $limit. Each collection is a table
+of pickled documents keyed on _id. ensure_index adds a real column (and a
+SQLite index) for each indexed field, so queries on those fields are narrowed
+down by SQLite before we look at any documents; everything else is checked
+in Python. explain says which index SQLite picked, in the same form as a
+MongoDB server would, though as the documents themselves are always read,
+no query is ever covered by an index here.
+
+Pick this backend with db_schemas.connect('local'), or by setting
+PRICE_PICTURE_BACKEND=local.
+"""
+
+# SQLite won't take more than 999 parameters in a single query.
+_max_parameters = 500
+
+# Stands in for a field a document doesn't have.
+_missing = object()
+
+class LocalDatabase():
+    """A database of LocalCollections, stored in one SQLite file.
+
+    Public methods:
+    - __init__(path) -- opens (or creates) the database file.
+    - __getitem__(name) -- returns a LocalCollection.
+    - collection_names() -- the names of every collection.
+    - drop_collection(name) -- removes a collection and everything in it.
+
+    Public variables:
+    - path -- the SQLite file.
+    """
+
+    def __init__(self, path):
+        """Constructor.
+
+        path can be ':memory:' for a database which disappears when we're done
+        with it.
+        """
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread = False)
+        self._connection.text_factory = str
+        # We only ever have one writer, and can always rebuild from the csv
+        # files, so there's no need to sync to disk after every statement.
+        self._connection.execute('PRAGMA journal_mode = WAL')
+        self._connection.execute('PRAGMA synchronous = NORMAL')
+        self._lock = threading.RLock()
+        self._collections = {}
+
+    def __getitem__(self, name):
+        """Returns the collection called name, creating it if need be."""
+        if name not in self._collections:
+            self._collections[name] = LocalCollection(self, name)
+        return self._collections[name]
+
+    def collection_names(self):
+        """Returns the names of every collection in the database."""
+        with self._lock:
+            return [str(row[0]) for row in self._connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' "
+                "AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+
+    def drop_collection(self, name):
+        """Removes a collection and everything in it."""
+        self[name].drop()
+
+class LocalCollection():
+    """A collection of documents in a LocalDatabase, which can be used in place
+    of a pymongo collection.
+
+    Public methods:
+    - find(query, projection), find_one(query, projection) -- look things up.
+    - insert(documents), save(document) -- add things.
+    - update(query, document, upsert, multi) -- change things.
+    - remove(query), drop() -- get rid of things.
+    - count() -- the number of documents.
+    - distinct(key, query) -- the different values of a field.
+    - ensure_index(key_or_list, unique) -- indexes some fields.
+    - index_information() -- the indexes, by name.
+    - drop_index(index_or_name) -- removes an index.
+    - initialize_unordered_bulk_op() -- starts a LocalBulkOperation.
+    - aggregate(pipeline) -- runs an aggregation pipeline.
+
+    Public variables:
+    - name -- the collection's name.
+    """
+
+    def __init__(self, database, name):
+        """Constructor. Use LocalDatabase[name] rather than calling this."""
+        self.name = name
+        self._database = database
+        self._connection = database._connection
+        self._lock = database._lock
+        self._table = _quote(name)
+        self._fields = []
+        self._create()
+
+    def find(self, query = None, projection = None):
+        """Returns a LocalCursor over the documents matching query."""
+        return LocalCursor(self, query or {}, projection)
+
+    def find_one(self, query = None, projection = None):
+        """Returns the first document matching query, or None."""
+        for document in self.find(query, projection).limit(1):
+            return document
+        return None
+
+    def insert(self, documents):
+        """Inserts a document, or a list of them, and returns the _id(s).
+
+        Raises DuplicateKeyError if any of them are already present, though
+        those before it will still have been inserted.
+        """
+        single = isinstance(documents, dict)
+        if single:
+            documents = [documents]
+        ids = []
+        with self._lock:
+            try:
+                with self._connection:
+                    for document in documents:
+                        document.setdefault('_id', uuid.uuid4().hex)
+                        self._connection.execute(self._insert_sql('INSERT'),
+                                                 self._row(document))
+                        ids.append(document['_id'])
+            except sqlite3.IntegrityError as e:
+                # The ones before the duplicate should still go in
+                if ids:
+                    self.insert(documents[:len(ids)])
+                raise errors.DuplicateKeyError(str(e), 11000)
+        return ids[0] if single else ids
+
+    def save(self, document):
+        """Inserts a document, replacing any with the same _id."""
+        document.setdefault('_id', uuid.uuid4().hex)
+        with self._lock:
+            with self._connection:
+                self._connection.execute(self._insert_sql('INSERT OR REPLACE'),
+                                         self._row(document))
+        return document['_id']
+
+    def update(self, query, document, upsert = False, multi = False):
+        """Updates the first document matching query (or all of them, if
+        multi), either with the $set and $inc operators or by replacing it
+        with document. If nothing matches and upsert is set, a new document is
+        made from the query.
+        """
+        with self._lock:
+            matches = self.find(query)
+            if not multi:
+                matches = matches.limit(1)
+            updated = [_apply_update(old, document) for old in matches]
+            if not updated and upsert:
+                new = dict((field, value) for field, value in query.iteritems()
+                           if not field.startswith('$') and
+                              not _is_operator(value))
+                updated = [_apply_update(new, document)]
+                updated[0].setdefault('_id', uuid.uuid4().hex)
+            with self._connection:
+                self._connection.executemany(
+                    self._insert_sql('INSERT OR REPLACE'),
+                    [self._row(new) for new in updated])
+        return { 'n': len(updated) }
+
+    def remove(self, query = None):
+        """Removes every document matching query, or everything."""
+        with self._lock:
+            with self._connection:
+                if not query:
+                    self._connection.execute('DELETE FROM ' + self._table)
+                    return
+                ids = [document['_id'] for document in
+                       self.find(query, { '_id': 1 })]
+                for start in range(0, len(ids), _max_parameters):
+                    chunk = ids[start:start + _max_parameters]
+                    self._connection.execute(
+                        'DELETE FROM %s WHERE _id IN (%s)' %
+                        (self._table, ', '.join('?' * len(chunk))), chunk)
+
+    def drop(self):
+        """Removes the collection and all its indexes."""
+        with self._lock:
+            with self._connection:
+                self._connection.execute('DROP TABLE IF EXISTS ' + self._table)
+            self._create()
+
+    def count(self):
+        """Returns the number of documents in the collection."""
+        with self._lock:
+            return self._connection.execute(
+                'SELECT COUNT(*) FROM ' + self._table).fetchone()[0]
+
+    def distinct(self, key, query = None):
+        """Returns a list of the different values a field has in the documents
+        matching query.
+
+        If the field is indexed and there's no query, only one document for
+        each value is read, found with the index.
+        """
+        if not query and key in self._fields:
+            with self._lock:
+                rows = self._connection.execute(
+                    'SELECT doc FROM %s WHERE rowid IN '
+                    '(SELECT MIN(rowid) FROM %s GROUP BY %s)' %
+                    (self._table, self._table, _column(key))).fetchall()
+            documents = (cPickle.loads(str(row[0])) for row in rows)
+        else:
+            documents = self._select(query or {})
+        values = []
+        for document in documents:
+            value = _get(document, key)
+            if value is not _missing and value not in values:
+                values.append(value)
+        return values
+
+    def ensure_index(self, key_or_list, unique = False, **kwargs):
+        """Indexes a field, or a list of (field, direction) pairs.
+
+        Each field gets its own column, which is filled in for the documents
+        already present. Indexes we've already made are skipped straight
+        away, so this is cheap to call before every write.
+        """
+        fields = _index_fields(key_or_list)
+        name = self._index_name(fields)
+        if name in self._indexes:
+            return
+        with self._lock:
+            with self._connection:
+                for field in fields:
+                    if field != '_id' and field not in self._fields:
+                        self._add_field(field)
+                columns = ', '.join(_column(field) for field in fields)
+                self._connection.execute(
+                    'CREATE %s INDEX IF NOT EXISTS %s ON %s (%s)' %
+                    ('UNIQUE' if unique else '', _quote(name), self._table,
+                     columns))
+            self._indexes.add(name)
+
+    def index_information(self):
+        """Returns a dictionary mapping the name of each index to its fields,
+        as pymongo does, e.g. { 'date_1': { 'key': [('date', 1)] } }.
+
+        Everything is indexed in ascending order, whatever direction was asked
+        for.
+        """
+        information = { '_id_': { 'key': [('_id', 1)] } }
+        for sql_name, key, unique in self._index_list():
+            information[_mongo_index_name(key)] = { 'key': key }
+            if unique:
+                information[_mongo_index_name(key)]['unique'] = True
+        return information
+
+    def drop_index(self, index_or_name):
+        """Removes an index, given its name (see index_information) or its
+        fields. The columns stay, as other indexes may be using them.
+        """
+        if isinstance(index_or_name, basestring):
+            information = self.index_information()
+            if index_or_name not in information or index_or_name == '_id_':
+                raise errors.OperationFailure('index not found with name [%s]'
+                                              % index_or_name)
+            index_or_name = information[index_or_name]['key']
+        name = self._index_name(_index_fields(index_or_name))
+        with self._lock:
+            with self._connection:
+                self._connection.execute('DROP INDEX IF EXISTS ' +
+                                         _quote(name))
+            self._indexes.discard(name)
+
+    def initialize_unordered_bulk_op(self):
+        """Returns a LocalBulkOperation for this collection."""
+        return LocalBulkOperation(self)
+
+    def aggregate(self, pipeline, **kwargs):
+        """Runs an aggregation pipeline, and returns a list of the results.
+
+        A $match at the start of the pipeline uses the indexes, as it would
+        on a server.
+        """
+        stages = list(pipeline)
+        if stages and '$match' in stages[0]:
+            documents = self._select(stages.pop(0)['$match'])
+        else:
+            documents = self._select({})
+        for stage in stages:
+            documents = _run_stage(stage, documents)
+        return list(documents)
+
+    def _create(self):
+        """Makes sure the collection's table exists, and finds its indexed
+        fields.
+        """
+        with self._lock:
+            with self._connection:
+                self._connection.execute(
+                    'CREATE TABLE IF NOT EXISTS %s (_id PRIMARY KEY, doc BLOB)'
+                    % self._table)
+            self._indexes = set()
+            self._fields = [str(row[1])[2:] for row in self._connection.execute(
+                                'PRAGMA table_info(%s)' % self._table)
+                            if str(row[1]).startswith('i_')]
+
+    def _add_field(self, field):
+        """Adds a column for an indexed field, and fills it in."""
+        self._connection.execute('ALTER TABLE %s ADD COLUMN %s' %
+                                 (self._table, _column(field)))
+        self._fields.append(field)
+        rows = self._connection.execute('SELECT _id, doc FROM ' + self._table)
+        self._connection.executemany(
+            'UPDATE %s SET %s = ? WHERE _id = ?' % (self._table, _column(field)),
+            [(_sql_value(_get(cPickle.loads(str(doc)), field)), document_id)
+             for document_id, doc in rows.fetchall()])
+
+    def _insert_sql(self, verb):
+        """Returns the statement for writing a row (see _row)."""
+        columns = ['_id', 'doc'] + [_column(field) for field in self._fields]
+        return '%s INTO %s (%s) VALUES (%s)' % \
+            (verb, self._table, ', '.join(columns),
+             ', '.join('?' * len(columns)))
+
+    def _row(self, document):
+        """Returns the values a document is stored as."""
+        return ([document['_id'],
+                 sqlite3.Binary(cPickle.dumps(document, 2))] +
+                [_sql_value(_get(document, field)) for field in self._fields])
+
+    def _select(self, query):
+        """Generates every document matching query.
+
+        Conditions on _id and indexed fields are handed to SQLite (see
+        _statements).
+        """
+        query = _prepare_query(query)
+        for sql, parameters in self._statements(query):
+            with self._lock:
+                rows = self._connection.execute(sql, parameters).fetchall()
+            for row in rows:
+                document = cPickle.loads(str(row[0]))
+                if _matches(document, query):
+                    yield document
+
+    def _explain(self, query):
+        """Returns how a query is answered, laid out like a MongoDB server's
+        explain: the index SQLite searches (or a COLLSCAN if there isn't one),
+        and how many documents were read and returned.
+        """
+        indexes = dict((sql_name, _mongo_index_name(key))
+                       for sql_name, key, unique in self._index_list())
+        names = set()
+        examined = returned = 0
+        query = _prepare_query(query)
+        for sql, parameters in self._statements(query):
+            with self._lock:
+                plan = self._connection.execute('EXPLAIN QUERY PLAN ' + sql,
+                                                parameters).fetchall()
+                rows = self._connection.execute(sql, parameters).fetchall()
+            for step in plan:
+                found = re.search(r'USING (?:COVERING )?INDEX "?([^" ]+)"?',
+                                  str(step[-1]))
+                if found:
+                    names.add(indexes.get(found.group(1), found.group(1)))
+                elif 'PRIMARY KEY' in str(step[-1]):
+                    names.add('_id_')
+            examined += len(rows)
+            returned += sum(1 for row in rows
+                            if _matches(cPickle.loads(str(row[0])), query))
+        if names:
+            plan = { 'stage': 'FETCH',
+                     'inputStage': { 'stage': 'IXSCAN',
+                                     'indexName': ', '.join(sorted(names)) } }
+        else:
+            plan = { 'stage': 'COLLSCAN' }
+        return { 'queryPlanner': { 'winningPlan': plan },
+                 'executionStats': { 'nReturned': returned,
+                                     'totalKeysExamined':
+                                         examined if names else 0,
+                                     'totalDocsExamined': examined } }
+
+    def _statements(self, query):
+        """Returns the SQL statements (and their parameters) which pick out
+        the rows that might match query, from its conditions on _id and
+        indexed fields. A long $in list is split up over several statements,
+        to keep SQLite happy.
+        """
+        statements = []
+        clauses = []
+        parameters = []
+        in_column = None
+        in_values = [None]
+        for field, condition in query.iteritems():
+            if field != '_id' and field not in self._fields:
+                continue
+            column = _column(field)
+            if not _is_operator(condition):
+                if _sql_value(condition) is not None:
+                    clauses.append(column + ' = ?')
+                    parameters.append(_sql_value(condition))
+                continue
+            for operator, value in condition.iteritems():
+                if operator in _sql_comparisons and \
+                   _sql_value(value) is not None:
+                    clauses.append('%s %s ?' %
+                                   (column, _sql_comparisons[operator]))
+                    parameters.append(_sql_value(value))
+                elif operator == '$in' and in_column is None and \
+                     all(_sql_value(item) is not None for item in value):
+                    in_column = column
+                    in_values = sorted(set(_sql_value(item) for item in value))
+
+        starts = range(0, len(in_values), _max_parameters) \
+                 if in_column is not None else [0]
+        for start in starts:
+            chunk = in_values[start:start + _max_parameters] \
+                    if in_column is not None else []
+            chunk_clauses = list(clauses)
+            if in_column is not None:
+                chunk_clauses.append('%s IN (%s)' %
+                                     (in_column, ', '.join('?' * len(chunk))))
+            sql = 'SELECT doc FROM ' + self._table
+            if chunk_clauses:
+                sql += ' WHERE ' + ' AND '.join(chunk_clauses)
+            statements.append((sql, parameters + chunk))
+        return statements
+
+    def _index_name(self, fields):
+        """Returns what SQLite calls the index on some fields."""
+        return self.name + '__' + '_'.join(fields)
+
+    def _index_list(self):
+        """Returns the name, (field, direction) pairs and uniqueness of each
+        index SQLite has on the collection, apart from the one on _id.
+        """
+        indexes = []
+        with self._lock:
+            for row in self._connection.execute('PRAGMA index_list(%s)' %
+                                                self._table).fetchall():
+                name = str(row[1])
+                if name.startswith('sqlite_autoindex'):
+                    continue
+                columns = [str(column[2]) for column in
+                           self._connection.execute('PRAGMA index_info(%s)' %
+                                                    _quote(name))]
+                indexes.append((name, [(column[2:], 1) for column in columns],
+                                bool(row[2])))
+        return indexes
+
+class LocalCursor():
+    """The results of a LocalCollection.find, which can be sorted and limited
+    before being iterated over, like a pymongo cursor.
+
+    Public methods:
+    - sort(key_or_list, direction) -- orders the results.
+    - limit(count) -- stops after count results.
+    - count() -- the number of results.
+    - explain() -- how the query is answered (see LocalCollection._explain).
+    """
+
+    def __init__(self, collection, query, projection):
+        """Constructor. Use LocalCollection.find rather than calling this."""
+        self._collection = collection
+        self._query = query
+        self._projection = projection
+        self._sort = []
+        self._limit = 0
+
+    def sort(self, key_or_list, direction = 1):
+        """Orders the results by a field, or a list of (field, direction)
+        pairs.
+        """
+        if isinstance(key_or_list, basestring):
+            self._sort = [(key_or_list, direction)]
+        else:
+            self._sort = list(key_or_list)
+        return self
+
+    def limit(self, count):
+        """Returns at most count results (0 means no limit)."""
+        self._limit = count
+        return self
+
+    def count(self):
+        """Returns the number of matching documents."""
+        return sum(1 for document in self._collection._select(self._query))
+
+    def explain(self):
+        """Returns how the query is answered: the index used, and how many
+        documents were read, as a MongoDB server would describe it.
+        """
+        return self._collection._explain(self._query)
+
+    def __iter__(self):
+        """Generates the results."""
+        documents = self._collection._select(self._query)
+        if self._sort:
+            documents = _sorted(documents, self._sort)
+        for number, document in enumerate(documents):
+            if self._limit and number >= self._limit:
+                break
+            yield _project(document, self._projection)
+
+class LocalBulkOperation():
+    """A batch of writes to a LocalCollection, all done in one transaction.
+
+    Public methods:
+    - insert(document) -- queues an insert.
+    - find(query) -- picks the documents for a remove or replace, e.g.
+      find(query).upsert().replace_one(document).
+    - execute() -- does everything queued, and returns a summary like
+      pymongo's. Raises BulkWriteError if there were duplicates.
+    """
+
+    def __init__(self, collection):
+        """Constructor. Use LocalCollection.initialize_unordered_bulk_op."""
+        self._collection = collection
+        self._operations = []
+
+    def insert(self, document):
+        """Queues an insert."""
+        self._operations.append(('insert', document, None, False))
+
+    def find(self, query):
+        """Returns a selector for a remove or replace."""
+        return _BulkSelector(self, query)
+
+    def execute(self):
+        """Carries out the queued operations."""
+        collection = self._collection
+        connection = collection._connection
+        result = { 'nInserted': 0, 'nUpserted': 0, 'nMatched': 0,
+                   'nModified': 0, 'nRemoved': 0, 'writeErrors': [] }
+        with collection._lock:
+            with connection:
+                inserts = [(index, document) for index, (operation, document,
+                                                         query, upsert)
+                           in enumerate(self._operations)
+                           if operation == 'insert']
+                self._insert_all(inserts, result)
+                for index, (operation, document, query, upsert) in \
+                        enumerate(self._operations):
+                    if operation == 'remove_one':
+                        old = collection.find_one(query, { '_id': 1 })
+                        if old is not None:
+                            connection.execute('DELETE FROM %s WHERE _id = ?' %
+                                               collection._table, [old['_id']])
+                            result['nRemoved'] += 1
+                    elif operation == 'replace_one':
+                        old = collection.find_one(query, { '_id': 1 })
+                        if old is None and not upsert:
+                            continue
+                        new = dict(document)
+                        if old is not None:
+                            new['_id'] = old['_id']
+                            result['nMatched'] += 1
+                            result['nModified'] += 1
+                        else:
+                            new.setdefault('_id', query.get('_id',
+                                                            uuid.uuid4().hex))
+                            result['nUpserted'] += 1
+                        connection.execute(
+                            collection._insert_sql('INSERT OR REPLACE'),
+                            collection._row(new))
+        self._operations = []
+        if result['writeErrors']:
+            raise errors.BulkWriteError(result)
+        return result
+
+    def _insert_all(self, inserts, result):
+        """Does all the inserts in one go, or one at a time if there are any
+        duplicates among them.
+        """
+        collection = self._collection
+        connection = collection._connection
+        for index, document in inserts:
+            document.setdefault('_id', uuid.uuid4().hex)
+        rows = [collection._row(document) for index, document in inserts]
+        try:
+            connection.executemany(collection._insert_sql('INSERT'), rows)
+            result['nInserted'] += len(rows)
+            return
+        except sqlite3.IntegrityError:
+            # The inserts come first, so there's nothing else to undo
+            connection.rollback()
+        for (index, document), row in zip(inserts, rows):
+            try:
+                connection.execute(collection._insert_sql('INSERT'), row)
+                result['nInserted'] += 1
+            except sqlite3.IntegrityError as e:
+                result['writeErrors'].append({ 'index': index, 'code': 11000,
+                                               'errmsg': str(e),
+                                               'op': document })
+
+class _BulkSelector():
+    """The documents picked out by LocalBulkOperation.find."""
+
+    def __init__(self, bulk, query):
+        self._bulk = bulk
+        self._query = query
+        self._upsert = False
+
+    def upsert(self):
+        """Makes the following replace_one insert if nothing matches."""
+        self._upsert = True
+        return self
+
+    def remove_one(self):
+        """Queues the removal of the first matching document."""
+        self._bulk._operations.append(('remove_one', None, self._query, False))
+
+    def replace_one(self, document):
+        """Queues the replacement of the first matching document."""
+        self._bulk._operations.append(('replace_one', document, self._query,
+                                       self._upsert))
+
+# Query operators SQLite can deal with directly.
+_sql_comparisons = { '$gt': '>', '$gte': '>=', '$lt': '<', '$lte': '<=' }
+
+def _quote(name):
+    """Quotes a table or column name."""
+    return '"%s"' % name.replace('"', '""')
+
+def _column(field):
+    """Returns the column an indexed field is kept in."""
+    if field == '_id':
+        return '_id'
+    return _quote('i_' + field)
+
+def _index_fields(key_or_list):
+    """Returns the fields of an index, given as a field or a list of (field,
+    direction) pairs.
+    """
+    if isinstance(key_or_list, basestring):
+        return [key_or_list]
+    return [field for field, direction in key_or_list]
+
+def _mongo_index_name(key):
+    """Returns what MongoDB would call an index, e.g. 'date_1_district_1'."""
+    return '_'.join('%s_%s' % (field, direction) for field, direction in key)
+
+def _sql_value(value):
+    """Converts a value to something SQLite can compare in the same order,
+    or None if it can't.
+    """
+    if hasattr(value, 'isoformat'):
+        # ISO dates sort the same as the dates themselves
+        return value.isoformat()
+    if isinstance(value, (basestring, int, long, float)):
+        return value
+    return None
+
+def _get(document, field):
+    """Returns a (possibly dotted) field of a document, or _missing."""
+    for part in field.split('.'):
+        if not isinstance(document, dict) or part not in document:
+            return _missing
+        document = document[part]
+    return document
+
+def _is_operator(condition):
+    """Checks whether a query condition is made of operators, like
+    { '$gt': 3 }, rather than being a plain value.
+    """
+    return isinstance(condition, dict) and bool(condition) and \
+        all(key.startswith('$') for key in condition)
+
+def _prepare_query(query):
+    """Returns a copy of a query with its $in and $nin lists turned into sets
+    (where their values allow it), so that checking each document against a
+    long list doesn't mean going through the whole list.
+    """
+    prepared = {}
+    for field, condition in query.iteritems():
+        if field in ('$or', '$and'):
+            condition = [_prepare_query(part) for part in condition]
+        elif _is_operator(condition):
+            condition = dict(condition)
+            for operator in ('$in', '$nin'):
+                if operator in condition:
+                    try:
+                        condition[operator] = frozenset(condition[operator])
+                    except TypeError:
+                        pass
+        prepared[field] = condition
+    return prepared
+
+def _matches(document, query):
+    """Checks whether a document matches a query."""
+    for field, condition in query.iteritems():
+        if field == '$or':
+            if not any(_matches(document, part) for part in condition):
+                return False
+            continue
+        if field == '$and':
+            if not all(_matches(document, part) for part in condition):
+                return False
+            continue
+        value = _get(document, field)
+        if _is_operator(condition):
+            for operator, argument in condition.iteritems():
+                if not _compare(value, operator, argument):
+                    return False
+        elif not _compare(value, '$eq', condition):
+            return False
+    return True
+
+def _compare(value, operator, argument):
+    """Checks a single operator (e.g. '$gt') against a value."""
+    if operator == '$exists':
+        return (value is not _missing) == bool(argument)
+    if operator == '$ne':
+        return not _compare(value, '$eq', argument)
+    if operator == '$nin':
+        return not _compare(value, '$in', argument)
+    if value is _missing:
+        return operator == '$eq' and argument is None
+    if isinstance(value, list) and operator != '$eq':
+        return any(_compare(item, operator, argument) for item in value)
+    if operator == '$eq':
+        if isinstance(value, list) and not isinstance(argument, list):
+            return argument in value
+        return value == argument
+    if operator == '$in':
+        try:
+            return value in argument
+        except TypeError:
+            # An unhashable value can't be in a set of hashable ones
+            return False
+    if operator == '$gt':
+        return value > argument
+    if operator == '$gte':
+        return value >= argument
+    if operator == '$lt':
+        return value < argument
+    if operator == '$lte':
+        return value <= argument
+    if operator == '$regex':
+        return isinstance(value, basestring) and \
+            re.search(argument, value) is not None
+    raise ValueError('Unsupported query operator: ' + operator)
+
+def _apply_update(document, update):
+    """Returns a copy of a document with an update applied to it."""
+    if not any(key.startswith('$') for key in update):
+        new = dict(update)
+        if '_id' in document:
+            new['_id'] = document['_id']
+        return new
+    new = dict(document)
+    for operator, fields in update.iteritems():
+        for field, value in fields.iteritems():
+            if operator == '$set':
+                new[field] = value
+            elif operator == '$inc':
+                new[field] = new.get(field, 0) + value
+            elif operator == '$unset':
+                new.pop(field, None)
+            else:
+                raise ValueError('Unsupported update operator: ' + operator)
+    return new
+
+def _project(document, projection):
+    """Returns just the fields of a document asked for by a projection."""
+    if not projection:
+        return document
+    included = [field for field, wanted in projection.iteritems() if wanted]
+    if not included:
+        return dict((field, value) for field, value in document.iteritems()
+                    if field not in projection)
+    projected = dict((field, document[field]) for field in included
+                     if field in document)
+    if projection.get('_id', 1) and '_id' in document:
+        projected['_id'] = document['_id']
+    return projected
+
+def _sorted(documents, keys):
+    """Sorts documents by a list of (field, direction) pairs."""
+    documents = list(documents)
+    for field, direction in reversed(keys):
+        documents.sort(key = lambda document: _sort_key(_get(document, field)),
+                       reverse = direction < 0)
+    return documents
+
+def _sort_key(value):
+    """Puts missing values first, as MongoDB does."""
+    if value is _missing or value is None:
+        return (0, None)
+    return (1, value)
+
+def _run_stage(stage, documents):
+    """Runs one aggregation pipeline stage over some documents."""
+    operator, argument = stage.items()[0]
+    if operator == '$match':
+        return (document for document in documents
+                if _matches(document, argument))
+    if operator == '$project':
+        return (_project_stage(document, argument) for document in documents)
+    if operator == '$group':
+        return _group(documents, argument)
+    if operator == '$sort':
+        return _sorted(documents, argument.items())
+    if operator == '$skip':
+        return list(documents)[argument:]
+    if operator == '$limit':
+        return list(documents)[:argument]
+    raise ValueError('Unsupported aggregation stage: ' + operator)
+
+def _project_stage(document, projection):
+    """Runs a $project over a document."""
+    projected = {}
+    if projection.get('_id', 1) not in (0, False):
+        projected['_id'] = document.get('_id')
+    for field, expression in projection.iteritems():
+        if field == '_id' and expression in (0, False, 1, True):
+            continue
+        if expression in (1, True):
+            value = _get(document, field)
+            if value is not _missing:
+                projected[field] = value
+        elif expression not in (0, False):
+            projected[field] = _evaluate(expression, document)
+    return projected
+
+# Aggregation expression operators, working on a list of evaluated arguments.
+_expression_operators = {
+    '$year': lambda date: date.year,
+    '$month': lambda date: date.month,
+    '$dayOfMonth': lambda date: date.day,
+    '$ceil': lambda number: float(math.ceil(number)),
+    '$floor': lambda number: float(math.floor(number)),
+    '$ln': math.log,
+    '$log10': math.log10,
+    '$divide': lambda dividend, divisor: float(dividend) / divisor,
+    '$multiply': lambda *numbers: reduce(lambda a, b: a * b, numbers, 1),
+    '$add': lambda *numbers: sum(numbers),
+    '$subtract': lambda first, second: first - second,
+    '$substr': lambda string, start, length:
+                   string[start:] if length < 0 else
+                   string[start:start + length],
+    '$toUpper': lambda string: string.upper(),
+    '$toLower': lambda string: string.lower(),
+    '$concat': lambda *strings: ''.join(strings),
+}
+
+def _evaluate(expression, document):
+    """Evaluates an aggregation expression against a document."""
+    if isinstance(expression, basestring) and expression.startswith('$'):
+        value = _get(document, expression[1:])
+        return None if value is _missing else value
+    if isinstance(expression, list):
+        return [_evaluate(item, document) for item in expression]
+    if not isinstance(expression, dict):
+        return expression
+    if len(expression) == 1 and expression.keys()[0].startswith('$'):
+        operator, arguments = expression.items()[0]
+        if operator not in _expression_operators:
+            raise ValueError('Unsupported expression operator: ' + operator)
+        if not isinstance(arguments, list):
+            arguments = [arguments]
+        arguments = [_evaluate(argument, document) for argument in arguments]
+        if any(argument is None for argument in arguments):
+            return None
+        return _expression_operators[operator](*arguments)
+    return dict((field, _evaluate(value, document))
+                for field, value in expression.iteritems())
+
+def _group(documents, specification):
+    """Runs a $group over some documents."""
+    groups = {}
+    for document in documents:
+        group_id = _evaluate(specification['_id'], document)
+        key = _hashable(group_id)
+        if key not in groups:
+            groups[key] = { '_id': group_id }
+            for field, accumulator in specification.iteritems():
+                if field != '_id':
+                    groups[key][field] = _Accumulator(accumulator)
+        for field, accumulator in groups[key].iteritems():
+            if field != '_id':
+                accumulator.add(document)
+    for group in groups.itervalues():
+        yield dict((field, value if field == '_id' else value.result())
+                   for field, value in group.iteritems())
+
+def _hashable(value):
+    """Turns a group _id into something that can be a dictionary key."""
+    if isinstance(value, dict):
+        return tuple(sorted((field, _hashable(item))
+                            for field, item in value.iteritems()))
+    if isinstance(value, list):
+        return tuple(_hashable(item) for item in value)
+    return value
+
+class _Accumulator():
+    """One $group accumulator, e.g. { '$sum': 1 }, worked out as documents
+    come in so that counting doesn't need a list of every document.
+    """
+
+    def __init__(self, specification):
+        (self._operator, self._expression), = specification.items()
+        if self._operator not in ('$sum', '$avg', '$min', '$max', '$push',
+                                  '$addToSet', '$first', '$last'):
+            raise ValueError('Unsupported accumulator: ' + self._operator)
+        self._total = 0
+        self._count = 0
+        self._value = None
+        self._values = []
+
+    def add(self, document):
+        value = _evaluate(self._expression, document)
+        if value is None:
+            return
+        operator = self._operator
+        if operator in ('$sum', '$avg'):
+            if isinstance(value, (int, long, float)):
+                self._total += value
+                self._count += 1
+        elif operator in ('$push', '$addToSet'):
+            self._values.append(value)
+        elif self._count == 0 or operator == '$last' or \
+             (operator == '$min' and value < self._value) or \
+             (operator == '$max' and value > self._value):
+            self._value = value
+            self._count += 1
+
+    def result(self):
+        if self._operator == '$sum':
+            return self._total
+        if self._operator == '$avg':
+            return float(self._total) / self._count if self._count else None
+        if self._operator == '$push':
+            return self._values
+        if self._operator == '$addToSet':
+            return list(set(self._values))
+        return self._value
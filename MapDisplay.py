@@ -18,22 +18,88 @@
     along with price_picture.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import cPickle
+import hashlib
+import os
 import os.path
+import shutil
+import subprocess
+import tempfile
+from cStringIO import StringIO
 from collections import namedtuple
+from multiprocessing import Pool
+from sys import argv
 
 import matplotlib.pyplot as plotter
+import numpy as np
+from matplotlib import rcParams
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.colors import LinearSegmentedColormap
 from matplotlib.colorbar import ColorbarBase
-from matplotlib.animation import FuncAnimation
-from mpl_toolkits.basemap import Basemap
-from pymongo import MongoClient
+from matplotlib.figure import Figure
+from pymongo.errors import OperationFailure
 
 import db_schemas as schemas
-from PriceYear import PriceYear
-
+import instrumentation
+from AggregateCache import AggregateCache
+from MapGeometry import MapGeometry
+from PriceLoader import PriceLoader
+from PriceMatrix import PriceMatrix, normalize_pct_increase
+from SharedAggregates import SharedAggregates
+from SpatialIndex import SpatialIndex
+from district_locator import locate_districts
+
+# Only used (if it's there) the first time the map geometry is cached
 pickle_filename = 'highresmap.pickle'
 
+highres_map_options = dict(llcrnrlat = 51.462371, llcrnrlon = -1.726692,
+                           urcrnrlat = 52.187215, urcrnrlon = -0.836800,
+                           resolution = 'f', projection = 'tmerc',
+                           lat_0 = 51.874893, lon_0 = -1.281746,
+                           area_thresh = 1)
+
+# Where everything goes in the figure
+figure_size = (10, 12)
+colorbar_position = [0.85, 0.04, 0.03, 0.92]
+map_position = [0.0, 0.0, 0.82, 1.0]
+
+# How far past the edges of the view we look for markers, as a fraction of its
+# size, so that big markers just outside still poke in
+viewport_margin = 0.05
+
+# What exported frames are called
+frame_filename = 'frame_%04d.png'
+
+# What the markers can show. The medians and means are loaded together (along
+# with the counts, which always come too), so switching between these doesn't
+# go back to the DB.
+display_metrics = ('pct_increase', 'change', 'median', 'mean', 'count')
+loaded_metrics = ('median', 'mean')
+
+# What each metric is called, and its color scale: the values at each tick,
+# their labels, and where they go on the scale. Without positions the ticks
+# are spread out evenly on a log scale. Percentage increases have their own
+# scale (see _normalize_pct_increase).
+metric_titles = { 'pct_increase': 'Percent increase in median house price',
+                  'change': 'Change in median house price',
+                  'median': 'Median house price',
+                  'mean': 'Mean house price',
+                  'count': 'Number of house sales' }
+metric_scales = {
+    'pct_increase': (None,
+                     ['-100%', '0%', '250%', '500%', '750%', '>1000%'],
+                     [0, .2, .4, .6, .8, 1.0]),
+    'change': ([-100000, 0, 100000, 200000, 300000, 400000, 500000],
+               [u'<-\xa3100k', u'\xa30', u'+\xa3100k', u'+\xa3200k',
+                u'+\xa3300k', u'+\xa3400k', u'>+\xa3500k'],
+               [0, .2, .36, .52, .68, .84, 1.0]),
+    'median': ([20000, 50000, 100000, 200000, 500000, 1000000, 2000000],
+               [u'<\xa320k', u'\xa350k', u'\xa3100k', u'\xa3200k',
+                u'\xa3500k', u'\xa31m', u'>\xa32m'], None),
+    'mean': ([20000, 50000, 100000, 200000, 500000, 1000000, 2000000],
+             [u'<\xa320k', u'\xa350k', u'\xa3100k', u'\xa3200k',
+              u'\xa3500k', u'\xa31m', u'>\xa32m'], None),
+    'count': ([1, 10, 100, 1000], ['1', '10', '100', '>1000'], None) }
+
 class MapDisplay():
     """Collect historical data and animate the results.
 
@@ -41,24 +107,41 @@ class MapDisplay():
     range, renders a map, and animates the difference from one PriceYear to the
     next.
 
-    At the moment we've only got data for Oxfordshire, and the only supported
-    animation is of the percentage difference in median price between a given year
-    and 1996.
+    At the moment we've only got data for Oxfordshire. The markers show the
+    percentage difference in median price between a given year and 1996 to
+    begin with, and can be switched to any of the display_metrics.
 
     Before this class can be used it's necessary to assemble the price data and
     bung it in a MongoDB instance. See the import_* and coarsify_* modules.
 
     Public methods:
-    - __init__(startyear, endyear) -- assembles our data.
-    - display_median_price_information() -- animates everything.
+    - __init__(startyear, endyear, database, themap, months, metric,
+      shared) -- assembles our data.
+    - display_median_price_information() -- animates everything. Press 'm'
+      to switch to the next metric.
+    - export_median_price_animation(output) -- renders everything without a
+      window, to a set of PNGs, a GIF or a video.
+    - render_frame(year, width, height) -- renders one frame without a
+      window, as PNG data.
+    - prefix_at(lon, lat) -- the postcode prefix nearest some GPS
+      coordinates.
+    - price_year(year) -- the PriceYear for a year (or month).
+    - set_metric(metric) -- switches what the markers show.
 
     Public variables:
+    - region -- the postcode area we're displaying.
     - landmarks -- city names mapped to GPS coordinates.
-    - themap -- the Basemap used to generate the rivers and coordinate mappings.
+    - themap -- the MapGeometry used to draw the rivers and map coordinates.
     - startyear, endyear -- the range of the data we're looking at.
-    - price_data -- all the PriceYear data used in the animation.
+    - months -- None for a frame per year, or the number of months each
+      monthly frame's medians cover.
+    - metric -- what the markers show, one of display_metrics.
+    - price_matrix -- the PriceMatrix the frames are drawn from. Each year
+      is filled in once it's been loaded.
     """
 
+    region = 'OX'
+
     # These have the lat-lon reversed from the way Basemap wants them because of
     # copy-paste from Google Maps. =) 
     landmarks = { 'Oxford': ( 51.7504163, -1.2475879 ),
@@ -92,114 +175,640 @@ class MapDisplay():
                                (0.2, 0.5, 0.5),
                                (1.0, 0.9, 0.0)] } 
                     
-    def __init__(self, startyear, endyear):
+    def __init__(self, startyear, endyear, database = None, themap = None,
+                 months = None, metric = 'pct_increase', shared = False):
         """Constructor.
 
         Inputs are a startyear and an endyear, which must both exist in the
         price information DB.
 
-        An additional requirement is an active local MongoDB instance, which
-        we'll use to pull price data and postcode data out of.
-
-        A full-resolution Basemap instance is used so that we can get pretty
-        rivers. This is quick to load once it's been pickled (see the functions
-        at the end of the module), but if the map doesn't exist there will be a
-        one-time delay while it's built.
+        Price data and postcode data are pulled out of database, which
+        defaults to whatever db_schemas.connect() gives us (a local MongoDB
+        instance, unless told otherwise).
+
+        A full-resolution Basemap is used so that we can get pretty rivers.
+        Only the rivers and the projection are kept, in a MapGeometry, which
+        is quick to load (see the functions at the end of the module), but if
+        they haven't been cached yet there will be a one-time delay while
+        they're built. A different MapGeometry can be passed in as themap.
+
+        Normally there's a frame for each year. If months is given there's a
+        frame for each month instead, showing the medians over that many
+        months up to it: 1 for each month on its own, or 12 for a rolling
+        year. Monthly medians aren't cached, but only take one pass over the
+        DB.
+
+        Years are loaded in the background, a few at a time (see
+        PriceLoader), and the animation starts as soon as the first one is
+        ready rather than waiting for them all.
+
+        metric is what the markers show to begin with (see set_metric).
+
+        With shared, the postcode positions and the whole price matrix are
+        kept in a segment of shared memory (see SharedAggregates.py), so that
+        every MapDisplay on this machine for the same years and map uses the
+        one copy. The first builds it, loading every year up front, and the
+        rest just map it, which is almost instant and costs next to no
+        memory. It's built again whenever sales or postcodes are imported.
         """
-        if (not os.path.isfile(pickle_filename)):
-            print 'No pickled map found! Creating one.'
-            prepare_highres_data()
-        self.themap = cPickle.load(open(pickle_filename, 'rb'))
+        if metric not in display_metrics:
+            raise ValueError('Unknown metric: %s' % metric)
+        with instrumentation.span('map_geometry'):
+            if themap is None:
+                themap = get_highres_geometry()
+            self.themap = themap
         self.startyear = startyear
         self.endyear = endyear
-
-        client = MongoClient() # May crash if the DB server isn't running
-        db = client[schemas.db_name]
-        self._load_postcodes(db[schemas.postcode_collection_name])
-        self._prepare_price_data(startyear,
-                                 endyear,
-                                 db[schemas.prices_collection_name])
+        self.months = months
+        self.metric = metric
         self._colormap = LinearSegmentedColormap('price_colors',
                                                 MapDisplay._color_scale)
+        self._markers = None
+        self._loader = None
+        self._year_label = None
+        self._colorbar_axis = None
+        self._background = None
+        self._background_size = None
+
+        db = database if database is not None else schemas.connect()
+        cache = AggregateCache(db[schemas.aggregate_cache_collection_name],
+                               db[schemas.watermark_collection_name])
+        segment = None
+        if shared:
+            segment_name = self._segment_name(db)
+            stamp = self._segment_stamp(db, cache)
+            with instrumentation.span('attach_shared'):
+                segment = SharedAggregates.attach(segment_name, stamp)
+        if segment is not None:
+            self._attach_shared(segment)
+        else:
+            self._build(db, cache)
+        with instrumentation.span('prepare_markers') as span:
+            self._prepare_markers()
+            span.set(rows = len(self._marker_rows))
+        if shared and segment is None and hasattr(self, 'price_matrix'):
+            with instrumentation.span('publish_shared'):
+                self._publish_shared(segment_name, stamp)
+
+    def _build(self, db, cache):
+        """Loads the postcodes and sets up the price data from the DB."""
+        with instrumentation.span('load_postcodes') as span:
+            self._load_postcodes(db[schemas.postcode_collection_name])
+            span.set(rows = len(self.postcodes))
+        prices = schemas.prices_collection_for(db, MapDisplay.region)
+        with instrumentation.span('prepare_price_data',
+                                  startyear = self.startyear,
+                                  endyear = self.endyear):
+            self._prepare_price_data(self.startyear, self.endyear, prices,
+                                     cache)
+        with instrumentation.span('locate_districts') as span:
+            located = self._locate_unknown_prefixes(
+                db[schemas.input_postcode_collection_name], prices)
+            span.set(rows = located)
+
+    def price_year(self, year):
+        """Returns the PriceYear for a year (or, with months, a month named
+        'YYYY-MM'), compared with the first. Waits for it if it hasn't been
+        loaded yet.
+        """
+        col = self.price_matrix.column(year)
+        self._load_column(col)
+        return self.price_matrix.price_year(year, self.price_matrix.years[0])
+
+    def set_metric(self, metric):
+        """Switches the markers to show a different metric, one of
+        display_metrics.
+
+        Everything we need was loaded along with the medians, so only the
+        marker sizes and colors (and the colorbar, if it's been drawn) are
+        worked out again.
+        """
+        if metric not in display_metrics:
+            raise ValueError('Unknown metric: %s' % metric)
+        self.metric = metric
+        self._prepare_columns(np.flatnonzero(self._loaded))
+        if self._colorbar_axis is not None:
+            self._colorbar_axis.clear()
+            self._draw_colorbar(self._colorbar_axis)
+            self._colorbar_axis.figure.canvas.set_window_title(
+                self._window_title())
+            # The colorbar is part of the cached background
+            self._background = None
+
+    def display_median_price_animation(self, interval = 1000,
+                                       repeat_delay = 3000):
+        """Kicks off the animation of median price information.
+
+        Frames are shown every interval milliseconds, with an extra pause of
+        repeat_delay at the end before starting again.
+
+        Everything that doesn't change (rivers, landmarks, colorbar) is drawn
+        once and cached as an image the size of the window, so each frame only
+        has to draw the markers and the year on top of it. The cached image is
+        thrown away and redrawn whenever the window is resized.
+        """
+        fig = plotter.figure(num = 1, figsize = figure_size, tight_layout = True)
+        fig.canvas.set_window_title(self._window_title())
+
+        # Kept so that set_metric can redraw it
+        self._colorbar_axis = fig.add_axes(colorbar_position)
+        self._draw_colorbar(self._colorbar_axis)
+        fig.add_axes(map_position)
+        self._init_animate()
+        self._background = None
+        self._frame = 0
+        fig.canvas.mpl_connect('draw_event', self._on_draw)
+        fig.canvas.mpl_connect('resize_event', self._on_resize)
+        fig.canvas.mpl_connect('key_press_event', self._on_key_press)
+        # Hang on to the timer, or it'll be garbage collected
+        self._timer = fig.canvas.new_timer(interval = interval)
+        self._timer.add_callback(self._next_frame, fig, interval,
+                                 repeat_delay)
+        self._timer.start()
+        plotter.show()
+
+    def export_median_price_animation(self, output, processes = None,
+                                      interval = 1000, dpi = 100):
+        """Renders the animation of median price information without a window.
+
+        The background (rivers, landmarks and colorbar) is drawn once, and
+        then each year's frame is drawn on top of it by a pool of worker
+        processes, each of which is only sent the markers for its own frames.
+
+        If output ends in .gif the frames are put together with ImageMagick,
+        and if it ends in anything else (e.g. .mp4) with ffmpeg, with interval
+        milliseconds between frames. If output has no extension, it's taken
+        to be a directory, and the frames are left in there as PNGs.
+        processes defaults to the number of CPUs.
+        """
+        with instrumentation.span('render_background'):
+            background, xlim, ylim = self._render_background(dpi)
+        # Everything has to be here, and the loader's threads finished,
+        # before the worker processes are forked
+        for col in range(len(self.price_matrix.years)):
+            self._load_column(col)
+        frames = []
+        for index, year in enumerate(self.price_matrix.years):
+            xy, sizes, colors = self._frame_data(index)
+            frames.append((index, xy, sizes, colors, year))
+
+        assemble = os.path.splitext(output)[1] != ''
+        if assemble:
+            directory = tempfile.mkdtemp()
+        else:
+            directory = output
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+        pool = Pool(processes,
+                    initializer = _init_frame_worker,
+                    initargs = (background, dpi, xlim, ylim, directory))
+        try:
+            for filename, spans in pool.map(_render_frame, frames,
+                                            chunksize = 1):
+                instrumentation.merge(spans)
+        finally:
+            pool.close()
+            pool.join()
+
+        if assemble:
+            try:
+                _assemble_frames(directory, output, interval)
+            finally:
+                shutil.rmtree(directory)
 
-    def display_median_price_animation(self):
-        """Kicks off the animation of median price information."""
-        fig = plotter.figure(num = 1, figsize = (10, 12), tight_layout = True)
-        fig.canvas.set_window_title('Percent increase in median house ' + \
-                                    'price since 1996')
+    def render_frame(self, year, width = 1000, height = 1200, dpi = 100):
+        """Draws the frame for a year (or month), showing the current metric,
+        without a window. Returns it as PNG data, width by height pixels.
 
-        axis = fig.add_axes([0.85, 0.04, 0.03, 0.92])
-        colorbar_ticks = [0, .2, .4, .6, .8, 1.0]
-        colorbar_labels = ['-100%', '0%', '250%', '500%', '750%', '>1000%']
+        Markers are scaled with the width, so they cover as much of the map
+        as they would in the usual window.
+        """
+        col = self.price_matrix.column(year)
+        self._load_column(col)
+        with instrumentation.span('render_frame', year = year) as span:
+            fig = Figure(figsize = (float(width) / dpi, float(height) / dpi),
+                         dpi = dpi)
+            canvas = FigureCanvasAgg(fig)
+            self._draw_colorbar(fig.add_axes(colorbar_position))
+            axes = fig.add_axes(map_position)
+            self._draw_background_data(axes)
+            xy, sizes, colors = self._frame_data(col)
+            scale = float(width) / (figure_size[0] * dpi)
+            axes.scatter(xy[:, 0], xy[:, 1], s = sizes * scale ** 2,
+                         c = colors, edgecolors = 'face')
+            axes.text(500, 500, str(year))
+            output = StringIO()
+            canvas.print_png(output)
+            span.set(rows = len(xy))
+        return output.getvalue()
+
+    def _render_background(self, dpi):
+        """Draws everything that stays the same from frame to frame.
+
+        Returns the image as an array of RGBA pixels, along with the limits
+        of the map's axes.
+        """
+        fig = Figure(figsize = figure_size, dpi = dpi)
+        canvas = FigureCanvasAgg(fig)
+        self._draw_colorbar(fig.add_axes(colorbar_position))
+        axes = fig.add_axes(map_position)
+        self._draw_background_data(axes)
+        canvas.draw()
+        width, height = canvas.get_width_height()
+        image = np.frombuffer(canvas.buffer_rgba(), dtype = np.uint8)
+        return (image.reshape(height, width, 4).copy(), axes.get_xlim(),
+                axes.get_ylim())
+
+    def _draw_colorbar(self, axis):
+        """Draws the color scale for the markers, for the current metric."""
+        values, colorbar_labels, colorbar_ticks = metric_scales[self.metric]
+        if colorbar_ticks is None:
+            colorbar_ticks = np.linspace(0, 1.0, len(values))
         colorbar = ColorbarBase(axis, self._colormap, orientation='vertical')
         colorbar.set_ticks(colorbar_ticks)
         colorbar.set_ticklabels(colorbar_labels)
 
-        fig.add_axes([0.0, 0.0, 0.82, 1.0])
-        anim = FuncAnimation(fig,
-                             self._animate,
-                             frames = self.endyear + 1 - self.startyear,
-                             interval = 1000,
-                             blit = True,
-                             init_func = self._init_animate,
-                             repeat_delay = 3000)
-        plotter.show()
+    def _window_title(self):
+        """Returns the title of the window, for the current metric."""
+        title = metric_titles[self.metric]
+        if self.metric in ('pct_increase', 'change'):
+            title += ' since %s' % self.price_matrix.years[0]
+        return title
 
     def _init_animate(self):
-        """Initializes background drawings for the animation."""
-        return self._draw_background_data()
+        """Initializes background drawings for the animation, and the artists
+        which each frame updates.
+        """
+        return self._draw_background_data() + self._create_frame_artists()
 
     def _animate(self, frame):
         """Draws a single price year as part of the animation."""
-        year_index = frame % (self.endyear + 1 - self.startyear)
-        return self._display_price_year(self.price_data[year_index])
+        return self._display_column(frame % len(self.price_matrix.years))
+
+    def _next_frame(self, fig, interval, repeat_delay):
+        """Timer callback: moves the animation on a frame, and blits it."""
+        with instrumentation.span('next_frame', frame = self._frame) as span:
+            self._animate(self._frame)
+            canvas = fig.canvas
+            if (self._background is None or
+                self._background_size != canvas.get_width_height()):
+                # The draw_event handler will cache the background and blit
+                span.set(redraw = True)
+                canvas.draw()
+            else:
+                canvas.restore_region(self._background)
+                self._draw_frame_artists()
+                canvas.blit(fig.bbox)
+        self._frame += 1
+        if self._frame % len(self.price_matrix.years) == 0:
+            self._timer.interval = interval + repeat_delay
+        else:
+            self._timer.interval = interval
+
+    def prefix_at(self, lon, lat):
+        """Returns the postcode prefix nearest some GPS coordinates, or None
+        if we don't know where any are.
+        """
+        x, y = self.themap(lon, lat)
+        row, distance = self._postcode_index.nearest(x, y)
+        if row is None:
+            return None
+        return self._postcode_names[row]
+
+    def _on_draw(self, event):
+        """Caches the static part of the figure after a full redraw.
+
+        The markers and year are animated artists, so they're left out of
+        normal draws; we add them back on top once the background is saved.
+        """
+        canvas = event.canvas
+        self._background = canvas.copy_from_bbox(canvas.figure.bbox)
+        self._background_size = canvas.get_width_height()
+        self._draw_frame_artists()
+        canvas.blit(canvas.figure.bbox)
+
+    def _on_resize(self, event):
+        """Throws away the cached background, which is the wrong size now."""
+        self._background = None
+
+    def _on_key_press(self, event):
+        """Switches to the next metric when 'm' is pressed."""
+        if event.key == 'm':
+            index = display_metrics.index(self.metric)
+            self.set_metric(display_metrics[(index + 1) %
+                                            len(display_metrics)])
+
+    def _draw_frame_artists(self):
+        """Draws the markers and year on top of whatever's on the canvas."""
+        for artist in (self._markers, self._year_label):
+            artist.axes.draw_artist(artist)
         
     def _load_postcodes(self, collection):
-        """Loads postcode prefixes and their GPS coordinates from the DB."""
+        """Loads the postcode prefixes in our region and their GPS coordinates
+        from the DB, and projects them all onto the map in one go.
+        """
         print "Loading postcode locations."
-        Coordinate = namedtuple('Coordinate', ['lon', 'lat'])
         self.postcodes = {}
-        for entry in collection.find():
-            postcode = entry['_id']
-            lat = entry['value']['lat']
-            lon = entry['value']['long']
-            self.postcodes[postcode] = Coordinate(lon, lat)
-
-    def _prepare_price_data(self, startyear, endyear, collection):
-        """Grabs price data from the DB and assembles our collection of
-        PriceYears.
+        self._postcode_names = []
+        self._postcode_rows = {}
+        self.postcode_x = self.postcode_y = np.zeros(0)
+        self._add_postcodes(
+            dict((entry['_id'], (entry['value']['long'],
+                                 entry['value']['lat']))
+                 for entry in collection.find(
+                     { '_id': { '$regex':
+                                '^' + MapDisplay.region + '[0-9]' } })))
+
+    def _locate_unknown_prefixes(self, unit_collection, prices_collection):
+        """Finds somewhere to put the prefixes we've got prices for but which
+        aren't in the postcode tables (retired districts like OX6), from the
+        full postcodes of their sales. Returns how many were placed.
+        """
+        if not hasattr(self, 'price_matrix'):
+            return 0
+        unknown = [prefix for prefix in self.price_matrix.prefixes
+                   if prefix not in self._postcode_rows]
+        if not unknown:
+            return 0
+        located = locate_districts(unit_collection, prices_collection,
+                                   unknown)
+        self._add_postcodes(dict((prefix, (lon, lat))
+                                 for prefix, (lon, lat, count)
+                                 in located.iteritems()))
+        for prefix in sorted(set(unknown) - set(located)):
+            print "Can't find anywhere to put %s, leaving it out." % prefix
+        return len(located)
+
+    def _add_postcodes(self, coordinates):
+        """Adds some postcode prefixes (a dictionary mapping each to its GPS
+        coordinates as (lon, lat)), projecting them all onto the map in one go.
+        """
+        Coordinate = namedtuple('Coordinate', ['lon', 'lat'])
+        names = sorted(coordinates)
+        for postcode in names:
+            self.postcodes[postcode] = Coordinate(*coordinates[postcode])
+            self._postcode_rows[postcode] = len(self._postcode_names)
+            self._postcode_names.append(postcode)
+        if names:
+            x, y = self.themap(np.array([coordinates[postcode][0]
+                                         for postcode in names]),
+                               np.array([coordinates[postcode][1]
+                                         for postcode in names]))
+            self.postcode_x = np.concatenate((self.postcode_x, x))
+            self.postcode_y = np.concatenate((self.postcode_y, y))
+        self._postcode_index = SpatialIndex(self.postcode_x, self.postcode_y)
+
+    def _segment_name(self, db):
+        """Returns the name of the shared segment for our region, years and
+        map, in this DB.
+        """
+        source = getattr(db, 'path', None)
+        source = os.path.abspath(source) if source else \
+                 getattr(db, 'name', '')
+        key = repr((MapDisplay.region, self.startyear, self.endyear,
+                    self.months, os.path.abspath(self.themap.directory),
+                    source))
+        return 'map_%s_%s' % (MapDisplay.region,
+                              hashlib.sha1(key).hexdigest()[:16])
+
+    def _segment_stamp(self, db, cache):
+        """Returns what a shared segment must have been built from to still
+        be up to date: the watermark of each year's sales, and the number of
+        postcodes.
+        """
+        years = range(self.startyear, self.endyear + 1)
+        return { 'watermarks': dict((str(year), version) for year, version
+                                    in cache.versions(MapDisplay.region,
+                                                      years).iteritems()),
+                 'postcodes':
+                     [db[schemas.postcode_collection_name].count(),
+                      db[schemas.input_postcode_collection_name].count()] }
+
+    def _publish_shared(self, name, stamp):
+        """Loads every year, then puts the postcode positions and the price
+        matrix in a shared segment for other MapDisplays to attach to.
+        """
+        for col in range(len(self.price_matrix.years)):
+            self._load_column(col)
+        matrix = self.price_matrix
+        arrays = { 'postcode_lon': np.array([self.postcodes[postcode].lon
+                                             for postcode
+                                             in self._postcode_names]),
+                   'postcode_lat': np.array([self.postcodes[postcode].lat
+                                             for postcode
+                                             in self._postcode_names]),
+                   'postcode_x': self.postcode_x,
+                   'postcode_y': self.postcode_y,
+                   'medians': matrix.medians,
+                   'counts': matrix.counts }
+        for metric in loaded_metrics:
+            arrays['metric_' + metric] = matrix.metrics[metric]
+        SharedAggregates.publish(name, arrays,
+                                 { 'postcodes': self._postcode_names,
+                                   'prefixes': matrix.prefixes,
+                                   'years': matrix.years },
+                                 stamp)
+
+    def _attach_shared(self, segment):
+        """Takes the postcode positions and the price matrix from a shared
+        segment. The arrays are views of the segment, so they're read-only.
+        """
+        Coordinate = namedtuple('Coordinate', ['lon', 'lat'])
+        arrays = segment.arrays
+        self._postcode_names = [str(name) for name
+                                in segment.lists['postcodes']]
+        self._postcode_rows = dict((postcode, row) for row, postcode
+                                   in enumerate(self._postcode_names))
+        self.postcodes = dict((postcode,
+                               Coordinate(float(arrays['postcode_lon'][row]),
+                                          float(arrays['postcode_lat'][row])))
+                              for row, postcode
+                              in enumerate(self._postcode_names))
+        self.postcode_x = arrays['postcode_x']
+        self.postcode_y = arrays['postcode_y']
+        self._postcode_index = SpatialIndex(self.postcode_x, self.postcode_y)
+        years = [year if isinstance(year, int) else str(year)
+                 for year in segment.lists['years']]
+        self.price_matrix = PriceMatrix(
+            [str(prefix) for prefix in segment.lists['prefixes']], years,
+            arrays['medians'], arrays['counts'],
+            dict((metric, arrays['metric_' + metric])
+                 for metric in loaded_metrics if metric != 'median'))
+        self._loaded = np.ones(len(years), dtype = bool)
+
+    def _prepare_price_data(self, startyear, endyear, collection, cache):
+        """Sets up the PriceMatrix our frames are drawn from.
+
+        Years are loaded in the background by a PriceLoader, which starts on
+        the first few straight away, from the AggregateCache if they've been
+        worked out before and from the DB if not. The PriceMatrix starts out
+        empty, with a row for every prefix in the collection, and each year
+        is filled in when it's first needed (see _load_column).
+
+        Monthly data always comes straight from the DB, and is all worked out
+        here in one pass.
         """
         print "Generating median price data."
         try:
-            self.base_year = PriceYear(startyear, collection)
+            if self.months is None:
+                years = range(startyear, endyear + 1)
+                self._loader = PriceLoader(cache, collection,
+                                           MapDisplay.region, years,
+                                           metrics = loaded_metrics)
+                prefixes = sorted(collection.distinct('district'))
+                self.price_matrix = PriceMatrix.empty(prefixes, years,
+                                                      loaded_metrics)
+                self._loaded = np.zeros(len(years), dtype = bool)
+            else:
+                self.price_matrix = PriceMatrix.from_months(
+                    collection, startyear, endyear, self.months,
+                    metrics = loaded_metrics)
+                self._loaded = np.ones(len(self.price_matrix.years),
+                                       dtype = bool)
         except OperationFailure:
             print "Can't find the prices collection!"
             return
-        self.price_data = [self.base_year]
-        for year in range(startyear + 1, endyear + 1):
-            self.price_data.append(PriceYear(year, collection, self.base_year))
 
-    def _display_price_year(self, priceyear):
-        """Renders data for a single PriceYear.
+    def _load_column(self, col):
+        """Makes sure the year in column col of the price matrix has arrived,
+        along with the first year, which everything is compared with, and
+        works out its markers. Waits for it if need be.
+
+        Asking for a year also keeps the loader working on the few after it,
+        so they're usually ready by the time the animation gets there.
+        """
+        if self._loader is None:
+            return
+        if col != 0 and not self._loaded[0]:
+            self._load_column(0)
+        year = self.price_matrix.years[col]
+        if self._loaded[col]:
+            # Keeps the prefetching going; it's here already
+            self._loader.get(year)
+            return
+        with instrumentation.span('wait_for_year', year = year):
+            values, counts = self._loader.get(year)
+        self.price_matrix.fill_year(year, values, counts)
+        self._loaded[col] = True
+        self._prepare_columns([col])
+        if self._loaded.all():
+            self._loader.close()
+            self._loader = None
+
+    def _prepare_markers(self):
+        """Works out where every marker goes, and its size and color in every
+        year, so that drawing a frame is just a matter of picking a column.
+        """
+        matrix = self.price_matrix
+        # Anything _locate_unknown_prefixes couldn't place is left out
+        located = [row for row, prefix in enumerate(matrix.prefixes)
+                   if prefix in self._postcode_rows]
+        self._marker_rows = np.array(located, dtype = np.intp)
+        locations = np.array([self._postcode_rows[matrix.prefixes[row]]
+                              for row in located], dtype = np.intp)
+        self._marker_xy = np.column_stack((self.postcode_x[locations],
+                                           self.postcode_y[locations]))
+        self._marker_index = SpatialIndex(self._marker_xy[:, 0],
+                                          self._marker_xy[:, 1])
+        columns = len(matrix.years)
+        self._marker_sizes = np.zeros((len(located), columns))
+        self._marker_colors = np.zeros((len(located), columns, 4))
+        self._prepare_columns(np.flatnonzero(self._loaded))
+
+    def _prepare_columns(self, cols):
+        """Works out the size and color of every marker in some columns of
+        the price matrix, once they've been loaded, for the current metric.
+        """
+        cols = np.asarray(cols, dtype = np.intp)
+        if not len(cols):
+            return
+        normalized = self._normalize_metric(cols)
+        # Scatter sizes are areas rather than diameters
+        self._marker_sizes[:, cols] = (70 * normalized + 10) ** 2
+        self._marker_colors[:, cols] = self._colormap(normalized)
+
+    def _normalize_metric(self, cols):
+        """Maps the current metric for every marker in some columns of the
+        price matrix to [0,1], following its scale in metric_scales. Returns
+        an array with a row for each marker and a column for each of cols.
+
+        Only the columns asked for are looked at, all at once: switching
+        metrics works out every loaded column in one go, and a newly loaded
+        year costs a single column.
+        """
+        matrix = self.price_matrix
+        rows = self._marker_rows
+        if self.metric in ('pct_increase', 'change'):
+            medians = matrix.medians[np.ix_(rows, cols)]
+            base = matrix.medians[rows, 0][:, np.newaxis]
+            # As with the PriceYears, the base year has nothing to compare to,
+            # and nor does anywhere without sales in it
+            compared = (base > 0) & (cols != 0)
+        if self.metric == 'pct_increase':
+            ratios = np.zeros(medians.shape)
+            np.divide(medians, base, out = ratios, where = compared)
+            return self._normalize_pct_increase(ratios)
+        values, labels, positions = metric_scales[self.metric]
+        if self.metric == 'change':
+            change = np.where(compared, medians - base, 0)
+            return np.interp(change, values, positions)
+        logs = np.log10(np.maximum(
+            matrix.values(self.metric)[np.ix_(rows, cols)], 1))
+        return np.interp(logs, np.log10([values[0], values[-1]]), [0, 1.0])
+
+    def _frame_data(self, col, viewport = None):
+        """Returns the positions, sizes and colors of the markers for the
+        year in column col of the price matrix.
+
+        If a viewport (xmin, ymin, xmax, ymax, in map coordinates) is given,
+        only the markers in or near it are returned, found with the spatial
+        index, so a small view of a big map is quick to draw.
+        """
+        if viewport is None:
+            markers = np.arange(len(self._marker_rows))
+        else:
+            markers = self._marker_index.within(*viewport)
+        markers = markers[self.price_matrix.counts[self._marker_rows[markers],
+                                                   col] > 0]
+        return (self._marker_xy[markers], self._marker_sizes[markers, col],
+                self._marker_colors[markers, col])
+
+    def _create_frame_artists(self):
+        """Creates the single collection of markers, and the year label, which
+        every frame updates.
+
+        They're animated, so normal draws of the figure leave them out and
+        they can be blitted over the cached background instead.
+        """
+        self._markers = plotter.scatter(np.zeros(0), np.zeros(0),
+                                        edgecolors = 'face', animated = True)
+        self._year_label = plotter.text(500, 500, '', animated = True)
+        return (self._markers, self._year_label)
+
+    def _display_column(self, col):
+        """Renders the data for the year in column col of the price matrix,
+        waiting for it to load if need be.
+
+        Nothing new is drawn: the markers are moved, resized and recolored
+        from the arrays worked out in _prepare_columns.
 
         Returns an iterable of the drawn objects so we can use blit animation.
         """
-        drawn_stuff = []
-        for postcode in priceyear:
-            normalization = self._normalize_pct_increase(postcode.pct_increase)
-            try:
-                lon, lat = self.postcodes[postcode.postcode]
-                # There are a few nonexistant postcodes in the records, e.g. OX6.
-                # I'm guessing these were remapped in the past for whatever reason.
-            except KeyError:
-                continue
-            x, y = self.themap(lon, lat)
-            drawn_stuff += plotter.plot(x,
-                                        y,
-                                        'o',
-                                        color = self._colormap(normalization),
-                                        markersize = 70 * normalization + 10)
-        return tuple(drawn_stuff) + (plotter.text(500, 500, str(priceyear.year)),)
+        if self._markers is None:
+            self._create_frame_artists()
+        self._load_column(col)
+        year = self.price_matrix.years[col]
+        with instrumentation.span('display_price_year', year = year) as span:
+            xy, sizes, colors = self._frame_data(col,
+                                                 _viewport(self._markers.axes))
+            self._markers.set_offsets(xy)
+            self._markers.set_sizes(sizes)
+            self._markers.set_facecolors(colors)
+            self._markers.set_edgecolors(colors)
+            self._year_label.set_text(str(year))
+            span.set(rows = len(xy))
+        return (self._markers, self._year_label)
         
     def _normalize_pct_increase(self, pct_increase):
         """Maps a percentage change to [0,1]
@@ -214,48 +823,119 @@ class MapDisplay():
         These aren't really "percentage increases", but rather "percent of the
         previous median value", so an increase of 20% will be 1.2, and a
         decrease 0.8. 
+
+        This works on whole arrays as well as single values.
         """        
-        if pct_increase > 1:
-            normalized = (pct_increase - 1) * 0.8 / 10 + 0.2
-            if normalized > 1: 
-                normalized = 1.0
-            return normalized
-        else:
-            return (pct_increase - 1) * 0.2 + 0.2
+        return normalize_pct_increase(pct_increase)
         
-    def _draw_background_data(self):
-        """Draws the fixed data in the plot, e.g. landmarks and rivers.
+    def _draw_background_data(self, axes = None):
+        """Draws the fixed data in the plot, e.g. landmarks and rivers, on the
+        given axes (or the current ones).
 
         Returns the drawn items so we can use blit animation.
         """
+        if axes is None:
+            axes = plotter.gca()
         drawn_stuff = []
-        self.themap.drawrivers()
+        self.themap.drawrivers(axes)
 
         for city in MapDisplay.landmarks:
             x, y = self.themap(MapDisplay.landmarks[city][1],
                                MapDisplay.landmarks[city][0])
-            drawn_stuff += self.themap.plot(x, y, 'ko')
-            plotter.text(x + 500, y + 500, city)
+            drawn_stuff += axes.plot(x, y, 'ko')
+            axes.text(x + 500, y + 500, city)
+        self.themap.set_axes_limits(axes)
         return tuple(drawn_stuff)
 
-def prepare_highres_data():
-    """Generated high-resolution data and pickles it.
+def _viewport(axes):
+    """Returns the part of the map the axes show, as (xmin, ymin, xmax, ymax),
+    with viewport_margin added all round.
+    """
+    xmin, xmax = sorted(axes.get_xlim())
+    ymin, ymax = sorted(axes.get_ylim())
+    margin = viewport_margin * max(xmax - xmin, ymax - ymin)
+    return (xmin - margin, ymin - margin, xmax + margin, ymax + margin)
+
+def get_highres_geometry():
+    """Loads the high-resolution map geometry, preparing it first if it
+    hasn't been already.
 
     Highres data takes a long time to prepare but is worth the effort, so
-    we'll pickle it!
+    we'll cache it! If there's a pickled Basemap lying around from an older
+    version, that's used to speed things up.
     """
-    print 'Preparing highres data, give us a few minutes.'
-    themap = get_highres_map()
-    cPickle.dump(themap, open(pickle_filename, 'wb'), -1)
-
-def get_highres_map():
-    """Specifies the format of the high-resolution Basemap."""
-    return Basemap(llcrnrlat = 51.462371, llcrnrlon = -1.726692,
-                   urcrnrlat = 52.187215, urcrnrlon = -0.836800,
-                   resolution = 'f', projection = 'tmerc',
-                   lat_0 = 51.874893, lon_0 = -1.281746, area_thresh = 1)
+    return MapGeometry.for_bounds(basemap_pickle = pickle_filename,
+                                  **highres_map_options)
     
-if __name__ == '__main__':
-    mapDisplay = MapDisplay(1996, 2013)
-    mapDisplay.display_median_price_animation()
+# The background and layout each frame worker draws on, set by
+# _init_frame_worker.
+_frame_worker = {}
+
+def _init_frame_worker(background, dpi, xlim, ylim, directory):
+    """Pool initializer: hands each worker the shared background once."""
+    # Don't hand back the spans we inherited from the parent
+    instrumentation.reset()
+    _frame_worker.update(background = background, dpi = dpi, xlim = xlim,
+                         ylim = ylim, directory = directory)
+
+def _render_frame(args):
+    """Pool worker: draws one frame on top of the background and saves it as
+    a PNG. Returns the file name, and any instrumentation spans recorded
+    here so the parent can keep them.
+    """
+    index, xy, sizes, colors, year = args
+    with instrumentation.span('export_frame', year = year, rows = len(xy)):
+        background = _frame_worker['background']
+        dpi = _frame_worker['dpi']
+        height, width = background.shape[:2]
+        fig = Figure(figsize = (float(width) / dpi, float(height) / dpi),
+                     dpi = dpi)
+        canvas = FigureCanvasAgg(fig)
+        fig.figimage(background, 0, 0, origin = 'upper')
+        axes = fig.add_axes(map_position)
+        axes.set_xlim(_frame_worker['xlim'])
+        axes.set_ylim(_frame_worker['ylim'])
+        axes.set_aspect('equal')
+        axes.set_axis_off()
+        axes.scatter(xy[:, 0], xy[:, 1], s = sizes, c = colors,
+                     edgecolors = 'face')
+        axes.text(500, 500, str(year))
+        filename = os.path.join(_frame_worker['directory'],
+                                frame_filename % index)
+        fig.savefig(filename, dpi = dpi)
+    return filename, instrumentation.collect()
+
+def _assemble_frames(directory, output, interval):
+    """Turns the PNG frames in directory into a GIF (with ImageMagick) or a
+    video (with ffmpeg), depending on the extension of output.
+    """
+    pattern = os.path.join(directory, frame_filename)
+    if output.endswith('.gif'):
+        frames = sorted(os.path.join(directory, filename)
+                        for filename in os.listdir(directory))
+        command = ([rcParams['animation.convert_path'],
+                    '-delay', str(interval / 10), '-loop', '0'] +
+                   frames + [output])
+    else:
+        command = [rcParams['animation.ffmpeg_path'], '-y',
+                   '-framerate', str(1000.0 / interval),
+                   '-i', pattern, '-pix_fmt', 'yuv420p', output]
+    subprocess.check_call(command)
     
+if __name__ == '__main__':
+    options = dict(zip(argv[1::1], argv[2::1]))
+    if '--trace' in options:
+        instrumentation.enable()
+    months = options.get('--months')
+    mapDisplay = MapDisplay(1996, 2013,
+                            months = int(months) if months else None,
+                            metric = options.get('--metric', 'pct_increase'),
+                            shared = '--shared' in argv)
+    try:
+        if '--export' in options:
+            mapDisplay.export_median_price_animation(options['--export'])
+        else:
+            mapDisplay.display_median_price_animation()
+    finally:
+        if '--trace' in options:
+            instrumentation.dump_trace(options['--trace'])
@@ -0,0 +1,225 @@
+#! /usr/bin/python
+
+""" Copyright 2014 Forrest Brennen
+
+    This file is part of price_picture.
+
+    price_picture is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    price_picture is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with price_picture.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import cPickle
+import json
+import os
+import os.path
+
+import matplotlib.pyplot as plotter
+import numpy as np
+from matplotlib.collections import LineCollection
+
+import instrumentation
+
+"""
+MapGeometry.py
+
+All we really need from a full-resolution Basemap is its rivers and its
+coordinate projection, but it takes minutes to build one and a good while to
+unpickle it. Instead, we pull out just those bits once and keep them on disk:
+the rivers as two flat arrays (every point, and where each river starts), and
+the projection as a handful of parameters. The arrays are memory-mapped, so
+nothing is read until something is drawn.
+
+Each bounding box gets its own directory under cache_dir, so other regions can
+be cached alongside Oxfordshire.
+"""
+
+cache_dir = 'map_cache'
+
+def _load_pyproj():
+    """Finds pyproj, which older Basemaps ship their own copy of."""
+    try:
+        import pyproj
+    except ImportError:
+        from mpl_toolkits.basemap import pyproj
+    return pyproj
+
+class MapGeometry():
+    """The parts of a Basemap we actually use, loaded lazily from disk.
+
+    A MapGeometry can be used in place of a Basemap for projecting GPS
+    coordinates and drawing rivers.
+
+    Public methods:
+    - for_bounds(llcrnrlat, llcrnrlon, urcrnrlat, urcrnrlon, ...) -- loads the
+      geometry for a bounding box, building it first if need be.
+    - from_basemap(themap, directory) -- extracts and saves the geometry of
+      an existing Basemap.
+    - __init__(directory) -- loads saved geometry.
+    - __call__(lon, lat) -- projects GPS coordinates to map coordinates.
+    - drawrivers(axes, color, linewidth) -- draws the rivers.
+    - set_axes_limits(axes) -- makes the axes fit the map.
+
+    Public variables:
+    - directory -- where the geometry is stored.
+    - projection -- the projection parameters and the map's extent.
+    """
+
+    def __init__(self, directory):
+        """Constructor.
+
+        Only the (small) projection parameters are read here. The river arrays
+        and the projection itself are set up the first time they're needed.
+        """
+        self.directory = directory
+        with open(os.path.join(directory, 'projection.json')) as params:
+            self.projection = json.load(params)
+        self._proj = None
+        self._river_points = None
+        self._river_starts = None
+
+    @staticmethod
+    def for_bounds(llcrnrlat, llcrnrlon, urcrnrlat, urcrnrlon,
+                   resolution = 'f', projection = 'tmerc', lat_0 = None,
+                   lon_0 = None, area_thresh = 1, basemap_pickle = None):
+        """Returns the MapGeometry for a bounding box.
+
+        The first time a bounding box is asked for, a Basemap is built for it
+        (or unpickled from basemap_pickle, if that exists and was built with
+        the same options), which will take a while. After that the cached
+        geometry is used. The projection is centred on the box unless lat_0
+        and lon_0 are given.
+        """
+        if lat_0 is None:
+            lat_0 = (llcrnrlat + urcrnrlat) / 2.0
+        if lon_0 is None:
+            lon_0 = (llcrnrlon + urcrnrlon) / 2.0
+        options = dict(llcrnrlat = llcrnrlat, llcrnrlon = llcrnrlon,
+                       urcrnrlat = urcrnrlat, urcrnrlon = urcrnrlon,
+                       resolution = resolution, projection = projection,
+                       lat_0 = lat_0, lon_0 = lon_0, area_thresh = area_thresh)
+        directory = os.path.join(cache_dir, _directory_name(options))
+        if not os.path.isfile(os.path.join(directory, 'projection.json')):
+            print 'No cached map geometry found! Creating it.'
+            with instrumentation.span('build_map_geometry'):
+                themap = None
+                if basemap_pickle is not None and \
+                   os.path.isfile(basemap_pickle):
+                    themap = cPickle.load(open(basemap_pickle, 'rb'))
+                    if not _basemap_matches(themap, options):
+                        print 'The pickled map is of somewhere else.'
+                        themap = None
+                if themap is None:
+                    print 'Preparing highres data, give us a few minutes.'
+                    # Only imported here, as it's slow and we rarely need it
+                    from mpl_toolkits.basemap import Basemap
+                    themap = Basemap(**options)
+                MapGeometry.from_basemap(themap, directory)
+        with instrumentation.span('load_map_geometry'):
+            return MapGeometry(directory)
+
+    @staticmethod
+    def from_basemap(themap, directory):
+        """Extracts the rivers and projection from a Basemap, and saves them
+        in directory. Returns the resulting MapGeometry.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        figure = plotter.figure()
+        segments = themap.drawrivers(ax = figure.add_subplot(111)) \
+                         .get_segments()
+        plotter.close(figure)
+        lengths = [len(segment) for segment in segments]
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1])) \
+                   .astype(np.int64)
+        points = np.concatenate([np.asarray(segment, dtype = np.float64)
+                                 for segment in segments]) \
+                 if segments else np.zeros((0, 2))
+        np.save(os.path.join(directory, 'river_points.npy'), points)
+        np.save(os.path.join(directory, 'river_starts.npy'), starts)
+        projection = { 'projparams': dict(themap.projparams),
+                       'llcrnrx': float(themap.projtran.llcrnrx),
+                       'llcrnry': float(themap.projtran.llcrnry),
+                       'xmax': float(themap.urcrnrx),
+                       'ymax': float(themap.urcrnry) }
+        with open(os.path.join(directory, 'projection.json'), 'w') as params:
+            json.dump(projection, params, indent = 1)
+        return MapGeometry(directory)
+
+    def __call__(self, lon, lat):
+        """Projects GPS coordinates (single values or arrays) to map
+        coordinates, exactly as the Basemap would.
+        """
+        if self._proj is None:
+            self._proj = _load_pyproj().Proj(self.projection['projparams'])
+        x, y = self._proj(lon, lat)
+        return (np.subtract(x, self.projection['llcrnrx']),
+                np.subtract(y, self.projection['llcrnry']))
+
+    def drawrivers(self, axes = None, color = 'k', linewidth = 0.5):
+        """Draws the rivers as a single LineCollection, and returns it."""
+        if axes is None:
+            axes = plotter.gca()
+        with instrumentation.span('draw_rivers') as span:
+            if self._river_points is None:
+                self._river_points = np.load(
+                    os.path.join(self.directory, 'river_points.npy'),
+                    mmap_mode = 'r')
+                self._river_starts = np.load(
+                    os.path.join(self.directory, 'river_starts.npy'),
+                    mmap_mode = 'r')
+            segments = np.split(self._river_points, self._river_starts[1:])
+            rivers = LineCollection(segments, colors = color,
+                                    linewidths = linewidth)
+            span.set(rows = len(self._river_points))
+        axes.add_collection(rivers)
+        self.set_axes_limits(axes)
+        return rivers
+
+    def set_axes_limits(self, axes = None):
+        """Makes the axes show the whole map, the right way up and without
+        any stretching.
+        """
+        if axes is None:
+            axes = plotter.gca()
+        axes.set_xlim(0, self.projection['xmax'])
+        axes.set_ylim(0, self.projection['ymax'])
+        axes.set_aspect('equal')
+        # Map coordinates don't mean much to anyone, so Basemap hides them
+        axes.set_xticks([])
+        axes.set_yticks([])
+
+def _basemap_matches(themap, options):
+    """Checks whether a Basemap was built with a set of options: the same
+    bounding box, resolution and projection.
+    """
+    projparams = getattr(themap, 'projparams', {})
+    actual = dict(llcrnrlat = getattr(themap, 'llcrnrlat', None),
+                  llcrnrlon = getattr(themap, 'llcrnrlon', None),
+                  urcrnrlat = getattr(themap, 'urcrnrlat', None),
+                  urcrnrlon = getattr(themap, 'urcrnrlon', None),
+                  resolution = getattr(themap, 'resolution', None),
+                  projection = getattr(themap, 'projection', None),
+                  lat_0 = projparams.get('lat_0'),
+                  lon_0 = projparams.get('lon_0'))
+    for key, value in actual.iteritems():
+        wanted = options[key]
+        if isinstance(wanted, (int, long, float)):
+            if value is None or abs(value - wanted) > 1e-6:
+                return False
+        elif value != wanted:
+            return False
+    return True
+
+def _directory_name(options):
+    """Turns a set of Basemap options into a directory name."""
+    return '_'.join('%s-%s' % (key, options[key]) for key in sorted(options))
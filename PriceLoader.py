@@ -0,0 +1,104 @@
+#! /usr/bin/python
+
+""" Copyright 2014 Forrest Brennen
+
+    This file is part of price_picture.
+
+    price_picture is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    price_picture is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with price_picture.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from multiprocessing.pool import ThreadPool
+
+from PriceMatrix import default_metrics, load_year
+
+"""
+PriceLoader.py
+
+Loads a run of years' metrics in the background, so that the animation can
+start on the first year while the rest are still coming. See PriceLoader.
+"""
+
+class PriceLoader():
+    """Loads the metrics for a run of years a few at a time, in order, always
+    keeping a few years ahead of the last one asked for.
+
+    Each year is a query of its own (see PriceMatrix.load_year), and a pool
+    of threads keeps several of them going at once. pymongo keeps a pool of
+    connections to the server, which the threads share, so the queries
+    really do run side by side. With the local backend they take turns on
+    the one SQLite connection, but each year is still there as soon as it's
+    done rather than once they all are.
+
+    Public methods:
+    - __init__(cache, collection, region, years, threads, prefetch,
+      metrics) -- starts loading the first few years.
+    - get(year) -- waits for a year, and returns its metrics and counts.
+    - ready(year) -- whether a year has arrived yet.
+    - close() -- waits for whatever's loading, and stops the threads.
+
+    Public variables:
+    - years -- the years we're loading, in order.
+    - prefetch -- how many years after the last one asked for to load ahead
+      of time.
+    - metrics -- the metrics we're loading (see PriceYear.metric_value).
+    """
+
+    def __init__(self, cache, collection, region, years, threads = 4,
+                 prefetch = 4, metrics = default_metrics):
+        """Constructor.
+
+        The years come from collection (a region's prices) or cache (an
+        AggregateCache), as in PriceMatrix.from_cache. The first year and the
+        prefetch after it start loading straight away.
+        """
+        self.years = list(years)
+        self.prefetch = prefetch
+        self.metrics = list(metrics)
+        self._cache = cache
+        self._collection = collection
+        self._region = region
+        self._pool = ThreadPool(threads)
+        self._results = {}
+        if self.years:
+            self._request(self.years[0])
+
+    def get(self, year):
+        """Returns the metrics for a year as a pair of dictionaries, metric
+        -> (prefix -> value) and prefix -> number of sales, waiting for them
+        if they're not here yet. Any error loading them is raised here.
+        """
+        self._request(year)
+        return self._results[year].get()
+
+    def ready(self, year):
+        """Checks whether a year has been loaded, without waiting."""
+        return year in self._results and self._results[year].ready()
+
+    def close(self):
+        """Waits for any years still loading, and stops the threads."""
+        self._pool.close()
+        self._pool.join()
+
+    def _request(self, year):
+        """Makes sure year, and the prefetch years after it, are loading.
+
+        The pool takes jobs in the order they're given, so the nearest years
+        come first.
+        """
+        index = self.years.index(year)
+        for ahead in self.years[index:index + self.prefetch + 1]:
+            if ahead not in self._results:
+                self._results[ahead] = self._pool.apply_async(
+                    load_year, (self._cache, self._collection, self._region,
+                                ahead, self.metrics))
@@ -0,0 +1,449 @@
+#! /usr/bin/python
+
+""" Copyright 2014 Forrest Brennen
+
+    This file is part of price_picture.
+
+    price_picture is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    price_picture is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with price_picture.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+import db_schemas as schemas
+import instrumentation
+from AggregateCache import district_level
+from PriceYear import PriceYear, aggregate_monthly_price_sketches, \
+                      aggregate_price_sketches, histogram_edges, \
+                      metric_value, month_label, month_number
+from QuantileSketch import rolling_sketches
+
+# The name AggregateCache knows our medians by.
+median_metric = 'median'
+
+# The metrics (see PriceYear.metric_value) worked out unless we're asked for
+# others. Medians and counts are always worked out, whatever's asked for.
+default_metrics = (median_metric,)
+
+def price_year_range(startyear, endyear, collection):
+    """Generates the PriceYears from startyear to endyear inclusive, comparing
+    each of them to startyear.
+
+    Only one aggregation is run against the collection, however many years
+    are requested.
+    """
+    matrix = PriceMatrix.from_collection(collection, startyear, endyear)
+    return matrix.price_years(startyear)
+
+def load_year(cache, collection, region, year, metrics = default_metrics):
+    """Returns some metrics for a year in a region, as a pair of
+    dictionaries: metric -> (prefix -> value), and prefix -> number of sales.
+
+    They come from the AggregateCache if every metric is there and up to
+    date. Otherwise they're all worked out in one pass over collection (the
+    region's prices), and cached for next time.
+    """
+    metrics = _metric_list(metrics)
+    with instrumentation.span('load_year', region = region,
+                              year = year) as span:
+        found = _cached_years(cache, region, metrics, [year])
+        if year in found:
+            metric_values, counts = found[year]
+        else:
+            sketches = aggregate_price_sketches(collection, year, year)
+            metric_values, counts = _metric_values(sketches, metrics) \
+                                        .get(year, _no_values(metrics))
+            _cache_year(cache, region, year, metric_values, counts)
+            span.set(cached = False)
+        span.set(rows = len(counts))
+    return metric_values, counts
+
+def refresh_cached_cells(cache, database, cells):
+    """Recalculates every cached metric for a set of (region, year, prefix)
+    cells whose sales have changed, leaving everything else in the cache
+    alone.
+
+    Only the sales under the changed prefixes are read from each region's
+    prices collection, once for all the metrics.
+    """
+    changed = {}
+    for region, year, prefix in cells:
+        changed.setdefault((region, year), set()).add(prefix)
+    for (region, year), prefixes in sorted(changed.iteritems()):
+        metrics = _metric_list(cache.cached_metrics(region, district_level,
+                                                    year))
+        sketches = aggregate_price_sketches(
+            schemas.prices_collection_for(database, region), year, year,
+            sorted(prefixes))
+        metric_values, counts = _metric_values(sketches, metrics) \
+                                    .get(year, _no_values(metrics))
+        cache.patch_year(region, district_level, year, metric_values, counts,
+                         prefixes)
+
+def normalize_pct_increase(pct_increases):
+    """Maps percentage changes to [0,1], for a single value or a whole array.
+
+    See MapDisplay._normalize_pct_increase for the details of the scale.
+    Increases are capped at 1000%.
+    """
+    pct_increases = np.asarray(pct_increases, dtype = np.float64)
+    normalized = np.where(pct_increases > 1,
+                          np.minimum((pct_increases - 1) * 0.8 / 10 + 0.2, 1.0),
+                          (pct_increases - 1) * 0.2 + 0.2)
+    if normalized.ndim == 0:
+        return float(normalized)
+    return normalized
+
+class PriceMatrix():
+    """Median prices for every postcode prefix and year in a range, stored as
+    a prefix x year grid.
+
+    Rows are postcode prefixes (in sorted order), columns are years. Cells with
+    no sales have a median of 0, matching PriceYear._get_median_for. Because
+    everything lives in contiguous arrays, comparing against a different base
+    year or finding year-on-year changes is a single array operation.
+
+    Any other metrics (see PriceYear.metric_value) asked for are kept
+    alongside the medians, in grids of their own. They're all worked out
+    together, so switching between them doesn't need the DB.
+
+    A matrix built by from_months has a column for each month instead, named
+    'YYYY-MM'. Everything else works the same way, with months standing in for
+    years.
+
+    Public methods:
+    - __init__(prefixes, years, medians, counts, metrics) -- wraps existing
+      arrays.
+    - empty(prefixes, years, metrics) -- a PriceMatrix with no sales yet.
+    - from_collection(collection, startyear, endyear, relative_error,
+      metrics) -- builds a PriceMatrix from the DB.
+    - from_cache(cache, collection, region, startyear, endyear, metrics) --
+      builds a PriceMatrix from an AggregateCache, only going to the DB for
+      years which aren't cached.
+    - from_months(collection, startyear, endyear, window, relative_error,
+      metrics) -- builds a PriceMatrix of monthly (or rolling) metrics from
+      the DB.
+    - from_sketches(startyear, endyear, sketches, metrics) -- builds a
+      PriceMatrix from (year, prefix) -> QuantileSketch.
+    - from_year_values(startyear, endyear, year_values, metrics) -- builds a
+      PriceMatrix from year -> (metric -> (prefix -> value), prefix ->
+      count).
+    - fill_year(year, metric_values, counts) -- fills in a year's column.
+    - values(metric) -- the grid of values of a metric.
+    - column(year) -- the column index of a year.
+    - ratios(base_year) -- every median as a fraction of the base year's.
+    - pct_increases(base_year) -- the same, but 0 in the base year itself,
+      as PriceYears and MapDisplay show them.
+    - year_over_year() -- every median as a fraction of the previous year's.
+    - price_year(year, base_year), price_years(base_year) -- PriceYear views.
+
+    Public variables:
+    - prefixes -- the postcode prefix for each row.
+    - prefix_index -- a dictionary mapping prefixes to row numbers.
+    - years -- the year (or month) for each column.
+    - medians -- float array of median prices.
+    - counts -- int array of the number of sales behind each median.
+    - metrics -- a dictionary mapping each metric we have, including the
+      medians, to its array. Histograms have an extra dimension, for the
+      bins.
+    """
+
+    def __init__(self, prefixes, years, medians, counts, metrics = None):
+        """Constructor.
+
+        Accepts a sequence of prefixes, a sequence of years, and two arrays of
+        shape (len(prefixes), len(years)). Any other metrics can be given as
+        a dictionary mapping each to an array of the same shape (with an
+        extra dimension for histograms).
+        """
+        self.prefixes = list(prefixes)
+        self.prefix_index = dict((prefix, row)
+                                 for row, prefix in enumerate(self.prefixes))
+        self.years = list(years)
+        self.medians = np.ascontiguousarray(medians, dtype = np.float64)
+        self.counts = np.ascontiguousarray(counts, dtype = np.int64)
+        self.metrics = dict((metric, np.ascontiguousarray(values))
+                            for metric, values
+                            in (metrics or {}).iteritems())
+        self.metrics[median_metric] = self.medians
+
+    @staticmethod
+    def empty(prefixes, years, metrics = default_metrics):
+        """Returns a PriceMatrix with room for some metrics, but no sales in
+        any year yet. Years can be filled in with fill_year.
+        """
+        shape = (len(prefixes), len(years))
+        arrays = dict((metric, np.zeros(shape + (len(histogram_edges) - 1,),
+                                        dtype = np.int64)
+                               if metric == 'histogram' else np.zeros(shape))
+                      for metric in _metric_list(metrics))
+        return PriceMatrix(prefixes, years, arrays.pop(median_metric),
+                           np.zeros(shape, dtype = np.int64), arrays)
+
+    @staticmethod
+    def from_collection(collection, startyear, endyear, relative_error = None,
+                        metrics = default_metrics):
+        """Aggregates every year from startyear to endyear inclusive in a
+        single pass over a prices collection.
+
+        The metrics are exact unless a relative_error is given (see
+        QuantileSketch).
+        """
+        sketches = aggregate_price_sketches(collection, startyear, endyear,
+                                            relative_error = relative_error)
+        return PriceMatrix.from_sketches(startyear, endyear, sketches,
+                                         metrics)
+
+    @staticmethod
+    def from_cache(cache, collection, region, startyear, endyear,
+                   metrics = default_metrics):
+        """Builds a PriceMatrix for a region using an AggregateCache.
+
+        Years which have every metric cached (and up to date) are read
+        straight from the cache. Any others are aggregated in a single pass
+        over collection (the region's prices), and added to the cache.
+        """
+        metrics = _metric_list(metrics)
+        years = range(startyear, endyear + 1)
+        with instrumentation.span('cache_get', region = region) as span:
+            year_values = _cached_years(cache, region, metrics, years)
+            span.set(rows = len(year_values))
+        missing = [year for year in years if year not in year_values]
+        if missing:
+            sketches = aggregate_price_sketches(collection, min(missing),
+                                                max(missing))
+            computed = _metric_values(sketches, metrics)
+            for year in missing:
+                metric_values, counts = computed.get(year,
+                                                     _no_values(metrics))
+                with instrumentation.span('cache_put', year = year,
+                                          rows = len(counts)):
+                    _cache_year(cache, region, year, metric_values, counts)
+                year_values[year] = (metric_values, counts)
+        return PriceMatrix.from_year_values(startyear, endyear, year_values,
+                                            metrics)
+
+    @staticmethod
+    def from_months(collection, startyear, endyear, window = 1,
+                    relative_error = None, metrics = default_metrics):
+        """Builds a PriceMatrix with a column for every month from January of
+        startyear to December of endyear, named 'YYYY-MM'.
+
+        Each value is over the window months up to and including the
+        column's own, so a window of 12 gives trailing 12-month medians. The
+        sales are read in a single pass over collection, going back far
+        enough to fill the first window, and each window is worked out from
+        the one before (see QuantileSketch.rolling_sketches), so a monthly
+        series costs about what a yearly one does.
+        """
+        metrics = _metric_list(metrics)
+        first = month_number(startyear, 1)
+        last = month_number(endyear, 12)
+        sketches = aggregate_monthly_price_sketches(
+            collection, first - window + 1, last,
+            relative_error = relative_error)
+        by_prefix = {}
+        for (month, prefix), sketch in sketches.iteritems():
+            by_prefix.setdefault(prefix, {})[month] = sketch
+        prefixes = sorted(by_prefix)
+        months = range(first - window + 1, last + 1)
+        matrix = PriceMatrix.empty(prefixes,
+                                   [month_label(month)
+                                    for month in range(first, last + 1)],
+                                   metrics)
+        with instrumentation.span('rolling_metrics', window = window) as span:
+            for row, prefix in enumerate(prefixes):
+                windows = rolling_sketches([by_prefix[prefix].get(month)
+                                            for month in months], window)
+                for index, sketch in enumerate(windows):
+                    # The first window - 1 months are only there to fill the
+                    # first window
+                    col = index - window + 1
+                    if col < 0 or sketch.count == 0:
+                        continue
+                    matrix.counts[row, col] = sketch.count
+                    for metric in metrics:
+                        matrix.metrics[metric][row, col] = \
+                            metric_value(sketch, metric)
+            span.set(rows = len(prefixes))
+        # Leave out prefixes which only had sales before the first month
+        keep = np.flatnonzero(matrix.counts.any(axis = 1))
+        return PriceMatrix([prefixes[row] for row in keep], matrix.years,
+                           matrix.medians[keep], matrix.counts[keep],
+                           dict((metric, values[keep]) for metric, values
+                                in matrix.metrics.iteritems()
+                                if metric != median_metric))
+
+    @staticmethod
+    def from_sketches(startyear, endyear, sketches,
+                      metrics = default_metrics):
+        """Builds a PriceMatrix from a dictionary of (year, prefix) ->
+        QuantileSketch, as returned by aggregate_price_sketches.
+        """
+        metrics = _metric_list(metrics)
+        return PriceMatrix.from_year_values(startyear, endyear,
+                                            _metric_values(sketches, metrics),
+                                            metrics)
+
+    @staticmethod
+    def from_year_values(startyear, endyear, year_values,
+                         metrics = default_metrics):
+        """Builds a PriceMatrix from a dictionary mapping years to a pair of
+        dictionaries: metric -> (prefix -> value), and prefix -> number of
+        sales.
+
+        Years which are missing from year_values have no sales.
+        """
+        years = range(startyear, endyear + 1)
+        prefixes = set()
+        for year in years:
+            prefixes.update(year_values.get(year, ({}, {}))[1])
+        matrix = PriceMatrix.empty(sorted(prefixes), years, metrics)
+        for year in years:
+            if year in year_values:
+                matrix.fill_year(year, *year_values[year])
+        return matrix
+
+    def fill_year(self, year, metric_values, counts):
+        """Fills in the column for a year from a pair of dictionaries: metric
+        -> (prefix -> value), and prefix -> number of sales. Prefixes which
+        aren't in counts have no sales that year, and any we don't have a row
+        for are left out.
+        """
+        col = self.column(year)
+        self.counts[:, col] = 0
+        for values in self.metrics.itervalues():
+            values[:, col] = 0
+        for prefix, count in counts.iteritems():
+            row = self.prefix_index.get(prefix)
+            if row is None:
+                continue
+            self.counts[row, col] = count
+            for metric, values in metric_values.iteritems():
+                if metric in self.metrics and prefix in values:
+                    self.metrics[metric][row, col] = values[prefix]
+
+    def values(self, metric):
+        """Returns the grid of values of a metric, one row for each prefix
+        and one column for each year.
+        """
+        if metric == 'count':
+            return self.counts
+        return self.metrics[metric]
+
+    def column(self, year):
+        """Returns the column index for a year."""
+        return self.years.index(year)
+
+    def ratios(self, base_year):
+        """Returns every median as a fraction of the same prefix's median in
+        base_year, e.g. 1.2 for a 20% increase.
+
+        Prefixes with no sales in base_year get 0, as in PriceYear.
+        """
+        base = self.medians[:, self.column(base_year)][:, np.newaxis]
+        return _safe_divide(self.medians, base)
+
+    def pct_increases(self, base_year):
+        """Returns the ratios to base_year as PriceYear's pct_increase has
+        them: the base year has nothing to compare to, so it gets 0, as do
+        prefixes with no sales in it.
+        """
+        ratios = self.ratios(base_year)
+        ratios[:, self.column(base_year)] = 0
+        return ratios
+
+    def year_over_year(self):
+        """Returns every median as a fraction of the same prefix's median in
+        the previous year.
+
+        The result has one fewer column than there are years; column i is the
+        change from years[i] to years[i + 1].
+        """
+        return _safe_divide(self.medians[:, 1:], self.medians[:, :-1])
+
+    def price_year(self, year, base_year):
+        """Returns a PriceYear for year, compared against base_year."""
+        col = self.column(year)
+        ratios = self.pct_increases(base_year)[:, col]
+        present = np.flatnonzero(self.counts[:, col])
+        medians = dict((self.prefixes[row], self.medians[row, col])
+                       for row in present)
+        pct_increases = dict((self.prefixes[row], ratios[row])
+                             for row in present)
+        others = [metric for metric in sorted(self.metrics)
+                  if metric != median_metric]
+        metrics = dict((self.prefixes[row],
+                        dict((metric, self.metrics[metric][row, col].tolist())
+                             for metric in others))
+                       for row in present)
+        return PriceYear(year, medians = medians,
+                         pct_increases = pct_increases, metrics = metrics)
+
+    def price_years(self, base_year):
+        """Returns a PriceYear for every year, compared against base_year."""
+        return [self.price_year(year, base_year) for year in self.years]
+
+def _metric_list(metrics):
+    """Returns the metrics we actually store for a list of them: the medians
+    first, and not the counts, which we always have anyway.
+    """
+    return [median_metric] + [metric for metric in metrics
+                              if metric not in (median_metric, 'count')]
+
+def _no_values(metrics):
+    """Returns the metric values for a year with no sales."""
+    return dict((metric, {}) for metric in metrics), {}
+
+def _metric_values(sketches, metrics):
+    """Turns (year, prefix) -> QuantileSketch into year -> (metric -> (prefix
+    -> value), prefix -> number of sales).
+    """
+    by_year = {}
+    for (year, prefix), sketch in sketches.iteritems():
+        by_year.setdefault(year, []).append((prefix, sketch))
+    year_values = {}
+    for year, cells in sorted(by_year.iteritems()):
+        with instrumentation.span('metrics', year = year) as span:
+            metric_values = dict((metric,
+                                  dict((prefix, metric_value(sketch, metric))
+                                       for prefix, sketch in cells))
+                                 for metric in metrics)
+            counts = dict((prefix, sketch.count) for prefix, sketch in cells)
+            span.set(rows = sum(counts.itervalues()))
+        year_values[year] = (metric_values, counts)
+    return year_values
+
+def _cached_years(cache, region, metrics, years):
+    """Returns year -> (metric -> (prefix -> value), prefix -> number of
+    sales) for each of some years which has every metric in the cache.
+    """
+    found = {}
+    for metric in metrics:
+        cached = cache.get_years(region, district_level, metric, years)
+        for year, (values, counts) in cached.iteritems():
+            found.setdefault(year, ({}, counts))[0][metric] = values
+    return dict((year, year_values) for year, year_values in found.iteritems()
+                if len(year_values[0]) == len(metrics))
+
+def _cache_year(cache, region, year, metric_values, counts):
+    """Stores every metric of a year in the cache."""
+    for metric, values in metric_values.iteritems():
+        cache.put(region, district_level, metric, year, values, counts)
+
+def _safe_divide(numerator, denominator):
+    """Divides two arrays, giving 0 wherever the denominator is 0."""
+    result = np.zeros(np.broadcast(numerator, denominator).shape)
+    np.divide(numerator, denominator, out = result,
+              where = (denominator != 0))
+    return result
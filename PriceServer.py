@@ -0,0 +1,393 @@
+#! /usr/bin/python
+
+""" Copyright 2014 Forrest Brennen
+
+    This file is part of price_picture.
+
+    price_picture is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    price_picture is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with price_picture.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import threading
+import time
+import traceback
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from sys import argv
+
+import numpy as np
+
+import db_schemas as schemas
+import instrumentation
+from AggregateCache import AggregateCache
+from MapDisplay import MapDisplay, display_metrics, figure_size, \
+                       loaded_metrics
+from PriceMatrix import PriceMatrix
+from QuantileSketch import QuantileSketch
+
+"""
+PriceServer.py
+
+A long-running local HTTP service for the price data, so that other programs
+can use it without building a MapDisplay (and loading the map, the postcodes
+and every year's prices) each time. Everything is loaded once, when the
+service starts, and then kept in memory:
+
+    GET /OX/median/2010.json    the median price in every OX prefix in 2010
+    GET /OX/median/2010.png     the frame MapDisplay would draw for 2010;
+                                ?width=500&height=600 for another size
+    GET /stats                  request counts, cache hit rate and latency
+
+The metrics are MapDisplay's display_metrics. JSON is available for any region
+with sales, PNG frames only for MapDisplay's region, as that's the only map we
+have.
+
+Responses are kept in an LRU cache, keyed on the region, metric, year and
+image size, and requests are handled by a fixed pool of threads. Frames are
+drawn one at a time, as they share MapDisplay's markers.
+"""
+
+# Where we listen by default. Only this machine can get at it.
+default_address = ('127.0.0.1', 8000)
+
+# The size of frames, unless asked for otherwise, and the biggest we'll draw.
+default_image_size = (figure_size[0] * 100, figure_size[1] * 100)
+max_image_size = 4000
+
+class ResponseCache():
+    """A thread-safe LRU cache of responses, which counts its hits and misses.
+
+    Public methods:
+    - __init__(size) -- makes an empty cache.
+    - get(key, make) -- returns the cached response for key, or makes it (by
+      calling make) and caches it.
+
+    Public variables:
+    - size -- the most responses kept.
+    - hits, misses -- how many times get has found (or not found) a response.
+    """
+
+    def __init__(self, size = 256):
+        """Constructor."""
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._responses = OrderedDict()
+        self._making = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, make):
+        """Returns the response for key, calling make to make it if it isn't
+        cached. The least recently used response is dropped once there are
+        more than size.
+
+        Only one thread makes a response at a time: any others asking for it
+        meanwhile wait for that one, rather than making it again.
+        """
+        while True:
+            with self._lock:
+                if key in self._responses:
+                    self.hits += 1
+                    response = self._responses.pop(key)
+                    self._responses[key] = response
+                    return response
+                making = self._making.get(key)
+                if making is None:
+                    self.misses += 1
+                    making = self._making[key] = threading.Event()
+                    break
+            # If making it fails, or it's dropped before we get to it, we'll
+            # have another go ourselves
+            making.wait()
+        try:
+            response = make()
+            with self._lock:
+                self._responses[key] = response
+                while len(self._responses) > self.size:
+                    self._responses.popitem(last = False)
+        finally:
+            with self._lock:
+                del self._making[key]
+            making.set()
+        return response
+
+class PriceService():
+    """Answers requests for metrics and frames from data kept in memory.
+
+    Public methods:
+    - __init__(startyear, endyear, database, themap, cache_size, shared) --
+      loads everything.
+    - respond(path) -- answers a GET request.
+    - stats() -- the request counters.
+
+    Public variables:
+    - display -- the MapDisplay frames are drawn with, which holds the
+      aggregates and projected postcode positions for its region.
+    - cache -- the ResponseCache.
+    """
+
+    def __init__(self, startyear, endyear, database = None, themap = None,
+                 cache_size = 256, shared = False):
+        """Constructor.
+
+        Loads every year for MapDisplay's region straight away. Other
+        regions are loaded (through the AggregateCache) the first time
+        they're asked for.
+
+        With shared, MapDisplay's region comes from shared memory (see
+        MapDisplay), so a server per CPU, say, only needs one copy of it.
+        """
+        self._database = database if database is not None \
+                         else schemas.connect()
+        self.display = MapDisplay(startyear, endyear, self._database, themap,
+                                  shared = shared)
+        for year in self.display.price_matrix.years:
+            self.display.price_year(year)
+        self.cache = ResponseCache(cache_size)
+        self._startyear = startyear
+        self._endyear = endyear
+        self._matrices = { MapDisplay.region: self.display.price_matrix }
+        self._matrices_lock = threading.Lock()
+        self._region_locks = {}
+        self._render_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._requests = 0
+        self._errors = 0
+        self._latency = QuantileSketch(relative_error = 0.01)
+
+    def respond(self, path):
+        """Answers a GET request for path. Returns the HTTP status, the
+        content type and the body.
+
+        Anything going wrong along the way (the DB falling over, say) is
+        answered with a 500, and counted as an error.
+        """
+        started = time.time()
+        with instrumentation.span('respond', path = path):
+            try:
+                status, content_type, body = self._respond(path)
+            except Exception as e:
+                traceback.print_exc()
+                status, content_type, body = \
+                    _error(500, 'Internal error: %s' % e)
+        # Microseconds, as the sketch works in whole numbers
+        elapsed = max(1, int((time.time() - started) * 1e6))
+        with self._stats_lock:
+            self._requests += 1
+            if status != 200:
+                self._errors += 1
+            self._latency.add([elapsed])
+        return status, content_type, body
+
+    def stats(self):
+        """Returns the counters: requests answered, errors among them, cache
+        hits and misses, and the latency in milliseconds.
+        """
+        with self._stats_lock:
+            latency = dict(zip(('p50', 'p90', 'p99'),
+                               [value / 1000.0 for value in
+                                self._latency.quantiles([0.5, 0.9, 0.99])]))
+            latency['mean'] = self._latency.mean() / 1000.0
+            lookups = self.cache.hits + self.cache.misses
+            return { 'requests': self._requests,
+                     'errors': self._errors,
+                     'cache_hits': self.cache.hits,
+                     'cache_misses': self.cache.misses,
+                     'cache_hit_rate': float(self.cache.hits) / lookups
+                                       if lookups else 0.0,
+                     'latency_ms': latency }
+
+    def _respond(self, path):
+        """Works out the response to a request (see respond)."""
+        url = urlparse.urlparse(path)
+        parts = url.path.strip('/').split('/')
+        if parts == ['stats']:
+            return 200, 'application/json', json.dumps(self.stats())
+        if len(parts) != 3 or '.' not in parts[2]:
+            return _error(404, 'No such page: ' + url.path)
+        region, metric = parts[0].upper(), parts[1]
+        year, extension = parts[2].rsplit('.', 1)
+        if metric not in display_metrics:
+            return _error(404, 'Unknown metric: ' + metric)
+        if not year.isdigit() or \
+           not self._startyear <= int(year) <= self._endyear:
+            return _error(404, 'No data for ' + year)
+        year = int(year)
+        if extension == 'json':
+            if region not in self._matrices and \
+               region not in schemas.price_regions(self._database):
+                return _error(404, 'Unknown region: ' + region)
+            return self.cache.get(
+                (region, metric, year, None),
+                lambda: (200, 'application/json',
+                         json.dumps(self._metric_values(region, metric,
+                                                        year))))
+        if extension == 'png':
+            if region != MapDisplay.region:
+                return _error(404, 'No map for ' + region)
+            query = urlparse.parse_qs(url.query)
+            try:
+                width = int(query.get('width', [default_image_size[0]])[0])
+                height = int(query.get('height', [default_image_size[1]])[0])
+            except ValueError:
+                return _error(400, 'The width and height must be numbers')
+            if not (0 < width <= max_image_size and
+                    0 < height <= max_image_size):
+                return _error(400, 'Images can be up to %d pixels across' %
+                              max_image_size)
+            return self.cache.get(
+                (region, metric, year, (width, height)),
+                lambda: (200, 'image/png',
+                         self._render(metric, year, width, height)))
+        return _error(404, 'Unknown format: ' + extension)
+
+    def _matrix(self, region):
+        """Returns the PriceMatrix for a region, loading it if need be.
+
+        Each region has a lock of its own, so requests for a region which is
+        being loaded wait for it, but nothing else does.
+        """
+        with self._matrices_lock:
+            if region in self._matrices:
+                return self._matrices[region]
+            lock = self._region_locks.setdefault(region, threading.Lock())
+        with lock:
+            if region not in self._matrices:
+                cache = AggregateCache(
+                    self._database[schemas.aggregate_cache_collection_name],
+                    self._database[schemas.watermark_collection_name])
+                matrix = PriceMatrix.from_cache(
+                    cache, schemas.prices_collection_for(self._database,
+                                                         region),
+                    region, self._startyear, self._endyear,
+                    metrics = loaded_metrics)
+                with self._matrices_lock:
+                    self._matrices[region] = matrix
+            return self._matrices[region]
+
+    def _metric_values(self, region, metric, year):
+        """Returns a metric for every prefix in a region with sales in a year,
+        along with the number of sales, ready to be turned into JSON.
+        """
+        matrix = self._matrix(region)
+        col = matrix.column(year)
+        if metric == 'pct_increase':
+            # As the map shows it (see PriceYear)
+            values = matrix.pct_increases(matrix.years[0])[:, col]
+        elif metric == 'change':
+            medians = matrix.medians
+            values = np.where(medians[:, 0] > 0,
+                              medians[:, col] - medians[:, 0], 0)
+        else:
+            values = matrix.values(metric)[:, col]
+        sold = np.flatnonzero(matrix.counts[:, col] > 0)
+        return { 'region': region, 'metric': metric, 'year': year,
+                 'values': dict((matrix.prefixes[row], values[row].item())
+                                for row in sold),
+                 'counts': dict((matrix.prefixes[row],
+                                 int(matrix.counts[row, col]))
+                                for row in sold) }
+
+    def _render(self, metric, year, width, height):
+        """Draws a frame for a metric and year."""
+        with self._render_lock:
+            if self.display.metric != metric:
+                self.display.set_metric(metric)
+            return self.display.render_frame(year, width, height)
+
+class PriceServer(HTTPServer):
+    """An HTTP server for a PriceService, handing each request to one of a
+    fixed pool of threads.
+
+    Public methods:
+    - __init__(service, address, workers) -- starts listening.
+    - serve_forever() -- answers requests until shutdown() is called.
+    - shutdown() -- stops serving (from another thread).
+    - server_close() -- stops listening, and finishes off the workers.
+
+    Public variables:
+    - service -- the PriceService answering requests.
+    """
+
+    def __init__(self, service, address = default_address, workers = 8):
+        """Constructor."""
+        HTTPServer.__init__(self, address, _RequestHandler)
+        self.service = service
+        self._pool = ThreadPool(workers)
+
+    def process_request(self, request, client_address):
+        """Passes a request on to the pool, rather than handling it in the
+        thread accepting connections.
+        """
+        self._pool.apply_async(self._process_in_pool,
+                               (request, client_address))
+
+    def server_close(self):
+        """Stops listening, and waits for the requests in hand."""
+        HTTPServer.server_close(self)
+        self._pool.close()
+        self._pool.join()
+
+    def _process_in_pool(self, request, client_address):
+        """Handles a request in a pool thread, as ThreadingMixIn would in a
+        thread of its own.
+        """
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """Passes GET requests on to the server's PriceService."""
+
+    def do_GET(self):
+        status, content_type, body = self.server.service.respond(self.path)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Keeps quiet about every request; see /stats instead."""
+        pass
+
+def _error(status, message):
+    """Returns an error response."""
+    return status, 'application/json', json.dumps({ 'error': message })
+
+if __name__ == '__main__':
+    options = dict(zip(argv[1::1], argv[2::1]))
+    if '--trace' in options:
+        instrumentation.enable()
+    service = PriceService(1996, 2013,
+                           cache_size = int(options.get('--cache', 256)),
+                           shared = '--shared' in argv)
+    server = PriceServer(service,
+                         (default_address[0],
+                          int(options.get('--port', default_address[1]))),
+                         workers = int(options.get('--workers', 8)))
+    print 'Serving on http://%s:%d/' % server.server_address
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if '--trace' in options:
+            instrumentation.dump_trace(options['--trace'])
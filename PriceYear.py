@@ -18,87 +18,253 @@
     along with price_picture.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import math
 from collections import namedtuple
 from datetime import datetime
 
-from pymongo import MongoClient
-from bson import Code
+import instrumentation
+from QuantileSketch import QuantileSketch
+
+"""
+PriceYear.py
+
+Summarises the sales in a prices collection by postcode prefix and year (or
+month), and holds a year's worth of the results.
+
+These are the metrics we can work out for each (prefix, year) cell. They all
+come from the cell's QuantileSketch, so any number of them costs the same
+single pass over the DB:
+
+    count       the number of sales
+    median      the median price
+    mean        the average price
+    qNN         the NNth percentile, e.g. q25 or q90
+    histogram   the number of sales in each of the histogram_edges bins
+"""
+
+# Where the bins of the price histograms start and end, in pounds.
+histogram_edges = [0, 50000, 100000, 150000, 200000, 250000, 300000, 400000,
+                   500000, 750000, 1000000, 2000000, float('inf')]
+
+def metric_value(sketch, metric):
+    """Works out a metric (see above) from a QuantileSketch."""
+    if metric == 'count':
+        return sketch.count
+    if metric == 'median':
+        return sketch.median()
+    if metric == 'mean':
+        return sketch.mean()
+    if metric == 'histogram':
+        return sketch.histogram(histogram_edges)
+    if metric.startswith('q') and metric[1:].isdigit():
+        return sketch.quantile(int(metric[1:]) / 100.0)
+    raise ValueError('Unknown metric: ' + metric)
+
+def aggregate_price_metrics(collection, startyear, endyear, metrics,
+                            prefixes = None, relative_error = None):
+    """Works out a list of metrics for every postcode prefix in every year
+    from startyear to endyear inclusive, in a single pass over the
+    collection (see aggregate_price_sketches).
+
+    Returns a dictionary mapping (year, prefix) to a dictionary of metric ->
+    value.
+    """
+    sketches = aggregate_price_sketches(collection, startyear, endyear,
+                                        prefixes, relative_error)
+    return dict((cell, dict((metric, metric_value(sketch, metric))
+                            for metric in metrics))
+                for cell, sketch in sketches.iteritems())
+
+def aggregate_price_sketches(collection, startyear, endyear, prefixes = None,
+                             relative_error = None):
+    """Summarises the sale prices for every postcode prefix in every year from
+    startyear to endyear inclusive.
+
+    Everything is grouped by (year, prefix) on the server in a single pass over
+    the collection, rather than one map-reduce per year. The collection should
+    be the prices for a single region (see db_schemas.prices_collection_for).
+    Prefixes are postcode districts, e.g. 'OX1' or 'W1A', and if a list of them
+    is given only sales under those are included.
+
+    Rather than collecting every price, the server counts the sales under each
+    QuantileSketch key (the price itself, or a bucket if relative_error is
+    given), so neither it nor we need memory in proportion to the number of
+    sales.
+
+    Returns a dictionary mapping (year, prefix) to a QuantileSketch.
+    """
+    with instrumentation.span('aggregate_price_sketches',
+                              startyear = startyear,
+                              endyear = endyear) as span:
+        return _aggregate_sketches(collection,
+                                   datetime(int(startyear), 1, 1),
+                                   datetime(int(endyear) + 1, 1, 1),
+                                   { 'year': { '$year': '$date' } },
+                                   lambda period: period['year'],
+                                   prefixes, relative_error, span)
+
+def aggregate_monthly_price_sketches(collection, startmonth, endmonth,
+                                     prefixes = None, relative_error = None):
+    """Summarises the sale prices for every postcode prefix in every month
+    from startmonth to endmonth inclusive, in a single pass over the
+    collection, just as aggregate_price_sketches does for years.
+
+    Months are numbered as by month_number. Returns a dictionary mapping
+    (month number, prefix) to a QuantileSketch.
+    """
+    startyear, startindex = divmod(int(startmonth), 12)
+    endyear, endindex = divmod(int(endmonth) + 1, 12)
+    with instrumentation.span('aggregate_monthly_price_sketches',
+                              startmonth = month_label(startmonth),
+                              endmonth = month_label(endmonth)) as span:
+        return _aggregate_sketches(collection,
+                                   datetime(startyear, startindex + 1, 1),
+                                   datetime(endyear, endindex + 1, 1),
+                                   { 'year': { '$year': '$date' },
+                                     'month': { '$month': '$date' } },
+                                   lambda period: month_number(
+                                       period['year'], period['month']),
+                                   prefixes, relative_error, span)
+
+def month_number(year, month):
+    """Returns a number for a month which goes up by one each month, so that
+    ranges of months are easy to work with, e.g. month_number(1996, 1) + 12
+    is month_number(1997, 1).
+    """
+    return int(year) * 12 + int(month) - 1
+
+def month_label(number):
+    """Returns the 'YYYY-MM' name of a month_number."""
+    year, index = divmod(int(number), 12)
+    return '%04d-%02d' % (year, index + 1)
+
+def sales_query(rangestart, rangeend, prefixes = None):
+    """Returns the query for the sales in [rangestart, rangeend), in the
+    prefixes given or all of them.
+
+    Only the date, district and price are looked at, which are all in each of
+    the db_schemas.prices_indexes.
+    """
+    query = { 'date': { '$gte': rangestart, '$lt': rangeend },
+              'price': { '$gt': 0 } }
+    if prefixes is not None:
+        query['district'] = { '$in': list(prefixes) }
+    return query
+
+def _aggregate_sketches(collection, rangestart, rangeend, period, period_of,
+                        prefixes, relative_error, span):
+    """Counts the sales in [rangestart, rangeend) under each QuantileSketch
+    key, grouped by prefix and by period, a $project specification of the
+    date fields to group on. period_of turns those fields back into the
+    period the results are keyed by.
+    """
+    query = sales_query(rangestart, rangeend, prefixes)
+    if relative_error is None:
+        key = '$price'
+    else:
+        log_gamma = math.log((1 + relative_error) / (1 - relative_error))
+        key = { '$ceil': { '$divide': [{ '$ln': '$price' }, log_gamma] } }
+    # Leaving out the _id means an index can answer everything
+    projection = dict(period, _id = 0, prefix = '$district', key = key)
+    group = dict((field, '$' + field) for field in period)
+    group.update(prefix = '$prefix', key = '$key')
+    pipeline = [{ '$match': query },
+                { '$project': projection },
+                { '$group': { '_id': group, 'count': { '$sum': 1 } } }]
+
+    keys = {}
+    groups = 0
+    for entry in _aggregate(collection, pipeline):
+        cell = (period_of(entry['_id']), entry['_id']['prefix'])
+        cell_keys, cell_counts = keys.setdefault(cell, ([], []))
+        cell_keys.append(entry['_id']['key'])
+        cell_counts.append(entry['count'])
+        groups += 1
+    span.set(rows = groups)
+    sketches = {}
+    for cell, (cell_keys, cell_counts) in keys.iteritems():
+        sketches[cell] = QuantileSketch(relative_error)
+        sketches[cell].add_counts(cell_keys, cell_counts)
+    return sketches
+
+def aggregate_median_prices(collection, startyear, endyear):
+    """Finds the median sale price for every postcode prefix in every year from
+    startyear to endyear inclusive, in a single pass over the collection.
+
+    Returns a dictionary mapping each year to a dictionary of prefix -> median.
+    Years with no sales at all are still present, but empty.
+    """
+    sketches = aggregate_price_sketches(collection, startyear, endyear)
+    medians = dict((year, {}) for year in range(startyear, endyear + 1))
+    for (year, prefix), sketch in sketches.iteritems():
+        medians[year][prefix] = sketch.median()
+    return medians
+
+def _aggregate(collection, pipeline):
+    """Runs an aggregation pipeline and returns an iterable of the results.
+
+    Older versions of pymongo hand back a dictionary, newer ones a cursor.
+    """
+    results = collection.aggregate(pipeline, allowDiskUse = True)
+    if isinstance(results, dict):
+        return results['result']
+    return results
 
 class PriceYear():
     """Aggregates postcode data for a single year, and compares them to the
-    previous year. Provides an iterator to cycle through this year's data.
+    previous year. Can be iterated over to cycle through this year's data.
+
+    To build a whole series of years at once, use a PriceMatrix, which only
+    needs a single pass over the DB and hands out PriceYears as views.
 
     Public methods:
-    - __init__(year, collection, previous_PriceYear) -- generates the PriceYear.
+    - __init__(year, collection, previous_PriceYear, medians, pct_increases) --
+      generates the PriceYear.
 
     Public variables:
     - PostcodePrice -- a namedtuple of data for one postcode
-    - postcode_map, price_reduce, median_finalize -- used to find data from the
-      DB.
     - year -- the year this PriceYear corresponds to.
     - median_prices -- a dictionary mapping postcodes to PostcodePrices
+    - metrics -- a dictionary mapping postcodes to any other metrics we know
+      for them (see metric_value), e.g. { 'OX1': { 'mean': 250000 } }
     """
 
     PostcodePrice = namedtuple('PostcodePrice', ['postcode', 'median_price',
                                                      'pct_increase', 'year'])
-    postcode_map = Code("function() {"
-                        "  emit(this.postcode.substring(0,4).trim(),"
-                        "       this.price);"
-                        "}")
-    price_reduce = Code("function(key, values) {"
-                        "  result = {'prices': []};"
-                        "  for(i in values) {"
-                        "    if(values[i].prices) {"
-                        "        result.prices = "
-                        "            result.prices.concat(values[i].prices);"
-                        "    } else {"
-                        "        result.prices.push(values[i]);"
-                        "    }"
-                        "  }"
-                        "  return result;"
-                        "}")
-    median_finalize = Code("function(key, reducedvalues) {"
-                           "  if(!reducedvalues.prices) {"
-                           "    return reducedvalues;"
-                           "  }"
-                           "  results = reducedvalues.prices;"
-                           "  results.sort();"
-                           "  numvals = results.length;"
-                           "  if(numvals % 2 != 0) {"
-                           "    return (results[(numvals + 1) / 2] + "
-                           "            results[(numvals + 1) / 2 - 1]) / 2;"
-                           "  }"
-                           "  return results[numvals / 2];"
-                           "}")
-                        
-
-    def __init__(self, year, collection, previous_PriceYear = None):
+
+    def __init__(self, year, collection = None, previous_PriceYear = None,
+                 medians = None, pct_increases = None, metrics = None):
         """Constructor.
 
         Accepts the year of the data, a pymongo collection to pull the data
         from, and a PriceYear to compare this one to, in order to produce the
         percent difference between the two years. For the first year in a
         series, previous_PriceYear should be None.
+
+        If medians (a dictionary of postcode prefix -> median price) is given
+        then the collection isn't touched at all. If pct_increases (prefix ->
+        fraction of the previous median) is given as well then
+        previous_PriceYear isn't needed either. This is how PriceMatrix builds
+        its PriceYears, passing along any other metrics it has as metrics
+        (postcode prefix -> metric -> value).
         """
         self.year = year
-        yearstart = datetime(int(year), 1, 1)
-        yearend = datetime(int(year), 12, 31)
-        results = collection.inline_map_reduce(self.postcode_map,
-                                               self.price_reduce,
-                                               finalize = self.median_finalize,
-                                               query = {'date': {'$gte': yearstart,
-                                                                 '$lte': yearend}})
+        self.metrics = metrics if metrics is not None else {}
+        if medians is None:
+            medians = aggregate_median_prices(collection, year, year)[year]
         self.median_prices = {}
-        for entry in results:
+        for postcode, median_price in medians.iteritems():
             pct_increase = 0
-            if previous_PriceYear is not None:
-                last_median = previous_PriceYear._get_median_for(entry['_id'])
+            if pct_increases is not None:
+                pct_increase = pct_increases.get(postcode, 0)
+            elif previous_PriceYear is not None:
+                last_median = previous_PriceYear._get_median_for(postcode)
                 if last_median != 0:
-                    pct_increase = entry['value'] / last_median
-            self.median_prices[entry['_id']] = self.PostcodePrice(entry['_id'],
-                                                                  entry['value'],
-                                                                  pct_increase,
-                                                                  year)
+                    pct_increase = float(median_price) / last_median
+            self.median_prices[postcode] = self.PostcodePrice(postcode,
+                                                              median_price,
+                                                              pct_increase,
+                                                              year)
         self.__keys = self.median_prices.keys()
         self.__keys.sort()
             
@@ -113,17 +279,10 @@ class PriceYear():
         return 0
 
     def __iter__(self):
-        """These next two allow us to iterate through the PostcodePrices in the
-        class.
+        """Generates the PostcodePrices in the class, in postcode order.
+
+        Each iteration has its own place in the list, so any number of them
+        can be going on at once.
         """
-        self.__keyindex = 0
-        return self
-
-    def next(self):
-        try:
-            postcode_price = self.median_prices[
-                self.__keys[self.__keyindex]]
-        except IndexError:
-            raise StopIteration
-        self.__keyindex += 1
-        return postcode_price
+        for postcode in self.__keys:
+            yield self.median_prices[postcode]
@@ -0,0 +1,236 @@
+#! /usr/bin/python
+
+""" Copyright 2014 Forrest Brennen
+
+    This file is part of price_picture.
+
+    price_picture is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    price_picture is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with price_picture.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import math
+
+import numpy as np
+
+def rolling_sketches(sketches, window):
+    """Generates a sketch for each step of a sliding window over a list of
+    sketches.
+
+    sketches is a list of QuantileSketches with the same relative_error, one
+    for each of a run of consecutive periods (e.g. months), with None for
+    periods with no prices. The i-th sketch generated covers sketches[i -
+    window + 1] to sketches[i] inclusive, so the first window - 1 cover fewer
+    periods.
+
+    Rather than merging window sketches for every step, every key any of the
+    sketches has is counted in a single sorted array, and each step adds the
+    counts of the period entering the window and takes away those of the one
+    leaving it.
+    """
+    present = [sketch for sketch in sketches if sketch is not None]
+    if len(set(sketch.relative_error for sketch in present)) > 1:
+        raise ValueError('Can only combine sketches with the same error')
+    relative_error = present[0].relative_error if present else None
+    for sketch in present:
+        sketch._compact()
+    keys = np.unique(np.concatenate([sketch._keys for sketch in present] +
+                                    [np.zeros(0, dtype = np.int64)]))
+    positions = [None if sketch is None
+                 else np.searchsorted(keys, sketch._keys)
+                 for sketch in sketches]
+    window_counts = np.zeros(len(keys), dtype = np.int64)
+    total = 0
+    for index, sketch in enumerate(sketches):
+        if sketch is not None:
+            window_counts[positions[index]] += sketch._counts
+            total += sketch.count
+        leaving = index - window
+        if leaving >= 0 and sketches[leaving] is not None:
+            window_counts[positions[leaving]] -= sketches[leaving]._counts
+            total -= sketches[leaving].count
+        windowed = QuantileSketch(relative_error)
+        counted = window_counts > 0
+        windowed._keys = keys[counted]
+        windowed._counts = window_counts[counted]
+        windowed.count = total
+        yield windowed
+
+class QuantileSketch():
+    """Finds medians and other quantiles of a stream of prices without having
+    to keep hold of every price.
+
+    Prices are counted by key, and only the distinct keys and their counts are
+    stored. In exact mode the key is the price itself, so the quantiles are
+    exact and memory grows with the number of distinct prices (which, as
+    people like round numbers, is a lot smaller than the number of sales). If
+    a relative_error is given, prices are instead put into logarithmically
+    sized buckets, and every quantile is within that fraction of the true
+    value; there are only a few thousand possible buckets between 1 and a
+    billion pounds, so memory is bounded whatever happens.
+
+    Sketches with the same relative_error can be merged, so partial results
+    from separate workers (or from the DB) can be combined.
+
+    Public methods:
+    - __init__(relative_error) -- creates an empty sketch.
+    - keys_for(prices) -- the keys a list of prices would be counted under.
+    - add(prices) -- adds a list or array of prices.
+    - add_counts(keys, counts) -- adds prices which have already been keyed.
+    - merge(other) -- adds everything in another sketch.
+    - quantile(q), quantiles(qs), median() -- reads the results.
+    - mean() -- the average price.
+    - histogram(edges) -- the number of prices between each pair of edges.
+
+    Public variables:
+    - relative_error -- None for exact results, or the error bound.
+    - count -- the number of prices added.
+    """
+
+    # How many keys we'll collect before tidying them up.
+    _compact_threshold = 65536
+
+    def __init__(self, relative_error = None):
+        """Constructor.
+
+        relative_error should be None for exact quantiles, or a fraction
+        between 0 and 1 (e.g. 0.01 for 1%).
+        """
+        self.relative_error = relative_error
+        self.count = 0
+        self._keys = np.zeros(0, dtype = np.int64)
+        self._counts = np.zeros(0, dtype = np.int64)
+        self._pending_keys = []
+        self._pending_counts = []
+        self._pending = 0
+        if relative_error is not None:
+            self._gamma = (1 + relative_error) / (1 - relative_error)
+            self._log_gamma = math.log(self._gamma)
+
+    def keys_for(self, prices):
+        """Returns the keys that an array of prices would be counted under.
+
+        Prices are whole numbers of pounds, and should be positive if we're
+        bucketing.
+        """
+        prices = np.asarray(prices)
+        if self.relative_error is None:
+            return prices.astype(np.int64)
+        return np.ceil(np.log(prices) / self._log_gamma).astype(np.int64)
+
+    def add(self, prices):
+        """Adds a list or array of prices."""
+        keys, counts = np.unique(self.keys_for(prices), return_counts = True)
+        self.add_counts(keys, counts)
+
+    def add_counts(self, keys, counts):
+        """Adds prices which have already been turned into keys (see
+        keys_for), along with the number of prices under each key.
+        """
+        keys = np.asarray(keys, dtype = np.int64)
+        counts = np.asarray(counts, dtype = np.int64)
+        self._pending_keys.append(keys)
+        self._pending_counts.append(counts)
+        self._pending += len(keys)
+        self.count += int(counts.sum())
+        if self._pending > QuantileSketch._compact_threshold:
+            self._compact()
+
+    def merge(self, other):
+        """Adds everything from another sketch with the same relative_error."""
+        if other.relative_error != self.relative_error:
+            raise ValueError('Can only merge sketches with the same error')
+        other._compact()
+        self.add_counts(other._keys, other._counts)
+
+    def quantile(self, q):
+        """Returns quantile q (between 0 and 1) of the prices, or 0 if there
+        aren't any.
+
+        Quantiles between two prices are interpolated, so the median of an
+        even number of prices is the average of the middle two.
+        """
+        return self.quantiles([q])[0]
+
+    def quantiles(self, qs):
+        """Returns a list of quantiles, one for each q in qs."""
+        self._compact()
+        if self.count == 0:
+            return [0] * len(qs)
+        return _interpolate(self._values(), np.cumsum(self._counts) - 1,
+                            self.count, qs)
+
+    def median(self):
+        """Returns the median price."""
+        return self.quantile(0.5)
+
+    def mean(self):
+        """Returns the average price, or 0 if there aren't any.
+
+        If we're bucketing, each price counts as the middle of its bucket, so
+        this is within relative_error of the true average too.
+        """
+        self._compact()
+        if self.count == 0:
+            return 0
+        return float(np.dot(self._values(), self._counts)) / self.count
+
+    def histogram(self, edges):
+        """Returns a list of the number of prices in each bin, where bin i
+        runs from edges[i] up to (but not including) edges[i + 1].
+
+        If we're bucketing, each price counts as the middle of its bucket.
+        """
+        self._compact()
+        bins = np.searchsorted(edges, self._values(), side = 'right') - 1
+        inside = (bins >= 0) & (bins < len(edges) - 1)
+        return np.bincount(bins[inside], weights = self._counts[inside],
+                           minlength = len(edges) - 1).astype(np.int64) \
+                 .tolist()
+
+    def _values(self, keys = None):
+        """Returns the price each key (by default, each of ours) stands for."""
+        if keys is None:
+            keys = self._keys
+        if self.relative_error is None:
+            return keys.astype(np.float64)
+        return 2 * self._gamma ** keys / (self._gamma + 1)
+
+    def _compact(self):
+        """Folds the pending keys into the sorted, distinct key array."""
+        if not self._pending_keys:
+            return
+        keys = np.concatenate([self._keys] + self._pending_keys)
+        counts = np.concatenate([self._counts] + self._pending_counts)
+        self._keys, inverse = np.unique(keys, return_inverse = True)
+        self._counts = np.bincount(inverse, weights = counts) \
+                         .astype(np.int64)
+        self._pending_keys = []
+        self._pending_counts = []
+        self._pending = 0
+
+def _interpolate(values, last, count, qs):
+    """Returns a list of quantiles, one for each q in qs, of count prices.
+
+    values holds the price under each key in order, and last the index each
+    key's last price would have if every price were sorted.
+    """
+    results = []
+    for q in qs:
+        position = q * (count - 1)
+        lower = int(math.floor(position))
+        upper = int(math.ceil(position))
+        low_value = values[np.searchsorted(last, lower)]
+        high_value = values[np.searchsorted(last, upper)]
+        results.append(low_value +
+                       (high_value - low_value) * (position - lower))
+    return results
@@ -0,0 +1,335 @@
+#! /usr/bin/python
+
+""" Copyright 2014 Forrest Brennen
+
+    This file is part of price_picture.
+
+    price_picture is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    price_picture is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with price_picture.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import os
+import os.path
+from array import array
+from datetime import date
+from sys import argv, byteorder, exit
+
+import numpy as np
+
+import db_schemas as schemas
+import instrumentation
+from PriceMatrix import PriceMatrix, default_metrics
+from QuantileSketch import QuantileSketch
+
+"""
+SalesStore.py
+
+Every sale in one or more prices collections, packed into three flat arrays
+so that they can be sliced up in memory rather than queried:
+
+    days     the date of each sale, as days since the start of the first
+             year, in 16 bits
+    prices   the price of each sale, in 32 bits
+    starts   where each postcode prefix's sales start
+
+The sales are sorted by prefix and then date, and the prefixes themselves are
+kept once, in a sorted table, so a prefix's sales are one slice of the arrays
+and a year (or month) of them is a smaller slice inside that, found with a
+binary search. At six bytes a sale, the whole country comes to about 150MB.
+
+A store can be saved to a directory and loaded again, memory-mapped, in no
+time at all: nothing is read until it's used. The aggregates come out in the
+same form as PriceYear's, so a PriceMatrix can be built straight from them.
+"""
+
+# What the files in a saved store are called, and which version of the
+# layout they're in.
+header_filename = 'store.json'
+array_filenames = { 'days': 'days.npy', 'prices': 'prices.npy',
+                    'starts': 'starts.npy' }
+store_version = 1
+
+class SalesStore():
+    """Sales, packed into arrays and sorted by postcode prefix and date.
+
+    Public methods:
+    - from_collections(collections) -- reads the sales in some prices
+      collections.
+    - from_database(database, regions) -- reads the sales in every region
+      (or just those given).
+    - load(directory) -- memory-maps a saved store.
+    - __init__(prefixes, starts, days, prices, epoch) -- wraps some arrays.
+    - save(directory) -- writes the store out.
+    - sales(prefix, start, end) -- the dates and prices of a prefix's sales.
+    - price_sketches(startyear, endyear, prefixes, relative_error) -- the
+      sales summarised by year, as PriceYear.aggregate_price_sketches.
+    - monthly_price_sketches(startmonth, endmonth, prefixes, relative_error)
+      -- the same, by month.
+    - price_matrix(startyear, endyear, metrics, relative_error) -- a
+      PriceMatrix of the sales.
+
+    Public variables:
+    - prefixes -- the postcode prefixes, in sorted order.
+    - starts -- where each prefix's sales start in days and prices, with the
+      number of sales on the end.
+    - days -- the day of each sale, counted from epoch.
+    - prices -- the price of each sale.
+    - epoch -- the date days are counted from.
+    """
+
+    def __init__(self, prefixes, starts, days, prices, epoch):
+        """Constructor.
+
+        Use one of the from_* methods or load rather than calling this
+        directly.
+        """
+        self.prefixes = list(prefixes)
+        self.starts = starts
+        self.days = days
+        self.prices = prices
+        self.epoch = epoch
+        self._rows = dict((prefix, row)
+                          for row, prefix in enumerate(self.prefixes))
+
+    def __len__(self):
+        """Returns the number of sales."""
+        return len(self.prices)
+
+    @staticmethod
+    def from_collections(collections):
+        """Reads every sale in some prices collections into a SalesStore.
+
+        Only the date, price and district of each sale are read. They're
+        collected in compact arrays as they come in (10 bytes a sale), and
+        then packed into one 64 bit key a sale, which is sorted in place, so
+        the most memory needed is about 16 bytes a sale, under three times
+        that of the finished store.
+        """
+        codes = {}
+        prefix_codes = array('H')
+        ordinals = array('i')
+        prices = array('i')
+        with instrumentation.span('read_sales') as span:
+            for collection in collections:
+                for sale in collection.find({}, { '_id': 0, 'date': 1,
+                                                  'price': 1,
+                                                  'district': 1 }):
+                    code = codes.get(sale['district'])
+                    if code is None:
+                        code = codes[sale['district']] = len(codes)
+                    prefix_codes.append(code)
+                    ordinals.append(sale['date'].toordinal())
+                    prices.append(sale['price'])
+            span.set(rows = len(prices))
+        prefixes = sorted(codes)
+        if not prefixes:
+            return SalesStore([], np.zeros(1, dtype = np.int64),
+                              np.zeros(0, dtype = np.uint16),
+                              np.zeros(0, dtype = np.int32), date(1995, 1, 1))
+        with instrumentation.span('sort_sales', rows = len(prices)):
+            days = np.frombuffer(ordinals, dtype = np.int32)
+            epoch = date(date.fromordinal(int(days.min())).year, 1, 1)
+            days -= epoch.toordinal()
+            if days.max() > np.iinfo(np.uint16).max:
+                raise ValueError('Sales span too many years to store')
+            days = days.astype(np.uint16)
+            del ordinals
+            # Each sale becomes its prefix's row, its day and its price, in
+            # that order from the top bit down, so sorting the keys sorts the
+            # sales by prefix and date without any index arrays
+            ranks = np.zeros(len(codes), dtype = np.uint64)
+            ranks[[codes[prefix] for prefix in prefixes]] = \
+                np.arange(len(prefixes))
+            keys = ranks[np.frombuffer(prefix_codes, dtype = np.uint16)]
+            del prefix_codes
+            keys <<= 16
+            keys |= days
+            del days
+            keys <<= 32
+            keys |= np.frombuffer(prices, dtype = np.uint32)
+            del prices
+            keys.sort()
+            starts = np.searchsorted(
+                keys, np.arange(len(prefixes) + 1, dtype = np.uint64) << 48)
+            # The day and price are the third 16 bits and the last 32 bits of
+            # each key, wherever those fall in memory
+            words = keys.view(np.uint16).reshape(-1, 4)
+            halves = keys.view(np.int32).reshape(-1, 2)
+            if byteorder == 'little':
+                days, prices = words[:, 2].copy(), halves[:, 0].copy()
+            else:
+                days, prices = words[:, 1].copy(), halves[:, 1].copy()
+            return SalesStore(prefixes, starts.astype(np.int64), days,
+                              prices, epoch)
+
+    @staticmethod
+    def from_database(database, regions = None):
+        """Reads every sale in some regions (by default, all of them) into a
+        SalesStore.
+        """
+        if regions is None:
+            regions = schemas.price_regions(database)
+        return SalesStore.from_collections(
+            [schemas.prices_collection_for(database, region)
+             for region in regions])
+
+    @staticmethod
+    def load(directory):
+        """Loads a store saved with save. The arrays are memory-mapped, so
+        nothing is read until it's used.
+
+        Raises ValueError if the store was saved in a layout we don't know.
+        """
+        with open(os.path.join(directory, header_filename)) as header_file:
+            header = json.load(header_file)
+        if header['version'] != store_version:
+            raise ValueError('Unknown sales store version: %s' %
+                             header['version'])
+        arrays = dict((name, np.load(os.path.join(directory, filename),
+                                     mmap_mode = 'r'))
+                      for name, filename in array_filenames.iteritems())
+        return SalesStore([str(prefix) for prefix in header['prefixes']],
+                          arrays['starts'], arrays['days'], arrays['prices'],
+                          date.fromordinal(header['epoch']))
+
+    def save(self, directory):
+        """Writes the store out to a directory, which is created if need be.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name, filename in array_filenames.iteritems():
+            np.save(os.path.join(directory, filename), getattr(self, name))
+        # The header goes last, so a half-written store won't load
+        with open(os.path.join(directory, header_filename), 'w') as header:
+            json.dump({ 'version': store_version,
+                        'epoch': self.epoch.toordinal(),
+                        'prefixes': self.prefixes }, header)
+
+    def sales(self, prefix, start = None, end = None):
+        """Returns the sales in a prefix from start up to (but not including)
+        end, both dates, or all of them if they're not given.
+
+        Returns two arrays: the dates of the sales (as numpy datetime64s) and
+        their prices. The prices are a slice of the store, not a copy.
+        """
+        first, last = self._slice(prefix, self._day(start),
+                                  self._day(end))
+        dates = np.datetime64(self.epoch, 'D') + \
+                self.days[first:last].astype('timedelta64[D]')
+        return dates, self.prices[first:last]
+
+    def price_sketches(self, startyear, endyear, prefixes = None,
+                       relative_error = None):
+        """Summarises the sale prices for every postcode prefix (or just
+        those given) in every year from startyear to endyear inclusive.
+
+        Returns a dictionary mapping (year, prefix) to a QuantileSketch, just
+        as PriceYear.aggregate_price_sketches does.
+        """
+        years = range(int(startyear), int(endyear) + 2)
+        with instrumentation.span('store_price_sketches',
+                                  startyear = startyear,
+                                  endyear = endyear) as span:
+            return self._sketches(years[:-1],
+                                  [self._day(date(year, 1, 1))
+                                   for year in years],
+                                  prefixes, relative_error, span)
+
+    def monthly_price_sketches(self, startmonth, endmonth, prefixes = None,
+                               relative_error = None):
+        """Summarises the sale prices for every postcode prefix (or just
+        those given) in every month from startmonth to endmonth inclusive,
+        numbered as by PriceYear.month_number.
+
+        Returns a dictionary mapping (month number, prefix) to a
+        QuantileSketch.
+        """
+        months = range(int(startmonth), int(endmonth) + 2)
+        with instrumentation.span('store_monthly_price_sketches') as span:
+            return self._sketches(months[:-1],
+                                  [self._day(date(month // 12,
+                                                  month % 12 + 1, 1))
+                                   for month in months],
+                                  prefixes, relative_error, span)
+
+    def price_matrix(self, startyear, endyear, metrics = default_metrics,
+                     relative_error = None):
+        """Returns a PriceMatrix of the metrics (see PriceYear.metric_value)
+        for every prefix and year from startyear to endyear inclusive.
+        """
+        return PriceMatrix.from_sketches(
+            startyear, endyear,
+            self.price_sketches(startyear, endyear,
+                                relative_error = relative_error),
+            metrics)
+
+    def _sketches(self, periods, boundaries, prefixes, relative_error, span):
+        """Builds a QuantileSketch for each period and prefix with sales,
+        where period i runs from day boundaries[i] up to boundaries[i + 1].
+        As in PriceYear, sales with no price are left out.
+        """
+        if prefixes is None:
+            prefixes = self.prefixes
+        sketches = {}
+        sales = 0
+        for prefix in prefixes:
+            if prefix not in self._rows:
+                continue
+            first, last = self._slice(prefix, boundaries[0], boundaries[-1])
+            cuts = first + np.searchsorted(self.days[first:last],
+                                           boundaries[1:-1])
+            for period, start, end in zip(periods, [first] + list(cuts),
+                                          list(cuts) + [last]):
+                prices = self.prices[start:end]
+                prices = prices[prices > 0]
+                if len(prices):
+                    sketch = QuantileSketch(relative_error)
+                    sketch.add(prices)
+                    sketches[(period, prefix)] = sketch
+                    sales += len(prices)
+        span.set(rows = sales)
+        return sketches
+
+    def _day(self, when):
+        """Returns the day number of a date, or None for None. Days outside
+        what we can store are moved to the nearest end.
+        """
+        if when is None:
+            return None
+        return min(max(when.toordinal() - self.epoch.toordinal(), 0),
+                   np.iinfo(np.uint16).max + 1)
+
+    def _slice(self, prefix, first_day = None, last_day = None):
+        """Returns where a prefix's sales from first_day up to last_day
+        start and end in the arrays, or (0, 0) if we don't know it.
+        """
+        row = self._rows.get(prefix)
+        if row is None:
+            return 0, 0
+        first = int(self.starts[row])
+        last = int(self.starts[row + 1])
+        days = self.days[first:last]
+        if last_day is not None:
+            last = first + int(np.searchsorted(days, last_day))
+        if first_day is not None:
+            first = first + int(np.searchsorted(days, first_day))
+        return first, last
+
+if __name__ == '__main__':
+    if len(argv) < 2:
+        print 'Give us a directory to save the store in!'
+        exit()
+    store = SalesStore.from_database(schemas.connect(), argv[2:] or None)
+    store.save(argv[1])
+    print 'Saved %d sales in %d prefixes.' % (len(store), len(store.prefixes))
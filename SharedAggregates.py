@@ -0,0 +1,172 @@
+#! /usr/bin/python
+
+""" Copyright 2014 Forrest Brennen
+
+    This file is part of price_picture.
+
+    price_picture is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    price_picture is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with price_picture.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import mmap
+import os
+import os.path
+import struct
+import tempfile
+
+import numpy as np
+
+"""
+SharedAggregates.py
+
+Named segments of shared memory holding a set of arrays (and a few lists to
+go with them), so that the processes on one machine can share a single copy
+of what would otherwise be loaded into each of them separately: MapDisplay
+uses these for its postcode positions and price matrix.
+
+Each segment is a file in shared_dir (/dev/shm, where there is one, so it
+never touches the disk), laid out as:
+
+    magic           8 bytes, 'PPSHARED'
+    header length   8 bytes, little-endian
+    header          JSON: the layout version, a stamp saying what data the
+                    segment was built from, the lists, and the dtype, shape
+                    and offset of each array
+    arrays          one after another, each starting on a 64 byte boundary
+
+Segments are written to a temporary file and renamed into place, so nobody
+ever sees half of one, and anyone still using an old one keeps it until
+they're done. Attaching maps the file read-only: the arrays are views of the
+shared pages, never copies, so each extra process costs next to nothing.
+"""
+
+# Where segments live.
+shared_dir = '/dev/shm' if os.path.isdir('/dev/shm') \
+             else tempfile.gettempdir()
+
+# What every segment starts with, and the version of the layout after it.
+segment_magic = 'PPSHARED'
+segment_version = 1
+_prefix_format = '<8sQ'
+_alignment = 64
+
+class SharedAggregates():
+    """A segment of shared memory, attached read-only.
+
+    Public methods:
+    - publish(name, arrays, lists, stamp) -- writes a segment.
+    - attach(name, stamp) -- maps a segment, if there's an up to date one.
+    - remove(name) -- deletes a segment.
+
+    Public variables:
+    - name -- the name of the segment.
+    - stamp -- what the data in it was built from.
+    - arrays -- a dictionary of read-only arrays, backed by the segment.
+    - lists -- a dictionary of lists (of strings or numbers) stored with the
+      arrays.
+    """
+
+    def __init__(self, name, stamp, arrays, lists, segment):
+        """Constructor. Use attach rather than calling this directly."""
+        self.name = name
+        self.stamp = stamp
+        self.arrays = arrays
+        self.lists = lists
+        self._segment = segment
+
+    @staticmethod
+    def publish(name, arrays, lists, stamp):
+        """Writes a segment holding some arrays and lists (dictionaries of
+        each, keyed on name), replacing any other segment of the same name.
+        stamp can be anything JSON can hold, and is checked by attach.
+        """
+        layout = {}
+        offset = 0
+        arrays = dict((key, np.ascontiguousarray(value))
+                      for key, value in arrays.iteritems())
+        for key in sorted(arrays):
+            offset = _aligned(offset)
+            layout[key] = [arrays[key].dtype.str, list(arrays[key].shape),
+                           offset]
+            offset += arrays[key].nbytes
+        header = json.dumps({ 'version': segment_version, 'stamp': stamp,
+                              'lists': lists, 'arrays': layout })
+        start = _aligned(struct.calcsize(_prefix_format) + len(header))
+        filename = _filename(name)
+        temporary = '%s.%d.tmp' % (filename, os.getpid())
+        with open(temporary, 'wb') as segment:
+            segment.write(struct.pack(_prefix_format, segment_magic,
+                                      len(header)))
+            segment.write(header)
+            for key in sorted(arrays):
+                segment.seek(start + layout[key][2])
+                segment.write(arrays[key].tostring())
+            segment.truncate(start + offset)
+        os.rename(temporary, filename)
+
+    @staticmethod
+    def attach(name, stamp = None):
+        """Maps a segment read-only, and returns it as a SharedAggregates.
+
+        Returns None if there's no such segment, if it's in a layout we don't
+        know, or if a stamp is given and the segment's doesn't match it (i.e.
+        it was built from data which has changed since).
+        """
+        try:
+            with open(_filename(name), 'rb') as segment_file:
+                segment = mmap.mmap(segment_file.fileno(), 0,
+                                    access = mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return None
+        prefix_size = struct.calcsize(_prefix_format)
+        if len(segment) < prefix_size:
+            return None
+        magic, header_size = struct.unpack(_prefix_format,
+                                           segment[:prefix_size])
+        if magic != segment_magic:
+            return None
+        header = json.loads(segment[prefix_size:prefix_size + header_size])
+        if header['version'] != segment_version or \
+           (stamp is not None and
+            header['stamp'] != json.loads(json.dumps(stamp))):
+            return None
+        start = _aligned(prefix_size + header_size)
+        arrays = {}
+        for key, (dtype, shape, offset) in header['arrays'].iteritems():
+            dtype = np.dtype(str(dtype))
+            count = int(np.prod(shape))
+            arrays[str(key)] = np.frombuffer(segment, dtype = dtype,
+                                             count = count,
+                                             offset = start + offset) \
+                                 .reshape(shape)
+        return SharedAggregates(name, header['stamp'], arrays,
+                                dict((str(key), value) for key, value
+                                     in header['lists'].iteritems()),
+                                segment)
+
+    @staticmethod
+    def remove(name):
+        """Deletes a segment. Anyone attached to it can carry on using it."""
+        try:
+            os.remove(_filename(name))
+        except OSError:
+            pass
+
+def _filename(name):
+    """Returns the file a segment is kept in."""
+    return os.path.join(shared_dir, 'price_picture_' + name)
+
+def _aligned(offset):
+    """Rounds an offset up to the next _alignment boundary."""
+    return (offset + _alignment - 1) // _alignment * _alignment
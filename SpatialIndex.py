@@ -0,0 +1,143 @@
+#! /usr/bin/python
+
+""" Copyright 2014 Forrest Brennen
+
+    This file is part of price_picture.
+
+    price_picture is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    price_picture is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with price_picture.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import math
+
+import numpy as np
+
+"""
+SpatialIndex.py
+
+A uniform grid over a set of points (postcode centroids, in map coordinates),
+so that we can find the points in a rectangle, or the point nearest somewhere,
+without looking at all of them.
+
+The points are sorted by grid cell, row by row, and we keep where each cell
+starts. A row of cells is then a single slice of the sorted points, so a
+rectangle costs one slice per row it covers plus the points inside it, however
+many points there are elsewhere. For the few thousand centroids we have this
+does as well as a KD-tree, and it's all numpy.
+"""
+
+class SpatialIndex():
+    """Finds points by location.
+
+    Public methods:
+    - __init__(x, y, points_per_cell) -- indexes some points.
+    - within(xmin, ymin, xmax, ymax) -- the points inside a rectangle.
+    - nearest(x, y) -- the point closest to somewhere.
+
+    Public variables:
+    - x, y -- the coordinates of the points, as given.
+    - cell_size -- the width and height of a grid cell.
+    """
+
+    def __init__(self, x, y, points_per_cell = 4):
+        """Constructor.
+
+        The grid is sized so that there are about points_per_cell points in
+        each cell, on average.
+        """
+        self.x = np.asarray(x, dtype = np.float64)
+        self.y = np.asarray(y, dtype = np.float64)
+        count = len(self.x)
+        if count:
+            self._xmin, self._ymin = self.x.min(), self.y.min()
+            width = self.x.max() - self._xmin
+            height = self.y.max() - self._ymin
+        else:
+            self._xmin = self._ymin = width = height = 0.0
+        cells = max(1, count // points_per_cell)
+        self.cell_size = max(math.sqrt(width * height / cells),
+                             max(width, height) / cells, 1e-9)
+        self._columns = int(width // self.cell_size) + 1
+        self._rows = int(height // self.cell_size) + 1
+        cell = (self._cell_rows(self.y) * self._columns +
+                self._cell_columns(self.x))
+        self._order = np.argsort(cell, kind = 'mergesort')
+        self._starts = np.searchsorted(cell[self._order],
+                                       np.arange(self._columns * self._rows
+                                                 + 1))
+
+    def within(self, xmin, ymin, xmax, ymax):
+        """Returns the indices of the points inside a rectangle, in order."""
+        candidates = self._square(self._cell_columns(xmin),
+                                  self._cell_rows(ymin),
+                                  self._cell_columns(xmax),
+                                  self._cell_rows(ymax))
+        x = self.x[candidates]
+        y = self.y[candidates]
+        inside = (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+        return np.sort(candidates[inside])
+
+    def nearest(self, x, y):
+        """Returns the index of the point nearest (x, y), and its distance,
+        or (None, None) if there aren't any points.
+        """
+        if not len(self.x):
+            return None, None
+        column = int(math.floor((x - self._xmin) / self.cell_size))
+        row = int(math.floor((y - self._ymin) / self.cell_size))
+        # Widen the search until we find something, starting from the edge of
+        # the grid if we're outside it...
+        reach = max(0, -column, column - self._columns + 1,
+                    -row, row - self._rows + 1)
+        while True:
+            candidates = self._square(column - reach, row - reach,
+                                      column + reach, row + reach)
+            if len(candidates):
+                break
+            reach = max(1, reach * 2)
+        # ...then make sure nothing in the cells around is any closer
+        best = np.hypot(self.x[candidates] - x, self.y[candidates] - y).min()
+        reach = int(math.ceil(best / self.cell_size)) + 1
+        candidates = self._square(column - reach, row - reach,
+                                  column + reach, row + reach)
+        distances = np.hypot(self.x[candidates] - x, self.y[candidates] - y)
+        closest = distances.argmin()
+        return int(candidates[closest]), float(distances[closest])
+
+    def _cell_columns(self, x):
+        """Returns the grid column(s) of some x coordinate(s)."""
+        return np.clip(np.floor_divide(np.subtract(x, self._xmin),
+                                       self.cell_size).astype(np.intp),
+                       0, self._columns - 1)
+
+    def _cell_rows(self, y):
+        """Returns the grid row(s) of some y coordinate(s)."""
+        return np.clip(np.floor_divide(np.subtract(y, self._ymin),
+                                       self.cell_size).astype(np.intp),
+                       0, self._rows - 1)
+
+    def _square(self, first_column, first_row, last_column, last_row):
+        """Returns the indices of every point in a block of cells, which may
+        run off the edges of the grid.
+        """
+        first_column = max(int(first_column), 0)
+        last_column = min(int(last_column), self._columns - 1)
+        first_row = max(int(first_row), 0)
+        last_row = min(int(last_row), self._rows - 1)
+        if first_column > last_column or first_row > last_row:
+            return np.zeros(0, dtype = np.intp)
+        slices = [self._order[self._starts[row * self._columns + first_column]:
+                              self._starts[row * self._columns + last_column
+                                           + 1]]
+                  for row in range(first_row, last_row + 1)]
+        return np.concatenate(slices)
@@ -1,3 +1,7 @@
 #! /usr/bin/python
 
-__all__ = ['MapDisplay', 'PriceYear', 'db_schemas', 'data_setup']
+__all__ = ['AggregateCache', 'LocalStore', 'MapDisplay', 'MapGeometry',
+           'PriceLoader', 'PriceServer', 'PriceYear', 'PriceMatrix',
+           'QuantileSketch', 'SalesStore', 'SharedAggregates', 'SpatialIndex',
+           'db_schemas', 'district_locator', 'instrumentation', 'postcodes',
+           'data_setup']
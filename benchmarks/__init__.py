@@ -0,0 +1,3 @@
+#! /usr/bin/python
+
+__all__ = ['generate_data', 'run_benchmarks']
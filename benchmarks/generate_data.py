@@ -0,0 +1,177 @@
+#! /usr/bin/python
+
+""" Copyright 2014 Forrest Brennen
+
+    This file is part of price_picture.
+
+    price_picture is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    price_picture is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with price_picture.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os.path
+from sys import argv, exit
+
+import numpy as np
+
+"""
+generate_data.py
+
+Makes up price paid data and postcodes, in the same formats as the Land
+Registry's csv file and data_setup/oxcoords.csv, so the benchmarks have
+something to chew on at any size we like without downloading gigabytes.
+
+Everything is generated from a seed, so the same scale and seed always give
+the same files. Oxfordshire is always the first area, and sits where it
+should on the map; any others are scattered across the rest of the country.
+Each sale is given a real unit postcode from the postcode file, and prices
+rise by a few percent a year, so the medians look vaguely plausible.
+"""
+
+# Sales, postcode areas, districts per area and unit postcodes per district.
+# The national scale is roughly the size of the real thing.
+scales = { 'tiny': dict(sales = 10000, areas = 1, districts = 20,
+                        units = 50),
+           'small': dict(sales = 100000, areas = 1, districts = 20,
+                         units = 200),
+           'regional': dict(sales = 1000000, areas = 10, districts = 20,
+                            units = 300),
+           'national': dict(sales = 25000000, areas = 124, districts = 24,
+                            units = 600) }
+
+# The UK's postcode areas, starting with the one the map shows.
+areas = ('OX AB AL B BA BB BD BH BL BN BR BS BT CA CB CF CH CM CO CR CT CV CW '
+         'DA DD DE DG DH DL DN DT DY E EC EH EN EX FK FY G GL GU GY HA HD HG '
+         'HP HR HS HU HX IG IM IP IV JE KA KT KW KY L LA LD LE LL LN LS LU M '
+         'ME MK ML N NE NG NN NP NR NW OL PA PE PH PL PO PR RG RH RM S SA SE '
+         'SG SK SL SM SN SO SP SR SS ST SW SY TA TD TF TN TQ TR TS TW UB W WA '
+         'WC WD WF WN WR WS WV YO ZE').split()
+
+# Inward codes never use these letters
+_unit_letters = 'ABDEFGHJLNPQRSTUWXYZ'
+
+# Where the areas go: Oxford, and a box around the rest of Great Britain
+_oxford = (51.75, -1.25)
+_country = ((50.1, -5.5), (57.5, 1.6))
+
+# Sales are written this many at a time
+_batch = 100000
+
+def generate_postcodes(filename, scale = 'small', seed = 0):
+    """Writes every unit postcode for a scale, with made up coordinates, in
+    the oxcoords.csv layout. Returns the number of postcodes written.
+    """
+    shape = scales[scale]
+    random = np.random.RandomState(seed)
+    centres = _district_centres(shape, seed)
+    written = 0
+    with open(filename, 'w') as output:
+        for area_index in range(shape['areas']):
+            for district_index in range(shape['districts']):
+                lat, lon = centres[area_index, district_index]
+                lats = lat + random.normal(0, 0.01, shape['units'])
+                lons = lon + random.normal(0, 0.01, shape['units'])
+                for unit_index in range(shape['units']):
+                    output.write('%s,%s,%s\n' % (
+                        unit_postcode(area_index, district_index, unit_index),
+                        _dms(lats[unit_index], 'N', 'S'),
+                        _dms(lons[unit_index], 'E', 'W')))
+                    written += 1
+    return written
+
+def generate_sale_data(filename, scale = 'small', seed = 0,
+                       startyear = 1995, endyear = 2013):
+    """Writes sales for a scale, spread evenly over the years from startyear
+    to endyear, in the Land Registry's csv layout. Returns the number of
+    sales written.
+    """
+    shape = scales[scale]
+    random = np.random.RandomState(seed + 1)
+    district_factors = random.lognormal(0, 0.3,
+                                        (shape['areas'], shape['districts']))
+    written = 0
+    with open(filename, 'w') as output:
+        while written < shape['sales']:
+            count = min(_batch, shape['sales'] - written)
+            area_indices = random.randint(0, shape['areas'], count)
+            district_indices = random.randint(0, shape['districts'], count)
+            unit_indices = random.randint(0, shape['units'], count)
+            years = random.randint(startyear, endyear + 1, count)
+            months = random.randint(1, 13, count)
+            days = random.randint(1, 29, count)
+            prices = (60000 * 1.07 ** (years - startyear) *
+                      district_factors[area_indices, district_indices] *
+                      random.lognormal(0, 0.4, count)).astype(np.int64)
+            rows = []
+            for i in range(count):
+                rows.append('"{%08X-0000-0000-0000-%012X}","%d",'
+                            '"%04d-%02d-%02d 00:00","%s","D","N","F","1","",'
+                            '"HIGH STREET","","TOWN","DISTRICT","COUNTY"\n' %
+                            (seed, written + i, prices[i], years[i],
+                             months[i], days[i],
+                             unit_postcode(area_indices[i],
+                                           district_indices[i],
+                                           unit_indices[i])))
+            output.writelines(rows)
+            written += count
+    return written
+
+def unit_postcode(area_index, district_index, unit_index):
+    """Returns the made up postcode for a unit, e.g. 'OX3 2AB'."""
+    sector = unit_index % 10
+    letters = unit_index // 10
+    return '%s%d %d%s%s' % (areas[area_index], district_index + 1, sector,
+                            _unit_letters[letters // len(_unit_letters) %
+                                          len(_unit_letters)],
+                            _unit_letters[letters % len(_unit_letters)])
+
+def _district_centres(shape, seed):
+    """Returns an (areas, districts, 2) array of district (lat, lon)s."""
+    random = np.random.RandomState(seed + 2)
+    (min_lat, min_lon), (max_lat, max_lon) = _country
+    area_centres = np.column_stack(
+        (random.uniform(min_lat, max_lat, shape['areas']),
+         random.uniform(min_lon, max_lon, shape['areas'])))
+    area_centres[0] = _oxford
+    offsets = random.uniform(-0.25, 0.25,
+                             (shape['areas'], shape['districts'], 2))
+    return area_centres[:, np.newaxis, :] + offsets
+
+def _dms(degrees, positive, negative):
+    """Formats decimal degrees as 'degrees,minutes,seconds,direction'."""
+    direction = positive if degrees >= 0 else negative
+    degrees = abs(degrees)
+    whole = int(degrees)
+    minutes = int((degrees - whole) * 60)
+    seconds = (degrees - whole - minutes / 60.0) * 3600
+    return '%d,%d,%.3f,%s' % (whole, minutes, seconds, direction)
+
+def data_files(directory, scale, seed = 0):
+    """Returns the names of the postcode and sale files for a scale, making
+    them first if they aren't in directory already.
+    """
+    postcode_file = os.path.join(directory,
+                                 'postcodes_%s_%d.csv' % (scale, seed))
+    sale_file = os.path.join(directory, 'sales_%s_%d.csv' % (scale, seed))
+    if not os.path.isfile(postcode_file):
+        generate_postcodes(postcode_file, scale, seed)
+    if not os.path.isfile(sale_file):
+        generate_sale_data(sale_file, scale, seed)
+    return postcode_file, sale_file
+
+if __name__ == '__main__':
+    if len(argv) < 3 or argv[1] not in scales:
+        print 'Usage: generate_data.py <%s> <directory> [seed]' % \
+            '|'.join(sorted(scales))
+        exit()
+    seed = int(argv[3]) if len(argv) > 3 else 0
+    print 'Wrote %s and %s.' % data_files(argv[2], argv[1], seed)
@@ -0,0 +1,362 @@
+#! /usr/bin/python
+
+""" Copyright 2014 Forrest Brennen
+
+    This file is part of price_picture.
+
+    price_picture is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    price_picture is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with price_picture.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import os
+import os.path
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from sys import argv, exit
+
+# Frames are only ever drawn off screen here
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plotter
+import numpy as np
+
+from .. import db_schemas as schemas
+from .. import instrumentation
+from ..AggregateCache import AggregateCache
+from ..MapDisplay import MapDisplay, _init_frame_worker, _render_frame, \
+                         highres_map_options
+from ..MapGeometry import MapGeometry, _load_pyproj
+from ..PriceMatrix import PriceMatrix, price_year_range
+from ..SalesStore import SalesStore
+from ..SharedAggregates import SharedAggregates
+from ..data_setup.coarsify_postcodes import coarsify
+from ..data_setup.import_postcodes import bulk_import_postcodes, \
+                                         import_postcodes
+from ..data_setup.import_sale_data import bulk_import_sale_data, \
+                                         import_sale_data, _peak_memory_mb
+from .generate_data import data_files, scales
+
+"""
+run_benchmarks.py
+
+Times the hot paths, from importing the csv files to drawing frames, against
+data made up by generate_data, and writes the results out as JSON so that
+runs can be compared:
+
+    python -m price_picture.benchmarks.run_benchmarks small results.json
+    python -m price_picture.benchmarks.run_benchmarks small new.json \
+        --compare results.json
+
+Everything runs against a fresh database, in the embedded backend unless
+--backend mongodb is given, so nothing already in price_picture is touched.
+The map is a made up MapGeometry covering the usual Oxfordshire box, so no
+Basemap is needed either, and frames are drawn with Agg.
+
+Each result records the wall-clock seconds taken and, where it makes sense,
+the number of items dealt with. Anything more than tolerance slower than the
+baseline counts as a regression when comparing.
+"""
+
+# The per-row importer is only timed up to this many sales, as it's slow.
+per_row_limit = 200000
+
+# How much slower than the baseline something has to be to count as a
+# regression.
+tolerance = 0.2
+
+startyear = 1996
+endyear = 2013
+
+def run_benchmarks(scale = 'small', output = None, backend = 'local',
+                   directory = None, processes = None, seed = 0):
+    """Runs every benchmark at a scale, and returns the results.
+
+    Generated data is kept in directory (and reused next time with the same
+    scale and seed) if one is given; otherwise it's thrown away afterwards.
+    The results are also written to output, if given.
+    """
+    keep = directory is not None
+    if not keep:
+        directory = tempfile.mkdtemp()
+    elif not os.path.isdir(directory):
+        os.makedirs(directory)
+    timings = []
+    try:
+        with _timer(timings, 'generate_data', scales[scale]['sales']):
+            postcode_file, sale_file = data_files(directory, scale, seed)
+        database = _fresh_database(backend, directory, 'benchmark')
+        _time_imports(timings, database, postcode_file, sale_file, processes,
+                      scale, backend, directory)
+        _time_price_years(timings, database)
+        _time_sales_store(timings, database, directory)
+        _time_frames(timings, database, directory)
+    finally:
+        if not keep:
+            shutil.rmtree(directory)
+
+    results = { 'scale': scale,
+                'seed': seed,
+                'backend': backend,
+                'processes': processes,
+                'timestamp': datetime.utcnow().isoformat(),
+                'revision': _revision(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'benchmarks': timings }
+    if output is not None:
+        with open(output, 'w') as results_file:
+            json.dump(results, results_file, indent = 1, sort_keys = True)
+    return results
+
+def compare_results(baseline, results):
+    """Prints how each benchmark has changed since a baseline set of results,
+    and returns the names of any which have got slower by more than
+    tolerance.
+    """
+    before = dict((timing['name'], timing['seconds'])
+                  for timing in baseline['benchmarks'])
+    regressions = []
+    for timing in results['benchmarks']:
+        name = timing['name']
+        if name not in before or before[name] <= 0:
+            print '%-28s %10.3fs' % (name, timing['seconds'])
+            continue
+        ratio = timing['seconds'] / before[name]
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print '%-28s %10.3fs  (was %.3fs, x%.2f)%s' % \
+            (name, timing['seconds'], before[name], ratio, flag)
+    return regressions
+
+def _time_imports(timings, database, postcode_file, sale_file, processes,
+                  scale, backend, directory):
+    """Times importing the postcodes and sales, and coarsifying."""
+    sales = scales[scale]['sales']
+    postcodes = database[schemas.input_postcode_collection_name]
+    with _timer(timings, 'bulk_import_postcodes', _lines(postcode_file)):
+        bulk_import_postcodes(postcodes, postcode_file,
+                              centroid_database = database)
+    with _timer(timings, 'coarsify', postcodes.count()):
+        coarsify(postcodes, database)
+    with _timer(timings, 'bulk_import_sale_data', sales):
+        bulk_import_sale_data(database, sale_file, processes)
+    # Peaks over the whole run so far, but the bulk import should dominate
+    main, worker = _peak_memory_mb()
+    timings[-1]['peak_memory_mb'] = { 'main': main, 'largest_worker': worker }
+    print '%-28s %10.1fMB (largest worker %.1fMB)' % \
+        ('  peak memory', main, worker)
+    if sales <= per_row_limit:
+        per_row = _fresh_database(backend, directory, 'benchmark_per_row')
+        with _timer(timings, 'import_postcodes', _lines(postcode_file)):
+            import_postcodes(per_row[schemas.input_postcode_collection_name],
+                             postcode_file, centroid_database = per_row)
+        with _timer(timings, 'import_sale_data', sales):
+            import_sale_data(per_row, sale_file)
+
+def _time_price_years(timings, database):
+    """Times building the PriceYears for the usual range of years, straight
+    from the DB and through the AggregateCache.
+    """
+    prices = schemas.prices_collection_for(database, MapDisplay.region)
+    years = endyear + 1 - startyear
+    with _timer(timings, 'price_year_range', years):
+        price_year_range(startyear, endyear, prices)
+    with _timer(timings, 'price_matrix_approximate', years):
+        PriceMatrix.from_collection(prices, startyear, endyear,
+                                    relative_error = 0.01)
+    with _timer(timings, 'price_matrix_all_metrics', years):
+        PriceMatrix.from_collection(prices, startyear, endyear,
+                                    metrics = ('median', 'mean', 'q25', 'q75',
+                                               'histogram'))
+    with _timer(timings, 'price_matrix_rolling_months', years * 12):
+        PriceMatrix.from_months(prices, startyear, endyear, window = 12)
+    cache = AggregateCache(database[schemas.aggregate_cache_collection_name],
+                           database[schemas.watermark_collection_name])
+    with _timer(timings, 'price_matrix_cache_cold', years):
+        PriceMatrix.from_cache(cache, prices, MapDisplay.region, startyear,
+                               endyear)
+    with _timer(timings, 'price_matrix_cache_warm', years):
+        PriceMatrix.from_cache(cache, prices, MapDisplay.region, startyear,
+                               endyear)
+
+def _time_sales_store(timings, database, directory):
+    """Times packing the sales into a SalesStore, loading it back, and
+    building a PriceMatrix from it.
+    """
+    sales = schemas.prices_collection_for(database, MapDisplay.region).count()
+    with _timer(timings, 'sales_store_build', sales):
+        store = SalesStore.from_database(database)
+    store_directory = os.path.join(directory, 'sales_store')
+    store.save(store_directory)
+    with _timer(timings, 'sales_store_load', sales):
+        store = SalesStore.load(store_directory)
+    with _timer(timings, 'sales_store_price_matrix', endyear + 1 - startyear):
+        store.price_matrix(startyear, endyear)
+    shutil.rmtree(store_directory)
+
+def _time_frames(timings, database, directory):
+    """Times setting up a MapDisplay and drawing frames, both as the export
+    does (a full render per frame) and as the window does (blitting).
+    """
+    themap = _synthetic_geometry(os.path.join(directory, 'map'))
+    # Start cold, as the first frame is what the loader is there to speed up
+    database[schemas.aggregate_cache_collection_name].remove()
+    with _timer(timings, 'first_frame'):
+        with _timer(timings, 'map_display_setup'):
+            display = MapDisplay(startyear, endyear, database, themap)
+        display.price_year(startyear)
+    frames = len(display.price_matrix.years)
+    with _timer(timings, 'load_years', frames):
+        for year in display.price_matrix.years:
+            display.price_year(year)
+    SharedAggregates.remove(display._segment_name(database))
+    with _timer(timings, 'map_display_shared_publish'):
+        MapDisplay(startyear, endyear, database, themap, shared = True)
+    with _timer(timings, 'map_display_shared_attach'):
+        MapDisplay(startyear, endyear, database, themap, shared = True)
+    SharedAggregates.remove(display._segment_name(database))
+
+    dpi = 100
+    with _timer(timings, 'render_background'):
+        background, xlim, ylim = display._render_background(dpi)
+    frame_directory = os.path.join(directory, 'frames')
+    if not os.path.isdir(frame_directory):
+        os.makedirs(frame_directory)
+    _init_frame_worker(background, dpi, xlim, ylim, frame_directory)
+    with _timer(timings, 'export_frame', frames, per_item = True):
+        for index, year in enumerate(display.price_matrix.years):
+            xy, sizes, colors = display._frame_data(index)
+            filename, spans = _render_frame((index, xy, sizes, colors, year))
+            instrumentation.merge(spans)
+
+    fig = plotter.figure(figsize = (10, 12))
+    fig.add_axes([0.0, 0.0, 0.82, 1.0])
+    display._init_animate()
+    fig.canvas.draw()
+    saved = fig.canvas.copy_from_bbox(fig.bbox)
+    with _timer(timings, 'blit_frame', frames, per_item = True):
+        for frame in range(frames):
+            display._animate(frame)
+            fig.canvas.restore_region(saved)
+            display._draw_frame_artists()
+            fig.canvas.blit(fig.bbox)
+    plotter.close(fig)
+
+def _synthetic_geometry(directory):
+    """Makes a MapGeometry for the usual map box, with a few wiggly lines
+    standing in for the rivers.
+    """
+    options = highres_map_options
+    proj = _load_pyproj().Proj(proj = 'tmerc', lat_0 = options['lat_0'],
+                               lon_0 = options['lon_0'], ellps = 'WGS84',
+                               units = 'm')
+    llcrnrx, llcrnry = proj(options['llcrnrlon'], options['llcrnrlat'])
+    urcrnrx, urcrnry = proj(options['urcrnrlon'], options['urcrnrlat'])
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    random = np.random.RandomState(0)
+    rivers = [np.cumsum(random.normal(200, 400, (500, 2)), axis = 0) +
+              random.uniform(0, 20000, 2) for river in range(20)]
+    np.save(os.path.join(directory, 'river_points.npy'),
+            np.concatenate(rivers))
+    np.save(os.path.join(directory, 'river_starts.npy'),
+            np.arange(0, 500 * len(rivers), 500, dtype = np.int64))
+    with open(os.path.join(directory, 'projection.json'), 'w') as params:
+        json.dump({ 'projparams': proj.srs,
+                    'llcrnrx': llcrnrx, 'llcrnry': llcrnry,
+                    'xmax': urcrnrx - llcrnrx, 'ymax': urcrnry - llcrnry },
+                  params)
+    return MapGeometry(directory)
+
+def _fresh_database(backend, directory, name):
+    """Returns an empty database to run the benchmarks against."""
+    if backend == 'local':
+        from ..LocalStore import LocalDatabase
+        path = os.path.join(directory, name + '.sqlite')
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        return LocalDatabase(path)
+    from pymongo import MongoClient
+    client = MongoClient()
+    client.drop_database(schemas.db_name + '_' + name)
+    return client[schemas.db_name + '_' + name]
+
+@contextmanager
+def _timer(timings, name, items = None, per_item = False):
+    """Times the code inside it and adds the result to timings.
+
+    The importers are chatty, so anything they print is thrown away.
+    """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    started = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - started
+        sys.stdout.close()
+        sys.stdout = stdout
+    timing = { 'name': name, 'seconds': elapsed }
+    if items:
+        timing['items'] = items
+        timing['items_per_second'] = items / elapsed if elapsed else None
+        if per_item:
+            # For frames, what we care about is the time for each one
+            timing['seconds'] = elapsed / items
+            timing['total_seconds'] = elapsed
+    timings.append(timing)
+    print '%-28s %10.3fs' % (name, timing['seconds'])
+
+def _lines(filename):
+    """Counts the lines in a file."""
+    with open(filename, 'rb') as lines:
+        return sum(1 for line in lines)
+
+def _revision():
+    """Returns the git commit being benchmarked, if we can tell."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd = os.path.dirname(os.path.abspath(__file__)),
+            stderr = open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == '__main__':
+    if len(argv) < 2 or argv[1] not in scales:
+        print 'Usage: run_benchmarks.py <%s> [output.json] [--compare ' \
+              'baseline.json] [--backend local|mongodb] [--data directory] ' \
+              '[--processes n]' % '|'.join(sorted(scales))
+        exit()
+    options = dict(zip(argv[2::1], argv[3::1]))
+    output = argv[2] if len(argv) > 2 and not argv[2].startswith('--') \
+             else None
+    processes = options.get('--processes')
+    results = run_benchmarks(argv[1], output,
+                             backend = options.get('--backend', 'local'),
+                             directory = options.get('--data'),
+                             processes = processes and int(processes))
+    if '--compare' in options:
+        with open(options['--compare']) as baseline:
+            if compare_results(json.load(baseline), results):
+                exit(1)
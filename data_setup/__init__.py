@@ -1,3 +1,5 @@
 #! /usr/bin/python
 
-__all__ = ['coarsify_postcodes', 'import_postcodes', 'import_sale_data']
+__all__ = ['centroids', 'checkpoints', 'coarsify_postcodes',
+           'import_postcodes', 'import_sale_data', 'import_updates',
+           'partition_prices']
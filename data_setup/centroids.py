@@ -0,0 +1,196 @@
+#! /usr/bin/python
+
+""" Copyright 2014 Forrest Brennen
+
+    This file is part of price_picture.
+
+    price_picture is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    price_picture is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with price_picture.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+from .. import db_schemas as schemas
+from .. import postcodes
+
+"""
+centroids.py
+
+Works out where each postcode area, district and sector is, as the average
+position of the unit postcodes inside it, in a single pass over whatever's
+being read. The importer feeds in each postcode as it goes, so there's no
+need to go back over the DB afterwards.
+
+Each level is saved as a small lookup table of its own (see
+db_schemas.centroid_collection_names), one document per area, district or
+sector in the shape MapDisplay reads: { _id: 'OX1', value: { lat, long,
+count } }. Because the count is kept, a new batch of postcodes can be merged
+into the tables without knowing anything about the ones already there.
+
+An importer can tag each batch it merges, and each document remembers the
+last tag merged into it, so that merging a batch again (after being killed
+before it could checkpoint the batch, say) doesn't count it twice.
+"""
+
+# The levels we build centroids for, largest first.
+levels = ('area', 'district', 'sector')
+
+class CentroidBuilder():
+    """Accumulates count-weighted centroids at every level.
+
+    Public methods:
+    - add(postcode, lat, lon) -- adds a unit postcode.
+    - add_arrays(postcodes, lats, lons) -- adds a lot of them at once.
+    - merge(other) -- adds everything from another CentroidBuilder.
+    - centroids(level) -- the centroids found so far.
+    - save(database) -- replaces the lookup tables with these centroids.
+    - merge_into(database, tag) -- adds these centroids to the lookup
+      tables.
+    - clear() -- forgets everything.
+
+    Public variables:
+    - count -- the number of postcodes added.
+    """
+
+    def __init__(self):
+        """Constructor."""
+        self.clear()
+
+    def add(self, postcode, lat, lon):
+        """Adds a unit postcode at the given GPS coordinates.
+
+        Returns False (and adds nothing) if it isn't a valid postcode.
+        """
+        parts = postcodes.split(postcode)
+        if parts is None:
+            return False
+        for totals, code in zip(self._totals, parts):
+            total = totals.get(code)
+            if total is None:
+                totals[code] = [lat, lon, 1]
+            else:
+                total[0] += lat
+                total[1] += lon
+                total[2] += 1
+        self.count += 1
+        return True
+
+    def add_arrays(self, unit_postcodes, lats, lons):
+        """Adds a list of unit postcodes, with arrays of their GPS coordinates.
+
+        Each level's totals are summed over the arrays before they're added,
+        so this only touches each area, district and sector once. Returns the
+        number of valid postcodes added.
+        """
+        parts = [postcodes.split(postcode) for postcode in unit_postcodes]
+        valid = [i for i, part in enumerate(parts) if part is not None]
+        if not valid:
+            return 0
+        lats = np.asarray(lats, dtype = np.float64)[valid]
+        lons = np.asarray(lons, dtype = np.float64)[valid]
+        for index, level in enumerate(levels):
+            codes, inverse = np.unique([parts[i][index] for i in valid],
+                                       return_inverse = True)
+            lat_totals = np.bincount(inverse, weights = lats)
+            lon_totals = np.bincount(inverse, weights = lons)
+            counts = np.bincount(inverse)
+            for code, lat, lon, count in zip(codes.tolist(),
+                                             lat_totals.tolist(),
+                                             lon_totals.tolist(),
+                                             counts.tolist()):
+                self._add_total(level, code, lat, lon, count)
+        self.count += len(valid)
+        return len(valid)
+
+    def merge(self, other):
+        """Adds everything from another CentroidBuilder."""
+        for level in levels:
+            for code, (lat, lon, count) in \
+                    other._totals[levels.index(level)].iteritems():
+                self._add_total(level, code, lat, lon, count)
+        self.count += other.count
+
+    def centroids(self, level):
+        """Returns a dictionary of code -> (lat, long, count) for a level."""
+        return dict((code, (lat / count, lon / count, count))
+                    for code, (lat, lon, count)
+                    in self._totals[levels.index(level)].iteritems())
+
+    def save(self, database):
+        """Replaces the lookup tables in database with these centroids."""
+        for level in levels:
+            collection = database[schemas.centroid_collection_names[level]]
+            collection.remove()
+            documents = [_document(code, lat, lon, count)
+                         for code, (lat, lon, count)
+                         in self.centroids(level).iteritems()]
+            if documents:
+                collection.insert(documents)
+
+    def merge_into(self, database, tag = None):
+        """Adds these centroids to whatever is in the lookup tables already,
+        weighting each by its count.
+
+        If a tag is given, it's recorded in every document merged into, and
+        any document already carrying it is left alone, as it has had these
+        centroids added already.
+        """
+        for level in levels:
+            collection = database[schemas.centroid_collection_names[level]]
+            centroids = self.centroids(level)
+            if not centroids:
+                continue
+            merged = CentroidBuilder()
+            for existing in collection.find({ '_id': { '$in':
+                                                       centroids.keys() } }):
+                if tag is not None and existing.get('merged') == tag:
+                    del centroids[existing['_id']]
+                    continue
+                value = existing['value']
+                merged._add_total(level, existing['_id'],
+                                  value['lat'] * value['count'],
+                                  value['long'] * value['count'],
+                                  value['count'])
+            if not centroids:
+                continue
+            for code, (lat, lon, count) in centroids.iteritems():
+                merged._add_total(level, code, lat * count, lon * count, count)
+            bulk = collection.initialize_unordered_bulk_op()
+            for code, (lat, lon, count) in \
+                    merged.centroids(level).iteritems():
+                bulk.find({ '_id': code }).upsert() \
+                    .replace_one(_document(code, lat, lon, count, tag))
+            bulk.execute()
+
+    def clear(self):
+        """Forgets everything added so far."""
+        self._totals = tuple({} for level in levels)
+        self.count = 0
+
+    def _add_total(self, level, code, lat, lon, count):
+        """Adds already-summed coordinates for count postcodes to a code."""
+        totals = self._totals[levels.index(level)]
+        total = totals.setdefault(code, [0.0, 0.0, 0])
+        total[0] += lat
+        total[1] += lon
+        total[2] += count
+
+def _document(code, lat, lon, count, tag = None):
+    """Returns the lookup table entry for a centroid, tagged with the last
+    batch merged into it, if any.
+    """
+    document = { '_id': code,
+                 'value': { 'lat': lat, 'long': lon, 'count': count } }
+    if tag is not None:
+        document['merged'] = tag
+    return document
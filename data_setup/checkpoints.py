@@ -0,0 +1,152 @@
+#! /usr/bin/python
+
+""" Copyright 2014 Forrest Brennen
+
+    This file is part of price_picture.
+
+    price_picture is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    price_picture is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with price_picture.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import os.path
+
+"""
+checkpoints.py
+
+Our input files are big, so the importers read them in chunks and remember
+which chunks made it into the DB. If an import dies partway through we can
+pick up from the first chunk that didn't, and re-running an import of a file
+we've already finished with barely has to touch it.
+"""
+
+# Roughly how much of a file we deal with at a time.
+chunk_bytes = 16 * 1024 * 1024
+
+def read_chunks(csv_file, size = None, start = 0):
+    """Reads a file in chunks of roughly size bytes, without splitting lines.
+
+    Reading begins at byte offset start, which should be the beginning of a
+    line. Yields (start offset, end offset, data) for each chunk.
+    """
+    if size is None:
+        size = chunk_bytes
+    with open(csv_file, 'rb') as csv_input:
+        csv_input.seek(start)
+        while True:
+            data = csv_input.read(size)
+            if not data:
+                break
+            if not data.endswith('\n'):
+                data += csv_input.readline()
+            end = start + len(data)
+            yield start, end, data
+            start = end
+
+def chunk_digest(data):
+    """Returns the content hash we record for a chunk."""
+    return hashlib.sha1(data).hexdigest()
+
+class ImportCheckpoints():
+    """Keeps track of which chunks of an input file have been imported.
+
+    Every committed chunk gets a document in the metadata collection recording
+    its byte offsets and a hash of its contents. Chunks are committed in file
+    order, so everything up to resume_offset() is known to be in the DB.
+
+    Public methods:
+    - __init__(collection, csv_file, target_name, regions) -- sets up
+      checkpointing for a file.
+    - resume_offset() -- where to start reading the file from.
+    - commit(start, end, digest, rows) -- records a chunk as imported.
+    - chunk_id(start) -- identifies the chunk starting at start.
+    - clear() -- forgets everything about this file.
+
+    Public variables:
+    - source -- identifies the file, the collection it's imported into and
+      the regions kept.
+    """
+
+    def __init__(self, collection, csv_file, target_name, regions = None):
+        """Constructor.
+
+        Accepts the metadata collection to keep checkpoints in, the file being
+        imported, and the name of the collection it's going into (so the same
+        file can be imported into different places).
+
+        If the import only keeps some regions, they're given as regions, and
+        the checkpoints only count for imports of the same regions: having
+        imported a file's OX sales tells us nothing about its SW ones.
+        """
+        self._collection = collection
+        self._csv_file = csv_file
+        if regions is not None:
+            target_name += '[%s]' % ','.join(sorted(regions))
+        self.source = target_name + ':' + os.path.abspath(csv_file)
+        self._collection.ensure_index([('source', 1), ('start', 1)])
+
+    def resume_offset(self):
+        """Returns the end of the last chunk known to be imported.
+
+        The last committed chunk is re-read and its hash checked, so if the
+        file has been changed underneath us we start again from the beginning
+        (which is safe, as the imports skip duplicates). Unchanged files don't
+        get read any further than that.
+        """
+        offset = 0
+        last = None
+        for checkpoint in self._collection.find({ 'source': self.source }) \
+                                          .sort('start', 1):
+            if checkpoint['start'] != offset:
+                break
+            offset = checkpoint['end']
+            last = checkpoint
+        if last is None:
+            return 0
+        if not self._unchanged(last):
+            print 'Input file has changed since the last import, restarting.'
+            self.clear()
+            return 0
+        return offset
+
+    def commit(self, start, end, digest, rows):
+        """Records that the chunk from start to end, with the given
+        chunk_digest, has been imported.
+
+        Should only be called once everything in the chunk is in the DB.
+        """
+        self._collection.save({ '_id': self.chunk_id(start),
+                                'source': self.source,
+                                'start': start,
+                                'end': end,
+                                'hash': digest,
+                                'rows': rows })
+
+    def chunk_id(self, start):
+        """Returns a name for the chunk starting at start, unique to this
+        import, which importers can tag what they write with.
+        """
+        return '%s@%d' % (self.source, start)
+
+    def clear(self):
+        """Removes all checkpoints for this file."""
+        self._collection.remove({ 'source': self.source })
+
+    def _unchanged(self, checkpoint):
+        """Checks that a committed chunk still matches the file."""
+        if os.path.getsize(self._csv_file) < checkpoint['end']:
+            return False
+        with open(self._csv_file, 'rb') as csv_input:
+            csv_input.seek(checkpoint['start'])
+            data = csv_input.read(checkpoint['end'] - checkpoint['start'])
+        return chunk_digest(data) == checkpoint['hash']
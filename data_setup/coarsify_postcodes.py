@@ -18,43 +18,25 @@
     along with price_picture.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from pymongo import MongoClient
-from bson import Code
-
 from .. import db_schemas as schemas
+from .centroids import CentroidBuilder
 
-# We've got very detailed postcode data, but are more interested in a larger
-# scale for now, so we'll aggregate everything under the first bit of the
-# postcode, and average the coordinates together.
+# The postcode centroids are normally worked out by import_postcodes as it
+# goes (see centroids.py), but if they've got out of step with the postcodes
+# in the DB, this rebuilds every level of them from scratch in one pass.
 
-def coarsify(input_collection, output_collection_name):
-    """Averages together the GPS coordiantes for postcodes under a single prefix,
-    and saves them to another collection.
+def coarsify(input_collection, database):
+    """Works out the centroids of every postcode area, district and sector
+    from the postcodes in input_collection, and replaces the lookup tables in
+    database with them.
     """
-    # TODO: This map won't work properly for a few postcodes, such as those
-    # with single-letter initial designators. Will work for OX* for now tho!
-    themap = Code("function () {"
-                  "  emit(this.postcode.substring(0,4).trim(),"
-                  "       { lat:this.lat, long:this.long, count:1 });"
-                  "}")
-    thereduce = Code("function(key, values) {"
-                     "  lattotal = 0;"
-                     "  longtotal = 0;"
-                     "  count = 0;" # So we can reduce multiple times per key
-                     "  for(i in values) {"
-                     "    lattotal += values[i].lat * values[i].count;"
-                     "    longtotal += values[i].long * values[i].count;"
-                     "    count += values[i].count;"
-                     "  }"
-                     "  return { 'lat': lattotal / count,"
-                     "           'long': longtotal / count,"
-                     "           'count': count };"
-                     "}")
-    input_collection.map_reduce(themap, thereduce, output_collection_name)
+    builder = CentroidBuilder()
+    for entry in input_collection.find({}, { 'postcode': 1, 'lat': 1,
+                                             'long': 1 }):
+        builder.add(entry['postcode'], entry['lat'], entry['long'])
+    builder.save(database)
     
 if __name__ == '__main__':
-    client = MongoClient();
-    database = client[schemas.db_name]
+    database = schemas.connect()
     collection = database[schemas.input_postcode_collection_name]
-    output_collection_name = schemas.postcode_collection_name
-    coarsify(collection, output_collection_name)
+    coarsify(collection, database)
@@ -19,17 +19,26 @@
 """
 
 import csv
+import os.path
+import time
 from sys import argv, exit
 
-from pymongo import MongoClient, errors
+import numpy as np
+from pymongo import errors
 
 from .. import db_schemas as schemas
+from .. import instrumentation
+from .. import postcodes
+from .centroids import CentroidBuilder
+from .checkpoints import ImportCheckpoints, chunk_digest, read_chunks
+from .import_sale_data import _bulk_insert, _report_progress, batch_size
 
 """
 import_postcodes.py
 
-This processes a list of full postcodes and dumps them into a DB. You'll want
-to call coarsify_postcodes after this to merge them together.
+This processes a list of full postcodes and dumps them into a DB. As it goes,
+it works out the centroids of every postcode area, district and sector (see
+centroids.py), so there's no need to coarsify them afterwards.
 
 The Ordinance Survey only provides postcodes in grid-reference Northings and
 Eastings and we'd rather like GPS coordinates. Luckily they also provide a tool
@@ -41,6 +50,11 @@ http://www.ordnancesurvey.co.uk/business-and-government/help-and-support/navigat
 Sadly, that just gives us postcodes in degrees, minutes, and seconds, and
 we need them in decimal degrees (for sanity, and also for Basemap), so we'll
 convert them to that format as well.
+
+There are two ways in: import_postcodes, which goes through the file a row at
+a time, and bulk_import_postcodes, which turns each chunk of the file into
+arrays and converts and writes them all at once. The bulk one is the one to
+use for the whole country's 1.7 million postcodes.
 """
 
 postcode_fieldnames = ('postcode', 'latdeg', 'latmin', 'latsec', 'latdir',
@@ -54,35 +68,222 @@ def dms_to_dd(degrees, minutes, seconds, direction):
     return dir_modifier * (float(degrees) + float(minutes) / 60 +
                            float(seconds) / 3600)
 
-def import_postcodes(collection, csv_file):
-    """Imports postcodes from a csv_file, and saves them to a DB collection."""
-    
-    # Because this might take a while...
-    lines = sum(1 for line in open(csv_file))
-    line = 1;
+def dms_to_dd_array(degrees, minutes, seconds, directions):
+    """Converts arrays of degrees, minutes, seconds and directions ('N', 'S',
+    'E' or 'W') to an array of decimal degrees, as dms_to_dd does one at a
+    time.
+    """
+    sign = np.where(np.in1d(directions, ['S', 'W']), -1.0, 1.0)
+    return sign * (degrees + minutes / 60.0 + seconds / 3600.0)
+
+def import_postcodes(collection, csv_file, checkpoint_collection = None,
+                     centroid_database = None):
+    """Imports postcodes from a csv_file, and saves them to a DB collection.
+
+    The file is worked through in chunks. If a checkpoint_collection is given,
+    each chunk is recorded there once it's in the DB, and an import of the
+    same file will carry on from the first chunk that isn't. See
+    checkpoints.ImportCheckpoints.
+
+    If a centroid_database is given, the postcodes added in each chunk are
+    merged into its centroid lookup tables before the chunk is committed.
+    Postcodes which were in the DB already are left out, so importing the
+    same file twice doesn't count anything twice. With checkpoints, each
+    postcode and centroid is tagged with the chunk that added it (see
+    ImportCheckpoints.chunk_id), so that if we were killed partway through a
+    chunk, going over it again counts its postcodes exactly once.
+    """
+    total_bytes = os.path.getsize(csv_file)
+    bytes_read = 0
+    checkpoints = None
+    if checkpoint_collection is not None:
+        checkpoints = ImportCheckpoints(checkpoint_collection, csv_file,
+                                        collection.name)
+        bytes_read = checkpoints.resume_offset()
 
     # Avoid duplicates
     collection.ensure_index('postcode', unique = True, drop_dups = True)
-    
-    with open(csv_file, 'rb') as csv_input:
-        reader = csv.DictReader(csv_input, delimiter = ',',
+
+    builder = CentroidBuilder()
+    for start, end, data in read_chunks(csv_file, start = bytes_read):
+        tag = checkpoints.chunk_id(start) if checkpoints is not None else None
+        reader = csv.DictReader(data.splitlines(), delimiter = ',',
                                 fieldnames = postcode_fieldnames,
                                 restval = 'unknown')
+        rows = 0
+        entries = []
         for row in reader:
-            print "\rProcessing line " + str(line) + " of " + str(lines),
-            line += 1
+            rows += 1
+            postcode = postcodes.normalise(row['postcode'])
+            if postcode is None:
+                print 'Bad postcode in row:'
+                print row
+                continue
             try:
-                entry = { 'postcode': row['postcode'],
-                          'lat': dms_to_dd(row['latdeg'], row['latmin'],
-                                           row['latsec'], row['latdir']),
-                          'long': dms_to_dd(row['longdeg'], row['longmin'],
-                                            row['longsec'], row['longdir']) }
-                collection.insert(entry)
+                entries.append(
+                    { 'postcode': postcode,
+                      'lat': dms_to_dd(row['latdeg'], row['latmin'],
+                                       row['latsec'], row['latdir']),
+                      'long': dms_to_dd(row['longdeg'], row['longmin'],
+                                        row['longsec'], row['longdir']) })
             except ValueError:
                 print 'Error parsing row:'
                 print row
-            except errors.DuplicateKeyError:
-                pass
+        seen = set()
+        for batch_start in range(0, len(entries), batch_size):
+            batch = entries[batch_start:batch_start + batch_size]
+            for i in _new_postcodes(collection,
+                                    [entry['postcode'] for entry in batch],
+                                    seen, tag):
+                entry = batch[i]
+                if tag is not None:
+                    entry['chunk'] = tag
+                try:
+                    collection.insert(entry)
+                except errors.DuplicateKeyError:
+                    pass # Inserted before we were killed, but not counted
+                builder.add(entry['postcode'], entry['lat'], entry['long'])
+        if centroid_database is not None:
+            builder.merge_into(centroid_database, tag)
+        builder.clear()
+        if checkpoints is not None:
+            checkpoints.commit(start, end, chunk_digest(data), rows)
+        bytes_read = end
+        print "\rProcessed %d of %d bytes" % (bytes_read, total_bytes),
+
+def bulk_import_postcodes(collection, csv_file, checkpoint_collection = None,
+                          centroid_database = None):
+    """Imports postcodes from a csv_file as import_postcodes does, but as
+    quickly as we can manage.
+
+    Each chunk of the file is split into columns of typed arrays, the
+    coordinates are all converted to decimal degrees in one go, and any
+    postcode seen before (earlier in the file, or already in the DB) is
+    dropped before anything is written. The rest go in with unordered bulk
+    inserts, batch_size at a time, and their centroids are added up a level at
+    a time from the arrays.
+
+    checkpoint_collection and centroid_database are as for import_postcodes.
+    """
+    total_bytes = os.path.getsize(csv_file)
+    started = time.time()
+    bytes_read = 0
+    checkpoints = None
+    if checkpoint_collection is not None:
+        checkpoints = ImportCheckpoints(checkpoint_collection, csv_file,
+                                        collection.name)
+        bytes_read = checkpoints.resume_offset()
+    collection.ensure_index('postcode', unique = True, drop_dups = True)
+
+    rows = 0
+    inserted = 0
+    builder = CentroidBuilder()
+    for start, end, data in read_chunks(csv_file, start = bytes_read):
+        tag = checkpoints.chunk_id(start) if checkpoints is not None else None
+        seen = set()
+        with instrumentation.span('parse_postcode_chunk', start = start) \
+                as span:
+            names, lats, lons, count = _parse_postcode_chunk(data)
+            span.set(rows = count)
+        rows += count
+        with instrumentation.span('insert_postcode_chunk', start = start,
+                                  rows = len(names)):
+            for batch_start in range(0, len(names), batch_size):
+                batch = slice(batch_start, batch_start + batch_size)
+                new = _new_postcodes(collection, names[batch], seen, tag)
+                new_names = [names[batch_start + i] for i in new]
+                new_lats = lats[batch][new]
+                new_lons = lons[batch][new]
+                entries = [{ 'postcode': postcode, 'lat': lat, 'long': lon }
+                           for postcode, lat, lon in
+                           zip(new_names, new_lats.tolist(),
+                               new_lons.tolist())]
+                if tag is not None:
+                    for entry in entries:
+                        entry['chunk'] = tag
+                inserted += _bulk_insert(collection, entries)
+                builder.add_arrays(new_names, new_lats, new_lons)
+        if centroid_database is not None:
+            builder.merge_into(centroid_database, tag)
+        builder.clear()
+        if checkpoints is not None:
+            checkpoints.commit(start, end, chunk_digest(data), count)
+        bytes_read = end
+        _report_progress(bytes_read, total_bytes)
+
+    elapsed = time.time() - started
+    print
+    print 'Parsed %d rows (%d new) in %.1f seconds: %.0f rows/sec.' % \
+        (rows, inserted, elapsed, rows / max(elapsed, 1e-6))
+
+def _parse_postcode_chunk(data):
+    """Turns a chunk of the file into arrays: the normalised postcodes, and
+    their latitudes and longitudes in decimal degrees. Rows we can't make
+    sense of are reported and left out. Also returns the number of rows.
+    """
+    table = [row.split(',') for row in data.splitlines() if row]
+    rows = len(table)
+    for row in table:
+        if len(row) < len(postcode_fieldnames):
+            print 'Error parsing row:'
+            print ','.join(row)
+    table = [row[:len(postcode_fieldnames)] for row in table
+             if len(row) >= len(postcode_fieldnames)]
+    if not table:
+        return [], np.zeros(0), np.zeros(0), rows
+    table = np.array(table)
+    try:
+        numbers = table[:, [1, 2, 3, 5, 6, 7]].astype(np.float64)
+    except ValueError:
+        # There's a bad number somewhere; find it, and carry on without it
+        good = np.array([_is_numeric(row[[1, 2, 3, 5, 6, 7]])
+                         for row in table], dtype = bool)
+        for row in table[~good]:
+            print 'Error parsing row:'
+            print ','.join(row)
+        table = table[good]
+        numbers = table[:, [1, 2, 3, 5, 6, 7]].astype(np.float64)
+    lats = dms_to_dd_array(numbers[:, 0], numbers[:, 1], numbers[:, 2],
+                           table[:, 4])
+    lons = dms_to_dd_array(numbers[:, 3], numbers[:, 4], numbers[:, 5],
+                           table[:, 8])
+    names = [postcodes.normalise(postcode) for postcode in table[:, 0]]
+    valid = [i for i, postcode in enumerate(names) if postcode is not None]
+    if len(valid) < len(names):
+        for i in sorted(set(range(len(names))) - set(valid)):
+            print 'Bad postcode in row:'
+            print ','.join(table[i])
+    return [names[i] for i in valid], lats[valid], lons[valid], rows
+
+def _is_numeric(texts):
+    """Checks whether every one of some strings is a number."""
+    try:
+        [float(text) for text in texts]
+    except ValueError:
+        return False
+    return True
+
+def _new_postcodes(collection, names, seen, tag = None):
+    """Returns the positions in names of the postcodes which haven't been
+    counted yet, keeping only the first of any repeats.
+
+    seen holds the postcodes found so far in this chunk, and is added to.
+    Anything from earlier chunks has been written by now, so the lookup in
+    collection catches repeats of those too. Postcodes tagged with this
+    chunk's tag were written by an import that was killed before it
+    finished the chunk, and are still to be counted.
+    """
+    candidates = []
+    for i, postcode in enumerate(names):
+        if postcode not in seen:
+            seen.add(postcode)
+            candidates.append(i)
+    existing = set(entry['postcode'] for entry in collection.find(
+        { 'postcode': { '$in': [names[i] for i in candidates] } },
+        { 'postcode': 1, 'chunk': 1 })
+                   if tag is None or entry.get('chunk') != tag) \
+               if candidates else set()
+    return [i for i in candidates if names[i] not in existing]
 
 if __name__ == '__main__':
     if len(argv) < 2:
@@ -91,7 +292,13 @@ if __name__ == '__main__':
     if not argv[1].endswith('.csv'):
         print 'Argument must be a .csv file'
         exit()
-    client = MongoClient()
-    database = client[schemas.db_name]
+    database = schemas.connect()
     collection = database[schemas.input_postcode_collection_name]
-    import_postcodes(collection, argv[1])
+    if '--bulk' in argv[2:]:
+        import_function = bulk_import_postcodes
+    else:
+        import_function = import_postcodes
+    import_function(
+        collection, argv[1],
+        checkpoint_collection = database[schemas.checkpoint_collection_name],
+        centroid_database = database)
@@ -20,32 +20,54 @@
 
 import datetime
 import csv
+import os
+import resource
+import time
+from collections import deque
 from dateutil.parser import parse
+from multiprocessing import Pool, cpu_count
 from sys import argv, exit
 
-from pymongo import MongoClient, errors
+from pymongo import errors
 
 from .. import db_schemas as schemas
+from .. import instrumentation
+from .. import postcodes
+from ..AggregateCache import mark_changed
+from .checkpoints import ImportCheckpoints, chunk_digest, read_chunks
 
 """
 import_sale_data.py
 
 The Land Registry gives us house prices in a very hefty and complicated format,
 so we need to pull out just the appropriate bits and stuff them in a DB.
+
+Each sale goes into the prices collection for its region (see db_schemas), and
+is stored with its postcode district so we don't have to work that out again
+every time we aggregate.
 """
 
 # There are several additional fields here, but we only need the first four
 sale_data_fieldnames = ('id', 'price', 'date', 'postcode')
 
-def import_sale_data(collection, csv_file):
-    """Pulls relevant data from a csv file and stuffs it into a DB collection."""
+# How many documents go to the DB in each bulk insert.
+batch_size = 10000
+
+def import_sale_data(database, csv_file, watermark_collection = None,
+                     regions = None):
+    """Pulls relevant data from a csv file and stuffs it into the DB.
+
+    If a watermark_collection is given, the (region, year) cells which got new
+    sales are marked as changed there, so that cached aggregates get rebuilt.
+
+    If regions (a list of postcode areas, e.g. ['OX']) is given, only sales
+    there are kept.
+    """
     # Because this might take a while...
     lines = sum(1 for line in open(csv_file))
     line = 1;
+    changed = set()
 
-    # Avoid duplicates, and allow us to re-run imports
-    collection.ensure_index('_id', unique = True, drop_dups = True)
-    
     with open(csv_file, 'rb') as csv_input:
      
         reader = csv.DictReader(csv_input, delimiter = ',',
@@ -55,19 +77,216 @@ def import_sale_data(collection, csv_file):
             print "\rProcessing line " + str(line) + " of " + str(lines),
             line += 1
             try:
-                # Temp hack to improve tractibility
-                if not row['postcode'].startswith('OX'):
+                region, entry = sale_entry(row['id'], parse(row['date']),
+                                           row['price'], row['postcode'])
+                if region is None:
                     continue
-                entry = { '_id': row['id'],
-                          'date': parse(row['date']),
-                          'price': int(row['price']),
-                          'postcode': row['postcode'] }
-                collection.insert(entry)
+                if regions is not None and region not in regions:
+                    continue
+                schemas.prices_collection_for(database, region).insert(entry)
+                changed.add((region, entry['date'].year))
             except ValueError:
                 print 'Error parsing date or price for row :'
                 print row
             except errors.DuplicateKeyError:
                 pass 
+    if watermark_collection is not None:
+        mark_changed(watermark_collection, changed)
+
+def bulk_import_sale_data(database, csv_file, processes = None,
+                          regions = None, checkpoint_collection = None,
+                          watermark_collection = None):
+    """Pulls relevant data from a csv file and stuffs it into the DB, as
+    quickly as we can manage.
+
+    The file is only read once. It's split into chunks on line boundaries,
+    which are parsed by a pool of worker processes, and the results are
+    written with unordered bulk inserts (so duplicates don't hold anything
+    up). Only a couple of chunks per process are read ahead of the inserts,
+    so memory use stays flat however big the file is. Progress is reported
+    in terms of bytes read, and the throughput and peak memory use are
+    printed at the end.
+
+    If a checkpoint_collection is given, each chunk is recorded there once
+    it's in the DB, and an import of the same file will carry on from the
+    first chunk that isn't. See checkpoints.ImportCheckpoints.
+
+    If a watermark_collection is given, the (region, year) cells which got new
+    sales are marked as changed there, so that cached aggregates get rebuilt.
+    That's done for each chunk before it's committed, so that a chunk is
+    never recorded as imported without its cells being marked, however the
+    import ends. The first chunk after resuming may have been partly
+    inserted last time, in which case its sales are already in the DB and
+    don't count as new, so all of its cells are marked.
+
+    If regions (a list of postcode areas, e.g. ['OX']) is given, only sales
+    there are kept. processes defaults to the number of CPUs.
+    """
+    total_bytes = os.path.getsize(csv_file)
+    started = time.time()
+    checkpoints = None
+    bytes_read = 0
+    if checkpoint_collection is not None:
+        checkpoints = ImportCheckpoints(checkpoint_collection, csv_file,
+                                        schemas.prices_collection_name,
+                                        regions)
+        bytes_read = checkpoints.resume_offset()
+        if bytes_read:
+            print 'Resuming from byte %d of %d.' % (bytes_read, total_bytes)
+    rows = 0
+    inserted = 0
+    resumed = checkpoints is not None
+
+    pool = Pool(processes)
+    try:
+        chunks = ((start, end, data, regions)
+                  for start, end, data in read_chunks(csv_file,
+                                                      start = bytes_read))
+        window = 2 * (processes or cpu_count())
+        for entries, start, end, digest in _imap_window(pool, _parse_chunk,
+                                                        chunks, window):
+            rows += len(entries)
+            changed = set()
+            with instrumentation.span('insert_chunk', start = start,
+                                      rows = len(entries)):
+                for batch_start in range(0, len(entries), batch_size):
+                    batch = entries[batch_start:batch_start + batch_size]
+                    for region, region_batch in _by_region(batch).iteritems():
+                        new = _bulk_insert(
+                            schemas.prices_collection_for(database, region),
+                            region_batch)
+                        inserted += new
+                        if new or resumed:
+                            changed.update((region, entry['date'].year)
+                                           for entry in region_batch)
+            if watermark_collection is not None:
+                mark_changed(watermark_collection, changed)
+            if checkpoints is not None:
+                checkpoints.commit(start, end, digest, len(entries))
+            resumed = False
+            bytes_read = end
+            _report_progress(bytes_read, total_bytes)
+    finally:
+        pool.close()
+        pool.join()
+
+    elapsed = time.time() - started
+    print
+    print 'Parsed %d rows (%d new) in %.1f seconds: %.0f rows/sec.' % \
+        (rows, inserted, elapsed, rows / max(elapsed, 1e-6))
+    print 'Peak memory: %.1f MB (main), %.1f MB (largest worker).' % \
+        _peak_memory_mb()
+
+def parse_date(text):
+    """Parses the Land Registry's 'YYYY-MM-DD HH:MM' dates.
+
+    This is a lot quicker than dateutil, and is happy as long as the date is
+    at the start of the string.
+    """
+    return datetime.datetime(int(text[0:4]), int(text[5:7]), int(text[8:10]))
+
+def sale_entry(sale_id, date, price, postcode):
+    """Builds the DB entry for a sale.
+
+    Returns the region the sale belongs in and the entry, or (None, None) if
+    the postcode isn't valid. Raises ValueError if the price isn't a number.
+    """
+    parts = postcodes.split(postcode)
+    if parts is None:
+        return None, None
+    region, district, sector = parts
+    return region, { '_id': sale_id,
+                     'date': date,
+                     'price': int(price),
+                     'postcode': postcodes.normalise(postcode),
+                     'district': district }
+
+def parse_rows(lines, regions = None):
+    """Turns lines from the sale data file into DB entries.
+
+    Rows outside regions (if given) are skipped, as are rows we can't parse.
+    """
+    entries = []
+    for row in csv.reader(lines):
+        if len(row) < 4:
+            continue
+        try:
+            region, entry = sale_entry(row[0], parse_date(row[2]), row[1],
+                                       row[3])
+        except ValueError:
+            print 'Error parsing date or price for row :'
+            print row
+            continue
+        if region is None:
+            continue
+        if regions is not None and region not in regions:
+            continue
+        entries.append(entry)
+    return entries
+
+def _parse_chunk(args):
+    """Pool worker: parses one chunk of the file.
+
+    Returns the entries, the chunk's offsets and its content hash.
+    """
+    start, end, data, regions = args
+    return (parse_rows(data.splitlines(), regions), start, end,
+            chunk_digest(data))
+
+def _imap_window(pool, function, tasks, window):
+    """Like pool.imap, but only window tasks are handed out at a time, and
+    the next is only read from tasks once the oldest has been collected.
+    Results come back in order.
+    """
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(function, (task,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def _by_region(entries):
+    """Splits a list of entries up by region."""
+    regions = {}
+    for entry in entries:
+        region = postcodes.area_of_district(entry['district'])
+        regions.setdefault(region, []).append(entry)
+    return regions
+
+def _bulk_insert(collection, entries):
+    """Inserts a batch of entries, ignoring any that are already present.
+
+    Returns the number actually inserted.
+    """
+    if not entries:
+        return 0
+    bulk = collection.initialize_unordered_bulk_op()
+    for entry in entries:
+        bulk.insert(entry)
+    try:
+        result = bulk.execute()
+    except errors.BulkWriteError as e:
+        result = e.details
+        for error in result['writeErrors']:
+            if error['code'] != 11000: # Duplicate key
+                print 'Error inserting row:'
+                print error['op']
+    return result['nInserted']
+
+def _report_progress(bytes_read, total_bytes):
+    """Prints how far through the file we are."""
+    print "\rProcessed %.1f of %.1f MB (%.0f%%)" % \
+        (bytes_read / 1048576.0, total_bytes / 1048576.0,
+         100.0 * bytes_read / max(total_bytes, 1)),
+
+def _peak_memory_mb():
+    """Returns the peak resident memory of this process and of its largest
+    finished child, in MB.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return own / 1024.0, children / 1024.0
 
 if __name__ == '__main__':
     if len(argv) < 2:
@@ -76,8 +295,12 @@ if __name__ == '__main__':
     if not argv[1].endswith('.csv'):
         print 'Argument must be a .csv file'
         exit()
-    client = MongoClient()
-    database = client[schemas.db_name]
-    collection = database[schemas.prices_collection_name]
-    import_sale_data(collection, argv[1])
-    
+    database = schemas.connect()
+    watermarks = database[schemas.watermark_collection_name]
+    if '--bulk' in argv[2:]:
+        checkpoints = database[schemas.checkpoint_collection_name]
+        bulk_import_sale_data(database, argv[1],
+                              checkpoint_collection = checkpoints,
+                              watermark_collection = watermarks)
+    else:
+        import_sale_data(database, argv[1], watermarks)
@@ -0,0 +1,165 @@
+#! /usr/bin/python
+
+""" Copyright 2014 Forrest Brennen
+
+    This file is part of price_picture.
+
+    price_picture is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    price_picture is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with price_picture.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import csv
+import time
+from sys import argv, exit
+
+from .. import db_schemas as schemas
+from .. import postcodes
+from ..AggregateCache import AggregateCache, mark_changed
+from ..PriceMatrix import refresh_cached_cells
+from .import_sale_data import parse_date, sale_entry
+
+"""
+import_updates.py
+
+The Land Registry publishes a monthly file of changes to the price paid data,
+in the same format as the full file but with a record status on the end of
+each row: 'A' for a new sale, 'C' for a change to one we already have, and 'D'
+for one that should be deleted. Applying one of those is a lot quicker than
+importing the full file again.
+
+Only the cached aggregates for the (year, prefix) cells which were touched
+get recalculated. A change can move a sale to a different region, so every
+region's prices collection is checked for the sales in each batch.
+"""
+
+# How many rows we deal with at a time.
+batch_size = 10000
+
+def import_updates(database, csv_file, cache = None,
+                   watermark_collection = None, regions = None):
+    """Applies a Land Registry change file to the prices collections.
+
+    If a cache (an AggregateCache) is given, the cached aggregates for the
+    cells which changed are brought up to date. Otherwise the changed cells
+    are just marked as stale in watermark_collection, which defaults to the
+    database's own.
+
+    If regions (a list of postcode areas, e.g. ['OX']) is given, only sales
+    there are kept. Returns the set of (region, year, prefix) cells which
+    changed.
+    """
+    started = time.time()
+    touched = set()
+    rows = 0
+    with open(csv_file, 'rb') as csv_input:
+        batch = []
+        for row in csv.reader(csv_input):
+            if len(row) < 5:
+                continue
+            batch.append(row)
+            if len(batch) >= batch_size:
+                rows += len(batch)
+                touched.update(_apply_batch(database, batch, regions))
+                batch = []
+        rows += len(batch)
+        touched.update(_apply_batch(database, batch, regions))
+
+    if cache is not None:
+        refresh_cached_cells(cache, database, touched)
+    else:
+        if watermark_collection is None:
+            watermark_collection = \
+                database[schemas.watermark_collection_name]
+        mark_changed(watermark_collection,
+                     set((region, year) for region, year, prefix in touched))
+    print 'Applied %d changes, touching %d cells, in %.1f seconds.' % \
+        (rows, len(touched), time.time() - started)
+    return touched
+
+def _apply_batch(database, rows, regions):
+    """Applies a batch of change rows with one bulk operation per region.
+
+    Returns the (region, year, prefix) cells touched, both by the sales as
+    they were and as they are now.
+
+    If regions is given, nothing outside them is read or written: rows for
+    sales elsewhere are skipped, unless the sale is currently stored in one
+    of our regions and has moved out of them, in which case it's removed
+    from ours.
+    """
+    if not rows:
+        return set()
+    ids = [row[0] for row in rows]
+    touched = set()
+    # Which of our regions each sale is currently stored under
+    existing = {}
+    for region in schemas.price_regions(database):
+        if regions is not None and region not in regions:
+            continue
+        collection = schemas.prices_collection_for(database, region)
+        for old in collection.find({ '_id': { '$in': ids } },
+                                   { 'district': 1, 'date': 1 }):
+            existing[old['_id']] = region
+            touched.add(_cell_of(old))
+
+    bulks = {}
+    def bulk_for(region):
+        if region not in bulks:
+            bulks[region] = schemas.prices_collection_for(database, region) \
+                                   .initialize_unordered_bulk_op()
+        return bulks[region]
+
+    for row in rows:
+        status = row[-1].strip()
+        region, entry = None, None
+        if status != 'D':
+            try:
+                region, entry = sale_entry(row[0], parse_date(row[2]),
+                                           row[1], row[3])
+            except ValueError:
+                print 'Error parsing date or price for row :'
+                print row
+                continue
+        old_region = existing.get(row[0])
+        if region is not None and regions is not None and \
+           region not in regions:
+            if old_region is None:
+                continue
+            region, entry = None, None
+        if old_region is not None and old_region != region:
+            # Deleted, or moved to another region
+            bulk_for(old_region).find({ '_id': row[0] }).remove_one()
+        if entry is not None:
+            bulk_for(region).find({ '_id': row[0] }).upsert() \
+                            .replace_one(entry)
+            touched.add(_cell_of(entry))
+    for bulk in bulks.itervalues():
+        bulk.execute()
+    return touched
+
+def _cell_of(entry):
+    """Returns the (region, year, prefix) a sale belongs to."""
+    return (postcodes.area_of_district(entry['district']), entry['date'].year,
+            entry['district'])
+
+if __name__ == '__main__':
+    if len(argv) < 2:
+        print 'Give us a csv file!'
+        exit()
+    if not argv[1].endswith('.csv'):
+        print 'Argument must be a .csv file'
+        exit()
+    database = schemas.connect()
+    cache = AggregateCache(database[schemas.aggregate_cache_collection_name],
+                           database[schemas.watermark_collection_name])
+    import_updates(database, argv[1], cache)
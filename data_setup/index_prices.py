@@ -0,0 +1,124 @@
+#! /usr/bin/python
+
+""" Copyright 2014 Forrest Brennen
+
+    This file is part of price_picture.
+
+    price_picture is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    price_picture is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with price_picture.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from datetime import datetime
+from sys import argv
+
+from .. import db_schemas as schemas
+from ..PriceYear import sales_query
+
+"""
+index_prices.py
+
+Makes sure every region's prices collection has the indexes the aggregations
+need (db_schemas.prices_indexes), and drops any others, like the single-field
+ones older versions made, which only slow imports down.
+
+It then checks, with explain, that picking out a year's sales is answered from
+one of those indexes, so that aggregating a year takes time in proportion to
+that year's sales and not to the whole collection. On a MongoDB server the
+query should be covered, too: everything is read from the index, and no sales
+at all are looked at.
+"""
+
+# What the aggregations read of each sale (see PriceYear._aggregate_sketches).
+sale_fields = { '_id': 0, 'date': 1, 'district': 1, 'price': 1 }
+
+def index_prices(database, regions = None):
+    """Builds the prices_indexes for every region (or just those given), and
+    drops any other indexes. Returns a dictionary mapping each region to the
+    names of the indexes dropped.
+    """
+    wanted = [[tuple(key) for key in index]
+              for index in schemas.prices_indexes]
+    dropped = {}
+    for region in regions or schemas.price_regions(database):
+        collection = schemas.prices_collection_for(database, region)
+        dropped[region] = []
+        for name, information in collection.index_information().iteritems():
+            if name != '_id_' and \
+               [tuple(key) for key in information['key']] not in wanted:
+                collection.drop_index(name)
+                dropped[region].append(name)
+    return dropped
+
+def check_query_plans(database, year, regions = None):
+    """Explains the query for a year's sales in every region (or just those
+    given).
+
+    Returns a dictionary mapping each region to the index used (or None),
+    whether the query was covered, the number of sales looked at and the
+    number returned.
+    """
+    query = sales_query(datetime(year, 1, 1), datetime(year + 1, 1, 1))
+    plans = {}
+    for region in regions or schemas.price_regions(database):
+        collection = schemas.prices_collection_for(database, region)
+        plans[region] = _plan_summary(collection.find(query, sale_fields)
+                                                .explain())
+    return plans
+
+def _plan_summary(explanation):
+    """Picks out of the output of explain the index used (or None for a scan
+    of the whole collection), whether the query was covered, and how many
+    documents were looked at and returned.
+
+    Servers from 3.0 on describe the plan as a tree of stages; older ones as
+    a cursor type.
+    """
+    if 'queryPlanner' in explanation:
+        stages = []
+        stage = explanation['queryPlanner']['winningPlan']
+        while stage is not None:
+            stages.append(stage)
+            stage = stage.get('inputStage')
+        indexes = [stage['indexName'] for stage in stages
+                   if stage['stage'] == 'IXSCAN']
+        statistics = explanation.get('executionStats', {})
+        return (indexes[0] if indexes else None,
+                bool(indexes) and
+                not any(stage['stage'] == 'FETCH' for stage in stages),
+                statistics.get('totalDocsExamined'),
+                statistics.get('nReturned'))
+    cursor = explanation.get('cursor', '')
+    return (cursor.split(' ', 1)[1] if cursor.startswith('BtreeCursor')
+            else None,
+            bool(explanation.get('indexOnly')),
+            explanation.get('nscannedObjects'), explanation.get('n'))
+
+if __name__ == '__main__':
+    # Optionally a year to check, then the regions to look at
+    arguments = argv[1:]
+    year = datetime.now().year - 1
+    if arguments and arguments[0].isdigit():
+        year = int(arguments.pop(0))
+    database = schemas.connect()
+    regions = arguments or None
+    for region, names in sorted(index_prices(database, regions).iteritems()):
+        for name in names:
+            print 'Dropped %s from %s.' % (name, region)
+    for region, (index, covered, examined, returned) in \
+            sorted(check_query_plans(database, year, regions).iteritems()):
+        if index is None:
+            print '%s: %d scans the whole collection!' % (region, year)
+            continue
+        print '%s: %d uses %s%s, looking at %s sales for %s.' % \
+            (region, year, index, ' (covered)' if covered else '', examined,
+             returned)
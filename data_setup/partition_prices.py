@@ -0,0 +1,64 @@
+#! /usr/bin/python
+
+""" Copyright 2014 Forrest Brennen
+
+    This file is part of price_picture.
+
+    price_picture is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    price_picture is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with price_picture.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from .. import db_schemas as schemas
+from .import_sale_data import _bulk_insert, _by_region, batch_size, sale_entry
+
+"""
+partition_prices.py
+
+Sales used to all live in one prices collection, keyed on the first four
+characters of their postcodes. This moves them into the per-region collections
+(see db_schemas), adding the postcode district to each as it goes. Sales whose
+postcodes can't be parsed are left where they are.
+"""
+
+def partition_prices(database):
+    """Moves every sale in the old prices collection into its region's
+    collection, and drops the old collection if nothing was left behind.
+    """
+    legacy = database[schemas.prices_collection_name]
+    moved = 0
+    skipped = 0
+    batch = []
+    for sale in legacy.find():
+        region, entry = sale_entry(sale['_id'], sale['date'], sale['price'],
+                                   sale['postcode'])
+        if region is None:
+            skipped += 1
+            continue
+        batch.append(entry)
+        if len(batch) >= batch_size:
+            moved += _move(database, batch)
+            batch = []
+    moved += _move(database, batch)
+    print 'Moved %d sales, skipped %d.' % (moved, skipped)
+    if not skipped:
+        legacy.drop()
+
+def _move(database, entries):
+    """Inserts a batch of sales into their regions' collections."""
+    for region, region_batch in _by_region(entries).iteritems():
+        _bulk_insert(schemas.prices_collection_for(database, region),
+                     region_batch)
+    return len(entries)
+
+if __name__ == '__main__':
+    partition_prices(schemas.connect())
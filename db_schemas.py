@@ -18,6 +18,7 @@
     along with price_picture.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import os
 
 """
 db_schemas.py
@@ -25,9 +26,72 @@ db_schemas.py
 Names of the databases and collections used for storing price_picture data.
 This should probably be expanded, as there are still several collection-specific
 accessors in MapDisplay and PriceYear.
+
+Sales are partitioned by region (postcode area, e.g. 'OX'), with a prices
+collection for each, so that looking at one region never has to wade through
+any other region's sales.
+
+Everything goes through connect(), which hands back either a MongoDB database
+or a LocalStore database in a single file, whichever the backend argument, the
+PRICE_PICTURE_BACKEND environment variable or default_backend (in that order)
+asks for. It doesn't go looking for a server itself.
 """
 
 db_name = 'price_picture'
 prices_collection_name = 'prices'
 input_postcode_collection_name = 'postcodes'
 postcode_collection_name = 'postcode_prefix'
+area_centroid_collection_name = 'postcode_area'
+sector_centroid_collection_name = 'postcode_sector'
+checkpoint_collection_name = 'import_checkpoints'
+aggregate_cache_collection_name = 'aggregate_cache'
+watermark_collection_name = 'watermarks'
+
+# The postcode centroid lookup table for each level (see data_setup.centroids).
+# Districts are what MapDisplay draws.
+centroid_collection_names = { 'area': area_centroid_collection_name,
+                              'district': postcode_collection_name,
+                              'sector': sector_centroid_collection_name }
+
+# The indexes on each region's prices collection. Sales are picked out by date
+# (and sometimes by district), and all we read of them is the date, district
+# and price, so with all three in each index a server never has to look at the
+# sales themselves. Any other indexes are dropped by data_setup.index_prices.
+prices_indexes = [[('date', 1), ('district', 1), ('price', 1)],
+                  [('district', 1), ('date', 1), ('price', 1)]]
+
+# Which storage backend to use: 'mongodb' for a MongoDB server, or 'local' for
+# an embedded SQLite file (see LocalStore). The PRICE_PICTURE_BACKEND and
+# PRICE_PICTURE_DB_PATH environment variables override these.
+default_backend = 'mongodb'
+local_db_path = 'price_picture.sqlite'
+
+def connect(backend = None):
+    """Returns the price_picture database, for a MongoDB server or the local
+    file, as given by backend or the environment.
+    """
+    if backend is None:
+        backend = os.environ.get('PRICE_PICTURE_BACKEND', default_backend)
+    if backend == 'local':
+        from LocalStore import LocalDatabase
+        return LocalDatabase(os.environ.get('PRICE_PICTURE_DB_PATH',
+                                            local_db_path))
+    if backend == 'mongodb':
+        from pymongo import MongoClient
+        return MongoClient()[db_name] # May crash if the server isn't running
+    raise ValueError('Unknown storage backend: ' + backend)
+
+def prices_collection_for(database, region):
+    """Returns the prices collection for a region, e.g. 'prices_OX', with the
+    prices_indexes.
+    """
+    collection = database[prices_collection_name + '_' + region]
+    for index in prices_indexes:
+        collection.ensure_index(index)
+    return collection
+
+def price_regions(database):
+    """Returns the regions which have a prices collection."""
+    prefix = prices_collection_name + '_'
+    return sorted(name[len(prefix):] for name in database.collection_names()
+                  if name.startswith(prefix))
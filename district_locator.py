@@ -0,0 +1,132 @@
+#! /usr/bin/python
+
+""" Copyright 2014 Forrest Brennen
+
+    This file is part of price_picture.
+
+    price_picture is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    price_picture is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with price_picture.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+import postcodes
+from PriceYear import _aggregate
+
+"""
+district_locator.py
+
+Works out where postcode districts are that aren't in the centroid tables any
+more. The sale data goes back to 1995, and a few districts have been retired
+since: OX6 and OX8 in Oxfordshire were split up into OX25-OX29 and friends.
+Sales there used to be left off the map altogether.
+
+The sales remember their full postcodes, so we look those up in the unit
+postcode collection. Terminated postcodes are often still listed there, and
+give an exact position. Those that aren't were usually recoded keeping their
+inward code ('OX6 7AB' became 'OX26 7AB', say), so we look for units in the
+same area with the same inward code, and take whichever is nearest to where
+the rest of the district is. A district ends up at the average position of
+its sales, like the districts in the centroid tables.
+"""
+
+def locate_districts(unit_collection, prices_collection, districts):
+    """Finds the GPS coordinates of some districts from the postcodes of the
+    sales made in them.
+
+    unit_collection holds the unit postcodes (as filled in by
+    import_postcodes), and prices_collection the sales. Returns a dictionary
+    mapping each district that could be placed to (lon, lat, count), where
+    count is the number of sales the position is based on.
+    """
+    if not districts:
+        return {}
+    pipeline = [{ '$match': { 'district': { '$in': list(districts) } } },
+                { '$group': { '_id': '$postcode', 'count': { '$sum': 1 } } }]
+    sales = dict((entry['_id'], entry['count'])
+                 for entry in _aggregate(prices_collection, pipeline)
+                 if entry['_id'] is not None)
+    known = dict((entry['postcode'], (entry['long'], entry['lat']))
+                 for entry in unit_collection.find(
+                     { 'postcode': { '$in': list(sales) } }))
+    by_district = {}
+    for postcode, count in sales.iteritems():
+        by_district.setdefault(postcodes.district(postcode), []) \
+                   .append((postcode, count))
+
+    units_by_area = {}
+    locations = {}
+    for district, district_sales in by_district.iteritems():
+        area = postcodes.area_of_district(district)
+        found = [(known[postcode], count)
+                 for postcode, count in district_sales if postcode in known]
+        missing = [(postcode, count)
+                   for postcode, count in district_sales
+                   if postcode not in known]
+        if missing:
+            if area not in units_by_area:
+                units_by_area[area] = _units_by_inward_code(unit_collection,
+                                                            area)
+            found += _recoded_positions(units_by_area[area], missing, found)
+        if not found:
+            continue
+        positions = np.array([position for position, count in found])
+        counts = np.array([count for position, count in found],
+                          dtype = np.float64)
+        lon, lat = np.average(positions, axis = 0, weights = counts)
+        locations[district] = (float(lon), float(lat), int(counts.sum()))
+    return locations
+
+def _units_by_inward_code(unit_collection, area):
+    """Returns a dictionary mapping each inward code (e.g. '7AB') in an area to
+    the districts and positions of the units which have it.
+    """
+    units = {}
+    pattern = '^' + area + '[0-9]'
+    for entry in unit_collection.find({ 'postcode': { '$regex': pattern } }):
+        district, inward = entry['postcode'].split(' ')
+        units.setdefault(inward, []).append((district,
+                                             (entry['long'], entry['lat'])))
+    return units
+
+def _recoded_positions(units, missing, found):
+    """Guesses where some postcodes which are no longer listed were, from the
+    units which now share their inward codes.
+
+    found holds the ((lon, lat), count) of the district's postcodes we've
+    already placed, and is used to choose between candidates. If there
+    aren't any, we go with the district most of the candidates are in.
+    Returns a list of ((lon, lat), count) like found.
+    """
+    candidates = [(units[postcode.split(' ')[1]], count)
+                  for postcode, count in missing
+                  if postcode.split(' ')[1] in units]
+    if not candidates:
+        return []
+    if found:
+        anchor = np.median([position for position, count in found], axis = 0)
+    else:
+        votes = {}
+        for matches, count in candidates:
+            for district in set(district for district, position in matches):
+                votes[district] = votes.get(district, 0) + count
+        successor = max(sorted(votes), key = votes.get)
+        anchor = np.median([position for matches, count in candidates
+                            for district, position in matches
+                            if district == successor], axis = 0)
+    positions = []
+    for matches, count in candidates:
+        points = np.array([position for district, position in matches])
+        nearest = np.hypot(*(points - anchor).T).argmin()
+        positions.append((tuple(points[nearest]), count))
+    return positions
@@ -0,0 +1,220 @@
+#! /usr/bin/python
+
+""" Copyright 2014 Forrest Brennen
+
+    This file is part of price_picture.
+
+    price_picture is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    price_picture is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with price_picture.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import os
+import resource
+import threading
+import time
+
+"""
+instrumentation.py
+
+Named spans around the stages we care about (loading the map, loading
+postcodes, aggregating each year, drawing each frame, ...), so that when
+something is slow we can see where the time went:
+
+    instrumentation.enable()
+    with instrumentation.span('load_postcodes') as span:
+        ...
+        span.set(rows = len(postcodes))
+    instrumentation.dump_trace('trace.json')
+
+Each span records its wall time, the peak memory of the process when it
+finished (and how much that grew while it ran), and whatever fields it was
+given, such as a row count or a year. Spans nest, and remember which process
+and thread they ran in. The results are available from spans() and summary(),
+and can be written out as JSON, or as a trace-event file which chrome://tracing
+or Perfetto will draw as a timeline.
+
+Nothing is recorded unless enable() has been called (or PRICE_PICTURE_TRACE is
+set in the environment). When it hasn't, span() hands back the same do-nothing
+object every time, so leaving spans in hot loops costs next to nothing.
+"""
+
+enabled = bool(os.environ.get('PRICE_PICTURE_TRACE'))
+
+_records = []
+_records_lock = threading.Lock()
+_local = threading.local()
+
+class Span():
+    """A stage being timed. Use span() rather than creating these directly.
+
+    Public methods:
+    - set(**fields) -- adds fields (e.g. rows) to the span's record.
+
+    Public variables:
+    - name -- what's being timed.
+    - fields -- the extra fields recorded with the span.
+    """
+
+    def __init__(self, name, fields):
+        """Constructor."""
+        self.name = name
+        self.fields = fields
+
+    def set(self, **fields):
+        """Adds fields to the span's record."""
+        self.fields.update(fields)
+
+    def __enter__(self):
+        stack = _stack()
+        self._parent = stack[-1].name if stack else None
+        self._depth = len(stack)
+        stack.append(self)
+        self._peak_before = _peak_memory_mb()
+        self._started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.time() - self._started
+        peak = _peak_memory_mb()
+        _stack().pop()
+        record = { 'name': self.name,
+                   'start': self._started,
+                   'seconds': elapsed,
+                   'peak_memory_mb': peak,
+                   'memory_growth_mb': peak - self._peak_before,
+                   'pid': os.getpid(),
+                   'thread': threading.current_thread().name,
+                   'depth': self._depth,
+                   'parent': self._parent }
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        record.update(self.fields)
+        with _records_lock:
+            _records.append(record)
+        return False
+
+class _NullSpan():
+    """What span() returns when we're not recording."""
+
+    def set(self, **fields):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_null_span = _NullSpan()
+
+def span(name, **fields):
+    """Returns a context manager which records how long its body takes,
+    along with any fields given (e.g. year = 2001).
+    """
+    if not enabled:
+        return _null_span
+    return Span(name, fields)
+
+def enable():
+    """Starts recording spans."""
+    global enabled
+    enabled = True
+
+def disable():
+    """Stops recording spans. Anything recorded already is kept."""
+    global enabled
+    enabled = False
+
+def reset():
+    """Throws away everything recorded so far."""
+    with _records_lock:
+        del _records[:]
+
+def spans(name = None):
+    """Returns the records of every finished span (or just those called
+    name), in the order they finished.
+    """
+    with _records_lock:
+        return [dict(record) for record in _records
+                if name is None or record['name'] == name]
+
+def collect():
+    """Returns every record and forgets them, e.g. so a worker process can
+    hand its spans back to the parent (see merge).
+    """
+    with _records_lock:
+        records = list(_records)
+        del _records[:]
+    return records
+
+def merge(records):
+    """Adds records collected elsewhere, e.g. in a worker process."""
+    with _records_lock:
+        _records.extend(records)
+
+def summary():
+    """Returns a dictionary of span name -> the number of times it ran, the
+    total and longest times, the total of any rows recorded, and the highest
+    peak memory.
+    """
+    totals = {}
+    for record in spans():
+        total = totals.setdefault(record['name'],
+                                  { 'count': 0, 'total_seconds': 0.0,
+                                    'max_seconds': 0.0, 'rows': 0,
+                                    'peak_memory_mb': 0.0 })
+        total['count'] += 1
+        total['total_seconds'] += record['seconds']
+        total['max_seconds'] = max(total['max_seconds'], record['seconds'])
+        total['rows'] += record.get('rows', 0)
+        total['peak_memory_mb'] = max(total['peak_memory_mb'],
+                                      record['peak_memory_mb'])
+    return totals
+
+def dump_json(filename):
+    """Writes every span record, and the summary, to a JSON file."""
+    with open(filename, 'w') as output:
+        json.dump({ 'spans': spans(), 'summary': summary() }, output,
+                  indent = 1, sort_keys = True)
+
+def dump_trace(filename):
+    """Writes every span to a file in the trace-event format, for
+    chrome://tracing or Perfetto.
+    """
+    records = spans()
+    origin = min(record['start'] for record in records) if records else 0
+    events = []
+    for record in records:
+        arguments = dict((key, value) for key, value in record.iteritems()
+                         if key not in ('name', 'start', 'seconds', 'pid',
+                                        'thread', 'depth', 'parent'))
+        events.append({ 'name': record['name'],
+                        'ph': 'X',
+                        'ts': (record['start'] - origin) * 1e6,
+                        'dur': record['seconds'] * 1e6,
+                        'pid': record['pid'],
+                        'tid': record['thread'],
+                        'args': arguments })
+    with open(filename, 'w') as output:
+        json.dump({ 'traceEvents': events, 'displayTimeUnit': 'ms' }, output)
+
+def _stack():
+    """Returns the spans currently open in this thread."""
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+def _peak_memory_mb():
+    """Returns the peak resident memory of this process so far, in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
@@ -0,0 +1,86 @@
+#! /usr/bin/python
+
+""" Copyright 2014 Forrest Brennen
+
+    This file is part of price_picture.
+
+    price_picture is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    price_picture is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with price_picture.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import re
+
+"""
+postcodes.py
+
+Picks UK postcodes apart. A postcode like 'SW1A 1AA' is made up of:
+
+    area      'SW'        the letters at the start
+    district  'SW1A'      the outward code, everything before the space
+    sector    'SW1A 1'    the district plus the first digit of the inward code
+    unit      'SW1A 1AA'  the whole thing
+
+Taking the first four characters, as we used to, gets 'OX1 ' and 'OX14' right
+but makes a mess of 'W1 1AA' or 'M1 1AA'. The inward code is always a digit
+followed by two letters, so we find the split from the end instead.
+
+Each area is also what we partition the sale data by (see db_schemas).
+"""
+
+_postcode_pattern = re.compile(
+    '^([A-Z]{1,2})([0-9][0-9A-Z]?) *([0-9])([A-Z]{2})$')
+
+def normalise(postcode):
+    """Returns a postcode in upper case with a single space before the inward
+    code, e.g. 'OX101AB' or 'ox10  1ab' become 'OX10 1AB'.
+
+    Returns None if it doesn't look like a postcode at all.
+    """
+    match = _postcode_pattern.match(postcode.strip().upper())
+    if match is None:
+        return None
+    area, district, sector, unit = match.groups()
+    return '%s%s %s%s' % (area, district, sector, unit)
+
+def split(postcode):
+    """Returns the (area, district, sector) of a postcode, e.g. ('OX', 'OX1',
+    'OX1 1') for 'OX1 1AB', or None if it isn't a valid postcode.
+    """
+    match = _postcode_pattern.match(postcode.strip().upper())
+    if match is None:
+        return None
+    area, district, sector, unit = match.groups()
+    return area, area + district, '%s%s %s' % (area, district, sector)
+
+def area(postcode):
+    """Returns the area of a postcode, e.g. 'OX' for 'OX1 1AB', or None."""
+    parts = split(postcode)
+    return parts and parts[0]
+
+def district(postcode):
+    """Returns the district (outward code) of a postcode, e.g. 'OX1' for
+    'OX1 1AB', or None.
+    """
+    parts = split(postcode)
+    return parts and parts[1]
+
+def sector(postcode):
+    """Returns the sector of a postcode, e.g. 'OX1 1' for 'OX1 1AB', or
+    None.
+    """
+    parts = split(postcode)
+    return parts and parts[2]
+
+def area_of_district(district):
+    """Returns the area a district (e.g. 'OX14') belongs to (e.g. 'OX')."""
+    return re.match('[A-Z]*', district.upper()).group(0)